@@ -0,0 +1,41 @@
+import os
+import pytest
+import numpy as np
+
+torch = pytest.importorskip("torch")
+
+from test_compaction import DIM, make_index
+
+from xlmr_colbert.indexing.loaders import ALIASES_FILENAME
+from xlmr_colbert.ranking.index_part import IndexPart
+
+
+def test_duplicates_are_scored_by_the_range_of_their_canonical_pid(tmp_path):
+    torch.manual_seed(0)
+
+    parts_doclens = [torch.randint(1, 20, (30,)).tolist() for _ in range(3)]
+    parts_doclens[1][10] = 0  # pid 40, a duplicate of pid 3
+    parts_doclens[2][0] = 0  # pid 60, a duplicate of pid 45
+
+    index_path = str(tmp_path / "index")
+    make_index(index_path, parts_doclens)
+
+    aliases = np.arange(90, dtype=np.int64)
+    aliases[40], aliases[60] = 3, 45
+    np.save(os.path.join(index_path, ALIASES_FILENAME), aliases[:80])
+
+    Q = torch.randn(1, DIM, 8)
+    kwargs = dict(dim=DIM, maxsim="segmented", verbose=False)
+
+    scores = IndexPart(index_path, **kwargs).rank(Q, [3, 45, 85])
+
+    part = IndexPart(index_path, part_range=range(1, 2), **kwargs)
+    assert part.owns([40, 45, 60, 85]).tolist() == [False, True, True, False]
+    assert part.rank(Q, [45, 60]) == pytest.approx([scores[1], scores[1]])
+
+    part = IndexPart(index_path, part_range=range(0, 1), **kwargs)
+    assert part.rank(Q, [40]) == pytest.approx(scores[:1])
+
+    part = IndexPart(index_path, part_range=range(2, 3), **kwargs)
+    assert part.owns([60, 85]).tolist() == [False, True]
+    assert part.rank(Q, [85]) == pytest.approx(scores[2:])
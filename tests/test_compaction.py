@@ -0,0 +1,68 @@
+import os
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from xlmr_colbert.indexing.loaders import get_part_doclens_path
+from xlmr_colbert.indexing.index_manager import (
+    IndexManager,
+    save_doclens_arrays,
+    save_deleted,
+)
+from xlmr_colbert.indexing.compaction import compact_index, get_deleted_fraction
+from xlmr_colbert.ranking.index_part import IndexPart
+
+DIM = 16
+
+
+def make_index(directory, parts_doclens):
+    os.makedirs(directory)
+    indexmgr = IndexManager(DIM)
+
+    for part, doclens in enumerate(parts_doclens):
+        num_embeddings = sum(doclens)
+        embs = torch.nn.functional.normalize(torch.randn(num_embeddings, DIM), dim=-1)
+
+        indexmgr.save(embs.half(), os.path.join(directory, f"{part}.pt"))
+        indexmgr.save(
+            torch.randint(5, 1000, (num_embeddings,)),
+            os.path.join(directory, f"{part}.tokenids"),
+        )
+        indexmgr.save_doclens(doclens, get_part_doclens_path(directory, part))
+
+    save_doclens_arrays(directory)
+
+
+def ranking(index_path, Q, pids):
+    index = IndexPart(index_path, dim=DIM, maxsim="segmented", verbose=False)
+    scores = index.rank(Q, pids)
+
+    return [
+        (pid, round(score, 3))
+        for score, pid in sorted(zip(scores, pids), reverse=True)
+        if score != float("-inf")
+    ]
+
+
+def test_compaction_keeps_the_original_pids(tmp_path):
+    torch.manual_seed(0)
+
+    parts_doclens = [torch.randint(1, 20, (30,)).tolist() for _ in range(3)]
+    num_docs = sum(len(doclens) for doclens in parts_doclens)
+
+    index_path = str(tmp_path / "index")
+    output_path = str(tmp_path / "compacted")
+
+    make_index(index_path, parts_doclens)
+    save_deleted(index_path, [0, 5, 31, 32, 59, 60, 89], num_docs)
+
+    Q = torch.randn(1, DIM, 8)
+    pids = list(range(num_docs))
+
+    before = ranking(index_path, Q, pids)
+
+    compact_index(index_path, output_path, DIM)
+
+    assert ranking(output_path, Q, pids) == before
+    assert get_deleted_fraction(index_path) == (7, num_docs)
+    assert get_deleted_fraction(output_path) == (0, num_docs)
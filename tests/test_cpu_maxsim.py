@@ -0,0 +1,26 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from xlmr_colbert.ranking.index_ranker import IndexRanker
+
+
+def test_cpu_maxsim_keeps_the_thread_budget():
+    torch.manual_seed(0)
+
+    doclens = torch.randint(1, 300, (200,))
+    tensor = torch.randn(int(doclens.sum()) + 512, 16).half()
+    Q = torch.randn(1, 16, 8)
+    pids = torch.randperm(200)[:100].tolist()
+
+    num_threads = torch.get_num_threads()
+
+    segmented = IndexRanker(tensor, doclens, maxsim="segmented", device="cpu")
+    cpu = IndexRanker(tensor, doclens, maxsim="cpu", device="cpu", threads=4)
+
+    scores = cpu.rank(Q, pids)
+
+    assert torch.get_num_threads() == num_threads
+    assert torch.allclose(
+        torch.tensor(scores), torch.tensor(segmented.rank(Q, pids)), atol=1e-3
+    )
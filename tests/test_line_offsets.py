@@ -0,0 +1,30 @@
+import io
+import pytest
+
+pytest.importorskip("torch")
+
+from xlmr_colbert.indexing import index_manager
+from xlmr_colbert.indexing.loaders import load_line_offsets
+
+
+@pytest.mark.parametrize("blocksize", [1, 2, 3, 7, 1 << 20])
+def test_line_offsets_match_text_mode(tmp_path, monkeypatch, blocksize):
+    collection = tmp_path / "collection.tsv"
+    collection.write_bytes(
+        "0\tfirst\n1\tcarriage\rreturn\n2\twindows\r\n3\tdouble\r\r\n4\tlast\r".encode()
+    )
+
+    monkeypatch.setattr(index_manager, "LINE_OFFSETS_BLOCKSIZE", blocksize)
+    index_manager.save_line_offsets(str(collection), str(tmp_path))
+    offsets = load_line_offsets(str(tmp_path))
+
+    with open(collection) as f:
+        expected = list(f)
+
+    data = collection.read_bytes()
+    lines = [
+        io.TextIOWrapper(io.BytesIO(data[start:end])).read()
+        for start, end in zip(offsets[:-1], offsets[1:])
+    ]
+
+    assert lines == expected
@@ -0,0 +1,54 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("transformers")
+pytest.importorskip("sentencepiece")
+
+from xlmr_colbert.modeling.tokenization import (
+    QueryTokenizer,
+    DocTokenizer,
+    load_tokenizer,
+)
+
+TEXTS = [
+    "What is the capital of France?",
+    "Wie viele Einwohner hat München?",
+    "¿Dónde está la estación de tren más cercana?",
+    "Москва — столица России.",
+    "東京は日本の首都です。",
+    "서울은 한국의 수도입니다.",
+    "القاهرة هي عاصمة مصر",
+    "नई दिल्ली भारत की राजधानी है।",
+    "Ça coûte 12,50 € — naïve café, ﬁnal  spaces\tand tabs.",
+    "",
+]
+
+
+@pytest.fixture(scope="module", autouse=True)
+def tokenizers():
+    try:
+        load_tokenizer(False), load_tokenizer(True)
+    except OSError:
+        pytest.skip("The xlm-roberta-large tokenizer is not available.")
+
+
+def test_query_tokenizers_match():
+    slow = QueryTokenizer(32, fast=False).tensorize(TEXTS)
+    fast = QueryTokenizer(32, fast=True).tensorize(TEXTS)
+
+    assert all(torch.equal(a, b) for a, b in zip(slow, fast))
+
+
+@pytest.mark.parametrize("bsize", [None, 3])
+def test_doc_tokenizers_match(bsize):
+    slow = DocTokenizer(16, fast=False).tensorize(TEXTS, bsize=bsize)
+    fast = DocTokenizer(16, fast=True).tensorize(TEXTS, bsize=bsize)
+
+    if bsize is not None:
+        (slow, slow_indices), (fast, fast_indices) = slow, fast
+        assert torch.equal(slow_indices, fast_indices)
+
+        slow, fast = [torch.cat(b) for b in slow], [torch.cat(b) for b in fast]
+        assert len(slow) == len(fast)
+
+    assert all(torch.equal(a, b) for a, b in zip(slow, fast))
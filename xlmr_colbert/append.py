@@ -0,0 +1,106 @@
+import os
+import random
+import numpy as np
+
+from itertools import accumulate
+
+from xlmr_colbert.utils.runs import Run
+from xlmr_colbert.utils.parser import Arguments
+from xlmr_colbert.utils.utils import print_message
+from xlmr_colbert.indexing.encoder import CollectionEncoder
+from xlmr_colbert.indexing.faiss import get_faiss_index_name, append_faiss
+from xlmr_colbert.indexing.loaders import (
+    get_parts,
+    load_parts_num_docs,
+    DOCLENS_FILENAME,
+    DOCLENS_DTYPE,
+)
+from xlmr_colbert.indexing.index_manager import (
+    save_doclens_arrays,
+    save_contiguous_index,
+    EMBEDDINGS_METADATA_FILENAME,
+)
+
+
+def get_first_new_part(index_path):
+    """
+    The first part not yet covered by doclens.bin, which is only rewritten once an append (or
+    the initial indexing) is complete.
+    """
+
+    doclens_path = os.path.join(index_path, DOCLENS_FILENAME)
+    assert os.path.exists(doclens_path), f"No {doclens_path}, run convert_index first."
+
+    num_docs = os.path.getsize(doclens_path) // np.dtype(DOCLENS_DTYPE).itemsize
+
+    parts, _, _ = get_parts(index_path)
+    parts_doc_offsets = [0] + list(accumulate(load_parts_num_docs(index_path, parts)))
+
+    assert num_docs in parts_doc_offsets, (num_docs, parts_doc_offsets)
+
+    return parts_doc_offsets.index(num_docs), num_docs
+
+
+def main():
+    random.seed(12345)
+
+    parser = Arguments(description="Appending new passages to a ColBERT index.")
+
+    parser.add_model_parameters()
+    parser.add_model_inference_parameters()
+    parser.add_index_pruning_parameters()
+    parser.add_index_use_input()
+    parser.add_faiss_adding_parameters()
+
+    parser.add_argument("--collection", dest="collection", required=True)
+    parser.add_argument("--faiss_name", dest="faiss_name", default=None, type=str)
+    parser.add_argument(
+        "--chunksize", dest="chunksize", default=6.0, required=False, type=float
+    )  # in GiBs
+    parser.add_argument("--max_tokens", dest="max_tokens", default=None, type=int)
+    parser.add_argument(
+        "--prefetch", dest="prefetch", default=False, action="store_true"
+    )
+    parser.add_argument("--resume", dest="resume", default=False, action="store_true")
+
+    args = parser.parse()
+
+    assert args.nranks == 1, "Appending runs in a single process."
+
+    with Run.context():
+        args.index_path = os.path.join(args.index_root, args.index_name)
+        assert os.path.exists(args.index_path), args.index_path
+
+        if args.faiss_name is None and args.partitions is not None:
+            args.faiss_name = get_faiss_index_name(args)
+
+        part_offset, pid_offset = get_first_new_part(args.index_path)
+
+        print_message(
+            f"#> Appending {args.collection} as parts #{part_offset}.. "
+            f"(starting at pid {pid_offset}) of {args.index_path} .."
+        )
+
+        encoder = CollectionEncoder(
+            args,
+            process_idx=0,
+            num_processes=1,
+            part_offset=part_offset,
+            pid_offset=pid_offset,
+        )
+        encoder.encode()
+
+        if os.path.exists(os.path.join(args.index_path, EMBEDDINGS_METADATA_FILENAME)):
+            save_contiguous_index(args.index_path, args.dim, append=True)
+
+        if args.faiss_name is not None:
+            append_faiss(args, part_offset)
+        else:
+            Run.warn("No --faiss_name (or --partitions) given, not updating FAISS.")
+
+        # Last, as it marks the new parts as complete (see get_first_new_part).
+        save_doclens_arrays(args.index_path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""
+Compare the ranking quality, latency and resident size of a compressed index (see
+compress_index.py) against its float16 embeddings. Queries are noisy subsets of the tokens of
+random passages of the index, re-ranked against those passages plus random candidates.
+"""
+
+import os
+import time
+import random
+import torch
+
+from xlmr_colbert.utils.runs import Run
+from xlmr_colbert.utils.parser import Arguments
+from xlmr_colbert.utils.utils import print_message
+from xlmr_colbert.ranking.index_part import IndexPart
+from xlmr_colbert.ranking.index_ranker import MAXSIM_MODES
+
+
+def sample_queries(index, num_queries, query_maxlen, noise):
+    all_Q, sources = [], []
+
+    for _ in range(num_queries):
+        pid = random.randrange(index.doc_offset, index.doc_endpos)
+        offset = int(index.doclens_pfxsum[pid - index.doc_offset])
+        offset -= int(index.doclens_pfxsum[0])
+        doclen = int(index.doclens[pid - index.doc_offset])
+
+        if doclen == 0:  # a duplicate, see save_aliases()
+            continue
+
+        tokens = torch.randint(offset, offset + doclen, (query_maxlen,))
+        Q = index.tensor[tokens].float()
+        Q = torch.nn.functional.normalize(Q + noise * torch.randn_like(Q), p=2, dim=-1)
+
+        all_Q.append(Q.T.unsqueeze(0))
+        sources.append(pid)
+
+    return all_Q, sources
+
+
+def benchmark(index, all_Q, all_pids):
+    rankings, milliseconds = [], []
+
+    for Q, pids in zip(all_Q, all_pids):
+        s = time.time()
+        scores = torch.tensor(index.rank(Q, pids))
+        milliseconds.append((time.time() - s) * 1000.0)
+
+        rankings.append(torch.tensor(pids)[scores.sort(descending=True).indices])
+
+    return rankings, torch.tensor(milliseconds)
+
+
+def main():
+    random.seed(12345)
+    torch.manual_seed(12345)
+
+    parser = Arguments(description="Compare a compressed index against float16.")
+
+    parser.add_argument("--index_root", dest="index_root", required=True)
+    parser.add_argument("--index_name", dest="index_name", required=True)
+    parser.add_argument("--dim", dest="dim", default=128, type=int)
+    parser.add_argument("--part-range", dest="part_range", default="0..1", type=str)
+    parser.add_argument(
+        "--maxsim", dest="maxsim", default="cpu", choices=MAXSIM_MODES[1:]
+    )
+    parser.add_argument("--threads", dest="threads", default=None, type=int)
+    parser.add_argument("--query_maxlen", dest="query_maxlen", default=32, type=int)
+    parser.add_argument("--num_queries", dest="num_queries", default=100, type=int)
+    parser.add_argument("--depth", dest="depth", default=1000, type=int)
+    parser.add_argument("--noise", dest="noise", default=0.05, type=float)
+    parser.add_argument("--k", dest="k", default=10, type=int)
+
+    args = parser.parse()
+
+    part_offset, part_endpos = map(int, args.part_range.split(".."))
+    args.index_path = os.path.join(args.index_root, args.index_name)
+
+    with Run.context():
+        indexes = {
+            compressed: IndexPart(
+                args.index_path,
+                dim=args.dim,
+                part_range=range(part_offset, part_endpos),
+                maxsim=args.maxsim,
+                maxsim_threads=args.threads,
+                compressed=compressed,
+            )
+            for compressed in [False, True]
+        }
+
+        all_Q, sources = sample_queries(
+            indexes[False], args.num_queries, args.query_maxlen, args.noise
+        )
+        pids_range = indexes[False].pids_range
+        depth = min(args.depth, len(pids_range))
+        all_pids = [
+            list(dict.fromkeys([pid] + random.sample(pids_range, depth)))
+            for pid in sources
+        ]
+
+        results = {
+            compressed: benchmark(index, all_Q, all_pids)
+            for compressed, index in indexes.items()
+        }
+
+        nbytes = {
+            False: indexes[False].num_embeddings * args.dim * 2,
+            True: indexes[True].tensor.nbytes,
+        }
+
+        for compressed, (rankings, milliseconds) in results.items():
+            success = sum(
+                pid in ranking[: args.k].tolist()
+                for pid, ranking in zip(sources, rankings)
+            )
+
+            print_message(
+                f"#> [{'compressed' if compressed else 'float16'}] "
+                f"{round(nbytes[compressed] / 2**20, 1)} MiB of embeddings, "
+                f"Success@{args.k} = {round(success / len(sources), 3)}, "
+                f"mean = {round(milliseconds.mean().item(), 2)}ms, "
+                f"p50 = {round(milliseconds.quantile(0.5).item(), 2)}ms"
+            )
+
+        overlap = [
+            len(set(a[: args.k].tolist()) & set(b[: args.k].tolist())) / args.k
+            for a, b in zip(results[False][0], results[True][0])
+        ]
+        print_message(
+            f"#> Top-{args.k} overlap with float16 = "
+            f"{round(sum(overlap) / len(overlap), 3)}, "
+            f"{round(nbytes[False] / nbytes[True], 1)}x smaller"
+        )
+
+
+if __name__ == "__main__":
+    main()
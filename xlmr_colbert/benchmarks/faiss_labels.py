@@ -0,0 +1,107 @@
+"""
+Compare FAISS indexes labelled with embedding ordinals (+ emb2pid) against pid-labelled ones
+(built with index_faiss --pid_labels): startup time, emb2pid memory and per-query latency.
+"""
+
+import os
+import time
+import random
+import torch
+
+from xlmr_colbert.utils.runs import Run
+from xlmr_colbert.utils.parser import Arguments
+from xlmr_colbert.utils.utils import print_message
+from xlmr_colbert.evaluation.loaders import load_colbert, load_queries
+from xlmr_colbert.modeling.inference import ModelInference
+from xlmr_colbert.indexing.faiss import get_faiss_index_name
+from xlmr_colbert.ranking.faiss_index import FaissIndex
+
+
+def benchmark(args, faiss_index_path, all_Q):
+    s = time.time()
+    faiss_index = FaissIndex(args.index_path, faiss_index_path, args.nprobe)
+    startup = time.time() - s
+
+    emb2pid = faiss_index.emb2pid
+    emb2pid_bytes = 0 if emb2pid is None else emb2pid.numel() * emb2pid.element_size()
+
+    latencies, rankings = [], []
+
+    for Q in all_Q:
+        s = time.time()
+        pids = faiss_index.retrieve(args.faiss_depth, Q)[0]
+        latencies.append((time.time() - s) * 1000.0)
+        rankings.append(set(pids))
+
+    return startup, emb2pid_bytes, latencies, rankings
+
+
+def report(name, startup, emb2pid_bytes, latencies):
+    latencies = torch.tensor(latencies)
+
+    print_message(
+        f"#> [{name}] startup = {round(startup, 2)}s \t"
+        f"emb2pid = {round(emb2pid_bytes / 1024**2, 1)} MiB \t"
+        f"latency: mean = {round(latencies.mean().item(), 2)}ms, "
+        f"p50 = {round(latencies.quantile(0.5).item(), 2)}ms, "
+        f"p99 = {round(latencies.quantile(0.99).item(), 2)}ms"
+    )
+
+
+def main():
+    random.seed(12345)
+
+    parser = Arguments(description="Benchmark pid-labelled FAISS indexes.")
+
+    parser.add_model_parameters()
+    parser.add_model_inference_parameters()
+    parser.add_ranking_input()
+    parser.add_retrieval_input()
+
+    parser.add_argument("--faiss_name", dest="faiss_name", default=None, type=str)
+    parser.add_argument("--pids_faiss_name", dest="pids_faiss_name", default=None)
+    parser.add_argument("--faiss_depth", dest="faiss_depth", default=1024, type=int)
+    parser.add_argument("--num_queries", dest="num_queries", default=1000, type=int)
+
+    args = parser.parse()
+
+    with Run.context():
+        args.colbert, args.checkpoint = load_colbert(args)
+        args.queries = load_queries(args.queries)
+        args.index_path = os.path.join(args.index_root, args.index_name)
+
+        args.pid_labels = False
+        args.faiss_name = args.faiss_name or get_faiss_index_name(args)
+
+        args.pid_labels = True
+        args.pids_faiss_name = args.pids_faiss_name or get_faiss_index_name(args)
+
+        inference = ModelInference(args.colbert, amp=args.amp)
+        queries = list(args.queries.values())[: args.num_queries]
+
+        print_message(f"#> Encoding {len(queries)} queries..")
+        all_Q = [inference.queryFromText([q]).cpu() for q in queries]
+
+        results = {}
+        for name in [args.faiss_name, args.pids_faiss_name]:
+            faiss_index_path = os.path.join(args.index_path, name)
+            results[name] = benchmark(args, faiss_index_path, all_Q)
+
+        for name, (startup, emb2pid_bytes, latencies, _) in results.items():
+            report(name, startup, emb2pid_bytes, latencies)
+
+        rankings, pids_rankings = (
+            results[args.faiss_name][-1],
+            results[args.pids_faiss_name][-1],
+        )
+        overlap = [
+            len(a & b) / max(1, len(a | b)) for a, b in zip(rankings, pids_rankings)
+        ]
+        print_message(
+            f"#> Mean Jaccard overlap of the candidate sets = "
+            f"{round(sum(overlap) / max(1, len(overlap)), 3)}"
+        )
+
+
+if __name__ == "__main__":
+    main()
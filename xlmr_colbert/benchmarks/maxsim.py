@@ -0,0 +1,94 @@
+"""
+Time IndexRanker's MaxSim paths on CPU, over synthetic passages and queries.
+"""
+
+import time
+import random
+import torch
+
+from xlmr_colbert.utils.runs import Run
+from xlmr_colbert.utils.parser import Arguments
+from xlmr_colbert.utils.utils import print_message
+from xlmr_colbert.ranking.index_ranker import IndexRanker, MAXSIM_MODES
+
+
+def synthetic_index(num_docs, doc_maxlen, dim):
+    doclens = torch.normal(0.6 * doc_maxlen, 0.3 * doc_maxlen, (num_docs,))
+    doclens = doclens.round().clamp(1, doc_maxlen).int()
+
+    tensor = torch.randn(doclens.sum().item() + 512, dim)
+    tensor = torch.nn.functional.normalize(tensor, p=2, dim=-1).half()
+
+    return tensor, doclens
+
+
+def benchmark(ranker, all_Q, all_pids):
+    scores, milliseconds = [], []
+
+    for Q, pids in zip(all_Q, all_pids):
+        s = time.time()
+        scores.append(torch.tensor(ranker.rank(Q, pids)))
+        milliseconds.append((time.time() - s) * 1000.0)
+
+    return scores, torch.tensor(milliseconds)
+
+
+def main():
+    random.seed(12345)
+    torch.manual_seed(12345)
+
+    parser = Arguments(description="Benchmark MaxSim scoring on CPU.")
+
+    parser.add_argument("--dim", dest="dim", default=128, type=int)
+    parser.add_argument("--query_maxlen", dest="query_maxlen", default=32, type=int)
+    parser.add_argument("--doc_maxlen", dest="doc_maxlen", default=180, type=int)
+    parser.add_argument("--num_docs", dest="num_docs", default=100_000, type=int)
+    parser.add_argument("--num_queries", dest="num_queries", default=20, type=int)
+    parser.add_argument("--depth", dest="depth", default=1000, type=int)
+    parser.add_argument("--threads", dest="threads", default=None, type=int)
+
+    args = parser.parse()
+
+    with Run.context():
+        if args.threads is not None:
+            torch.set_num_threads(args.threads)
+
+        print_message(f"#> Using {torch.get_num_threads()} threads.")
+
+        tensor, doclens = synthetic_index(args.num_docs, args.doc_maxlen, args.dim)
+        print_message(
+            f"#> {args.num_docs} passages, {tensor.size(0) - 512} embeddings, "
+            f"mean doclen = {round(doclens.float().mean().item(), 1)}"
+        )
+
+        all_Q = torch.randn(args.num_queries, args.dim, args.query_maxlen)
+        all_Q = torch.nn.functional.normalize(all_Q, p=2, dim=1).unsqueeze(1)
+        all_pids = [
+            torch.randperm(args.num_docs)[: args.depth].tolist()
+            for _ in range(args.num_queries)
+        ]
+
+        results = {}
+        for maxsim in MAXSIM_MODES:
+            ranker = IndexRanker(
+                tensor, doclens, maxsim=maxsim, device="cpu", threads=args.threads
+            )
+            results[maxsim] = benchmark(ranker, all_Q, all_pids)
+
+            milliseconds = results[maxsim][1]
+            print_message(
+                f"#> [{maxsim}] {args.depth} passages per query: "
+                f"mean = {round(milliseconds.mean().item(), 2)}ms, "
+                f"p50 = {round(milliseconds.quantile(0.5).item(), 2)}ms"
+            )
+
+        baseline, _ = results[MAXSIM_MODES[0]]
+        for maxsim, (scores, _) in results.items():
+            delta = max((a - b).abs().max().item() for a, b in zip(scores, baseline))
+            print_message(
+                f"#> [{maxsim}] max |score - {MAXSIM_MODES[0]} score| = {delta}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""
+Compare the sentencepiece and fast XLM-R tokenizers: load time, tokens/sec of the Doc/Query
+tokenizers, and whether both produce exactly the same ids and masks on the given passages.
+"""
+
+import time
+import random
+import torch
+
+from xlmr_colbert.utils.runs import Run
+from xlmr_colbert.utils.parser import Arguments
+from xlmr_colbert.utils.utils import print_message, batch
+from xlmr_colbert.modeling.tokenization import (
+    QueryTokenizer,
+    DocTokenizer,
+    load_tokenizer,
+)
+
+
+def load_passages(path, num_passages):
+    passages = []
+
+    with open(path) as f:
+        for line_idx, line in enumerate(f):
+            if line_idx == num_passages:
+                break
+
+            pid, passage, *other = line.strip().split("\t")
+
+            if len(other) >= 1:
+                title, *_ = other
+                passage = title + " | " + passage
+
+            passages.append(passage)
+
+    return passages
+
+
+def benchmark(tokenizer, texts, bsize):
+    outputs, num_tokens = [], 0
+
+    s = time.time()
+
+    for texts_batch in batch(texts, bsize):
+        ids, mask = tokenizer.tensorize(texts_batch)
+        outputs.append((ids, mask))
+        num_tokens += mask.sum().item()
+
+    return outputs, num_tokens / (time.time() - s)
+
+
+def main():
+    random.seed(12345)
+
+    parser = Arguments(description="Benchmark the XLM-R tokenizer backends.")
+
+    parser.add_model_parameters()
+    parser.add_argument("--collection", dest="collection", required=True)
+    parser.add_argument("--queries", dest="queries", default=None)
+    parser.add_argument(
+        "--num_passages", dest="num_passages", default=100_000, type=int
+    )
+    parser.add_argument("--bsize", dest="bsize", default=256, type=int)
+
+    args = parser.parse()
+
+    with Run.context():
+        passages = load_passages(args.collection, args.num_passages)
+        queries = passages if args.queries is None else load_passages(args.queries, -1)
+
+        print_message(f"#> Loaded {len(passages)} passages and {len(queries)} queries.")
+
+        results = {}
+
+        for fast in [False, True]:
+            name = "fast" if fast else "sentencepiece"
+
+            s = time.time()
+            load_tokenizer(fast)
+            startup = time.time() - s
+
+            doc_tokenizer = DocTokenizer(args.doc_maxlen, fast=fast)
+            query_tokenizer = QueryTokenizer(args.query_maxlen, fast=fast)
+
+            D, doc_throughput = benchmark(doc_tokenizer, passages, args.bsize)
+            Q, query_throughput = benchmark(query_tokenizer, queries, args.bsize)
+
+            print_message(
+                f"#> [{name}] startup = {round(startup, 2)}s \t"
+                f"DocTokenizer = {int(doc_throughput)} tokens/sec \t"
+                f"QueryTokenizer = {int(query_throughput)} tokens/sec"
+            )
+
+            results[fast] = D + Q
+
+        mismatches = sum(
+            not (torch.equal(ids_a, ids_b) and torch.equal(mask_a, mask_b))
+            for (ids_a, mask_a), (ids_b, mask_b) in zip(results[False], results[True])
+        )
+
+        print_message(
+            f"#> {mismatches} of {len(results[False])} batches differ between backends."
+        )
+
+        assert mismatches == 0
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+import os
+import random
+
+from xlmr_colbert.utils.runs import Run
+from xlmr_colbert.utils.parser import Arguments
+from xlmr_colbert.utils.utils import print_message
+from xlmr_colbert.indexing.compaction import get_deleted_fraction, compact_index
+
+
+def main():
+    random.seed(12345)
+
+    parser = Arguments(
+        description="Rewriting a ColBERT index (and its FAISS index) without the embeddings of its deleted passages."
+    )
+
+    parser.add_argument("--index_root", dest="index_root", required=True)
+    parser.add_argument("--index_name", dest="index_name", required=True)
+    parser.add_argument("--output_name", dest="output_name", required=True)
+    parser.add_argument("--dim", dest="dim", default=128, type=int)
+    parser.add_argument("--faiss_name", dest="faiss_names", default=[], action="append")
+    parser.add_argument("--threshold", dest="threshold", default=0.1, type=float)
+
+    args = parser.parse()
+
+    with Run.context():
+        args.index_path = os.path.join(args.index_root, args.index_name)
+        args.output_path = os.path.join(args.index_root, args.output_name)
+        assert os.path.exists(args.index_path), args.index_path
+
+        num_deleted, num_docs = get_deleted_fraction(args.index_path)
+        fraction = num_deleted / num_docs
+
+        print_message(
+            f"#> {num_deleted} of {num_docs} passages ({round(fraction * 100.0, 2)}%) "
+            f"of {args.index_path} are deleted but still have embeddings."
+        )
+
+        if num_deleted == 0 or fraction < args.threshold:
+            print_message(f"#> Below --threshold {args.threshold}, not compacting.")
+            return
+
+        compact_index(args.index_path, args.output_path, args.dim, args.faiss_names)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+import os
+import faiss
+import random
+
+from xlmr_colbert.utils.runs import Run
+from xlmr_colbert.utils.parser import Arguments
+from xlmr_colbert.utils.utils import print_message
+from xlmr_colbert.indexing.loaders import get_parts
+from xlmr_colbert.indexing.faiss import get_faiss_index_name, load_sample
+from xlmr_colbert.indexing.index_manager import IndexManager, load_index_part
+from xlmr_colbert.indexing.residual import (
+    ResidualCodec,
+    get_codes_path,
+    get_residuals_path,
+    RESIDUAL_CODEC_FILENAME,
+)
+
+
+def load_centroids(faiss_index_path):
+    index = faiss.read_index(faiss_index_path, faiss.IO_FLAG_ONDISK_SAME_DIR)
+    ivf = faiss.try_extract_index_ivf(index)
+    assert ivf is not None, f"{faiss_index_path} is not an IVF index."
+
+    quantizer = ivf.quantizer
+    centroids = quantizer.reconstruct_n(0, quantizer.ntotal)
+
+    # e.g., with OPQ, the centroids live in the rotated space: rotate them back, which keeps the
+    # nearest centroid of every embedding. Other transforms (e.g., PCA) have no such inverse.
+    if isinstance(index, faiss.IndexPreTransform):
+        for i in reversed(range(index.chain.size())):
+            transform = faiss.downcast_VectorTransform(index.chain.at(i))
+
+            assert (
+                isinstance(transform, faiss.LinearTransform)
+                and transform.is_orthonormal
+                and transform.d_in == transform.d_out
+            ), (
+                f"{faiss_index_path} transforms the embeddings with "
+                f"{type(transform).__name__}, and only rotations (e.g., OPQ) can be undone: "
+                "use an index without it, or one with OPQ only."
+            )
+
+            centroids = transform.reverse_transform(centroids)
+
+    return centroids
+
+
+def main():
+    random.seed(12345)
+
+    parser = Arguments(
+        description="Compressing a ColBERT index to centroid ids and quantized residuals."
+    )
+
+    parser.add_index_use_input()
+
+    parser.add_argument("--faiss_name", dest="faiss_name", default=None, type=str)
+    parser.add_argument("--nbits", dest="nbits", default=2, choices=[1, 2], type=int)
+    parser.add_argument("--sample", dest="sample", default=None, type=float)
+
+    args = parser.parse()
+
+    with Run.context():
+        args.index_path = os.path.join(args.index_root, args.index_name)
+        assert os.path.exists(args.index_path), args.index_path
+
+        parts, parts_paths, samples_paths = get_parts(args.index_path)
+
+        # After append.py, only the new parts are compressed, with the same codec.
+        if os.path.exists(os.path.join(args.index_path, RESIDUAL_CODEC_FILENAME)):
+            codec = ResidualCodec.load(args.index_path)
+            print_message(f"#> Reusing the codec of {args.index_path} ..")
+        else:
+            faiss_name = args.faiss_name or get_faiss_index_name(args)
+            centroids = load_centroids(os.path.join(args.index_path, faiss_name))
+
+            print_message(f"#> Training a {args.nbits}-bit codec on {faiss_name} ..")
+
+            sample = load_sample(samples_paths, sample_fraction=args.sample)
+            codec = ResidualCodec.train(centroids, sample, args.nbits)
+            codec.save(args.index_path)
+
+        indexmgr = IndexManager(codec.dim)
+
+        for part, part_path in zip(parts, parts_paths):
+            codes_path = get_codes_path(args.index_path, part)
+            residuals_path = get_residuals_path(args.index_path, part)
+
+            if os.path.exists(residuals_path):
+                continue
+
+            embs = load_index_part(part_path)
+            codes, residuals = codec.compress(embs)
+
+            indexmgr.save(codes, codes_path)
+            indexmgr.save(residuals, residuals_path)
+
+            print_message(
+                f"#> Compressed part #{part}: {embs.numel() * embs.element_size()} bytes "
+                f"to {codes.numel() * 4 + residuals.numel()} bytes."
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,37 @@
+import os
+import random
+
+from xlmr_colbert.utils.runs import Run
+from xlmr_colbert.utils.parser import Arguments
+from xlmr_colbert.utils.utils import print_message
+from xlmr_colbert.indexing.index_manager import (
+    save_doclens_arrays,
+    save_contiguous_index,
+)
+
+
+def main():
+    random.seed(12345)
+
+    parser = Arguments(
+        description="Convert an existing ColBERT index to the memory-mappable layout."
+    )
+
+    parser.add_argument("--index_root", dest="index_root", required=True)
+    parser.add_argument("--index_name", dest="index_name", required=True)
+    parser.add_argument("--dim", dest="dim", default=128, type=int)
+
+    args = parser.parse()
+
+    with Run.context():
+        args.index_path = os.path.join(args.index_root, args.index_name)
+        assert os.path.exists(args.index_path), args.index_path
+
+        print_message(f"#> Converting {args.index_path} ..")
+
+        save_doclens_arrays(args.index_path)
+        save_contiguous_index(args.index_path, args.dim)
+
+
+if __name__ == "__main__":
+    main()
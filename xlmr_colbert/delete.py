@@ -0,0 +1,57 @@
+import os
+import random
+
+from xlmr_colbert.utils.runs import Run
+from xlmr_colbert.utils.parser import Arguments
+from xlmr_colbert.utils.utils import print_message
+from xlmr_colbert.indexing.loaders import load_doclens_arrays
+from xlmr_colbert.indexing.index_manager import save_deleted
+
+
+def load_pids(path):
+    """
+    One pid per line; any further (tab-separated) columns, like passages, are ignored.
+    """
+
+    with open(path) as f:
+        return [int(line.split("\t")[0]) for line in f if line.strip()]
+
+
+def main():
+    random.seed(12345)
+
+    parser = Arguments(description="Deleting passages from a ColBERT index.")
+
+    parser.add_argument("--index_root", dest="index_root", required=True)
+    parser.add_argument("--index_name", dest="index_name", required=True)
+    parser.add_argument("--pids", dest="pids", required=True)
+    parser.add_argument(
+        "--undelete", dest="undelete", default=False, action="store_true"
+    )
+
+    args = parser.parse()
+
+    with Run.context():
+        args.index_path = os.path.join(args.index_root, args.index_name)
+        assert os.path.exists(args.index_path), args.index_path
+
+        doclens, _, _ = load_doclens_arrays(args.index_path)
+        pids = load_pids(args.pids)
+
+        print_message(
+            f"#> {'Undeleting' if args.undelete else 'Deleting'} {len(pids)} pids "
+            f"of {args.index_path} .."
+        )
+
+        num_deleted = save_deleted(
+            args.index_path, pids, len(doclens), deleted=not args.undelete
+        )
+
+        print_message(
+            f"#> {num_deleted} of {len(doclens)} passages "
+            f"({round(num_deleted / len(doclens) * 100.0, 2)}%) are now deleted."
+        )
+
+
+if __name__ == "__main__":
+    main()
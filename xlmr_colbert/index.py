@@ -8,6 +8,12 @@ import xlmr_colbert.utils.distributed as distributed
 
 from xlmr_colbert.utils.utils import print_message, create_directory
 from xlmr_colbert.indexing.encoder import CollectionEncoder
+from xlmr_colbert.indexing.index_manager import (
+    save_doclens_arrays,
+    save_contiguous_index,
+    save_line_offsets,
+)
+from xlmr_colbert.indexing.dedup import save_aliases
 
 
 def main():
@@ -19,17 +25,24 @@ def main():
 
     parser.add_model_parameters()
     parser.add_model_inference_parameters()
+    parser.add_index_pruning_parameters()
     parser.add_indexing_input()
 
     parser.add_argument(
         "--chunksize", dest="chunksize", default=6.0, required=False, type=float
     )  # in GiBs
+    parser.add_argument("--max_tokens", dest="max_tokens", default=None, type=int)
+    parser.add_argument(
+        "--prefetch", dest="prefetch", default=False, action="store_true"
+    )
+    parser.add_argument("--resume", dest="resume", default=False, action="store_true")
+    parser.add_argument("--dedup", dest="dedup", default=False, action="store_true")
 
     args = parser.parse()
 
     with Run.context():
         args.index_path = os.path.join(args.index_root, args.index_name)
-        assert not os.path.exists(args.index_path), args.index_path
+        assert args.resume or not os.path.exists(args.index_path), args.index_path
 
         distributed.barrier(args.rank)
 
@@ -37,6 +50,14 @@ def main():
             create_directory(args.index_root)
             create_directory(args.index_path)
 
+            # Let every process seek to its own passages rather than read all of them.
+            if args.nranks > 1:
+                save_line_offsets(args.collection, args.index_path)
+
+            # Encode each distinct passage text only once.
+            if args.dedup:
+                save_aliases(args.collection, args.index_path)
+
         distributed.barrier(args.rank)
 
         process_idx = max(0, args.rank)
@@ -47,6 +68,11 @@ def main():
 
         distributed.barrier(args.rank)
 
+        # Merge the parts into single, memory-mappable doclens and embeddings files.
+        if args.rank < 1:
+            save_doclens_arrays(args.index_path)
+            save_contiguous_index(args.index_path, args.dim)
+
         # Save metadata.
         if args.rank < 1:
             metadata_path = os.path.join(args.index_path, "metadata.json")
@@ -61,5 +87,3 @@ def main():
 
 if __name__ == "__main__":
     main()
-
-# TODO: Add resume functionality
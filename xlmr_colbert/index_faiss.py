@@ -1,11 +1,19 @@
 import os
 import random
-import math
 
 from xlmr_colbert.utils.runs import Run
 from xlmr_colbert.utils.parser import Arguments
-from xlmr_colbert.indexing.faiss import index_faiss
-from xlmr_colbert.indexing.loaders import load_doclens
+from xlmr_colbert.indexing.faiss import (
+    index_faiss,
+    get_default_partitions,
+    DEFAULT_SAMPLES_PER_PARTITION,
+)
+from xlmr_colbert.indexing.faiss_index import (
+    FAISS_FACTORIES,
+    KMEANS_MODES,
+    is_ivf_factory,
+)
+from xlmr_colbert.indexing.loaders import load_doclens_arrays
 
 
 def main():
@@ -15,23 +23,48 @@ def main():
         description="Faiss indexing for end-to-end retrieval with ColBERT."
     )
     parser.add_index_use_input()
+    parser.add_faiss_adding_parameters()
 
     parser.add_argument("--sample", dest="sample", default=None, type=float)
+    parser.add_argument("--num_samples", dest="num_samples", default=None, type=int)
+    parser.add_argument(
+        "--samples_per_partition", dest="samples_per_partition", default=None, type=int
+    )
     parser.add_argument("--slices", dest="slices", default=1, type=int)
+    parser.add_argument(
+        "--slice_workers", dest="slice_workers", default=1, type=int
+    )  # slices built concurrently
+    parser.add_argument("--faiss_params", dest="faiss_params", default="", type=str)
+    parser.add_argument(
+        "--kmeans", dest="kmeans", default="auto", choices=KMEANS_MODES
+    )  # how to train the coarse quantizer, see FaissIndex.train
+    parser.add_argument(
+        "--ondisk", dest="ondisk", default=False, action="store_true"
+    )  # write the inverted lists to a memory-mapped .ivfdata file
 
     args = parser.parse()
     assert args.slices >= 1
+    assert args.slice_workers >= 1
     assert args.sample is None or (0.0 < args.sample < 1.0), args.sample
+    assert not args.ondisk or is_ivf_factory(args.faiss_factory), (
+        f"--ondisk needs an IVF index, but --faiss_factory {args.faiss_factory} has no "
+        "inverted lists to store on disk."
+    )
 
     with Run.context():
         args.index_path = os.path.join(args.index_root, args.index_name)
         assert os.path.exists(args.index_path), args.index_path
 
-        num_embeddings = sum(load_doclens(args.index_path))
+        _, doclens_pfxsum, _ = load_doclens_arrays(args.index_path)
+        num_embeddings = int(doclens_pfxsum[-1])
         print("#> num_embeddings =", num_embeddings)
 
-        if args.partitions is None:
-            args.partitions = 1 << math.ceil(math.log2(8 * math.sqrt(num_embeddings)))
+        uses_partitions = "{partitions}" in FAISS_FACTORIES.get(
+            args.faiss_factory, args.faiss_factory
+        )
+
+        if args.partitions is None and uses_partitions:
+            args.partitions = get_default_partitions(num_embeddings)
             print("\n\n")
             Run.warn("You did not specify --partitions!")
             Run.warn(
@@ -41,6 +74,16 @@ def main():
             )
             print("\n\n")
 
+        if args.partitions is not None and all(
+            x is None
+            for x in [args.sample, args.num_samples, args.samples_per_partition]
+        ):
+            Run.warn(
+                "No training sample size given, defaulting to",
+                DEFAULT_SAMPLES_PER_PARTITION,
+                "embeddings per partition.",
+            )
+
         index_faiss(args)
 
 
@@ -0,0 +1,139 @@
+import os
+import shutil
+import torch
+import numpy as np
+
+from xlmr_colbert.utils.utils import print_message, create_directory
+from xlmr_colbert.indexing.loaders import (
+    get_parts,
+    get_part_doclens_path,
+    load_part_doclens,
+    load_doclens_arrays,
+    load_deleted,
+    load_aliases,
+    DELETED_FILENAME,
+    ALIASES_FILENAME,
+)
+from xlmr_colbert.indexing.index_manager import (
+    IndexManager,
+    load_index_part,
+    save_doclens_arrays,
+    save_contiguous_index,
+    get_emb2pid_path,
+    save_emb2pid,
+    EMBEDDINGS_METADATA_FILENAME,
+)
+from xlmr_colbert.indexing.faiss_index import load_faiss_index
+from xlmr_colbert.indexing.faiss import add_parts
+
+
+def get_deleted_fraction(directory):
+    """
+    The number of deleted passages whose embeddings are still stored (i.e., that compaction
+    would drop), and the number of passages.
+    """
+
+    doclens, _, _ = load_doclens_arrays(directory)
+    deleted = load_deleted(directory, len(doclens))
+
+    if deleted is None:
+        return 0, len(doclens)
+
+    return int((deleted & (torch.from_numpy(np.asarray(doclens)) > 0)).sum()), len(
+        doclens
+    )
+
+
+def compact_index(index_path, output_path, dim, faiss_names=()):
+    """
+    Rewrite the parts of `index_path` into `output_path` without the embeddings of its deleted
+    passages. Pids stay as they are: deleted passages keep their pid, with a doclen of zero, and
+    stay marked as deleted. The FAISS indexes in `faiss_names` keep their trained quantizer and
+    codebooks, and are only repopulated.
+    """
+
+    parts, parts_paths, _ = get_parts(index_path)
+    doclens, _, parts_doc_offsets = load_doclens_arrays(index_path)
+    deleted = load_deleted(index_path, len(doclens))
+
+    assert deleted is not None, f"Nothing was deleted from {index_path}."
+
+    aliases = load_aliases(index_path)
+    if aliases is not None:
+        aliases = aliases[torch.arange(len(doclens))]
+
+    assert aliases is None or not (~deleted & deleted[aliases]).any(), (
+        "Some live duplicates alias deleted passages: delete them too, "
+        "or undelete their canonical passages."
+    )
+    assert not os.path.exists(output_path), output_path
+
+    create_directory(output_path)
+    indexmgr = IndexManager(dim)
+
+    for part in parts:
+        pid_offset, pid_endpos = parts_doc_offsets[part], parts_doc_offsets[part + 1]
+        part_doclens = torch.from_numpy(load_part_doclens(index_path, part)).long()
+        alive = ~deleted[pid_offset:pid_endpos]
+
+        assert len(part_doclens) == pid_endpos - pid_offset
+
+        keep = torch.repeat_interleave(alive, part_doclens)
+        embs = load_index_part(parts_paths[part])[keep]
+        ids = load_index_part(os.path.join(index_path, f"{part}.tokenids"))[keep]
+
+        print_message(
+            f"#> Part #{part}: keeping the embeddings of {int(alive.sum())} "
+            f"of {len(alive)} passages."
+        )
+
+        indexmgr.save(embs, os.path.join(output_path, f"{part}.pt"))
+        indexmgr.save(ids, os.path.join(output_path, f"{part}.tokenids"))
+        indexmgr.save(
+            embs[torch.randperm(embs.size(0))[: embs.size(0) // 20]],
+            os.path.join(output_path, f"{part}.sample"),
+        )
+        indexmgr.save_doclens(
+            (part_doclens * alive).tolist(), get_part_doclens_path(output_path, part)
+        )
+
+    for filename in ["metadata.json", DELETED_FILENAME, ALIASES_FILENAME]:
+        if os.path.exists(os.path.join(index_path, filename)):
+            shutil.copy(os.path.join(index_path, filename), output_path)
+
+    save_doclens_arrays(output_path)
+
+    if os.path.exists(os.path.join(index_path, EMBEDDINGS_METADATA_FILENAME)):
+        save_contiguous_index(output_path, dim)
+
+    for faiss_name in faiss_names:
+        compact_faiss(output_path, os.path.join(index_path, faiss_name), faiss_name)
+
+    print_message(
+        f"#> Dropped the embeddings of {int(deleted.sum())} of {len(doclens)} passages."
+    )
+
+
+def compact_faiss(output_path, faiss_index_path, faiss_name):
+    """
+    Re-add the (compacted) parts of `output_path` to a copy of the trained, unsliced index at
+    `faiss_index_path`, emptied first.
+    """
+
+    parts, _, _ = get_parts(output_path)
+    doclens, doclens_pfxsum, parts_doc_offsets = load_doclens_arrays(output_path)
+
+    index = load_faiss_index(faiss_index_path)
+
+    print_message(f"#> Repopulating {faiss_index_path} ({index.offset} embeddings) ..")
+
+    index.index.reset()
+    index.offset = 0
+
+    add_parts(index, output_path, parts, doclens, doclens_pfxsum, parts_doc_offsets)
+
+    output_faiss_path = os.path.join(output_path, faiss_name)
+    index.save(output_faiss_path)
+
+    if not index.pid_labels:
+        save_emb2pid(get_emb2pid_path(output_faiss_path), doclens)
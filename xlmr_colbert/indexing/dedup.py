@@ -0,0 +1,77 @@
+import os
+import hashlib
+import unicodedata
+import numpy as np
+
+from xlmr_colbert.utils.utils import print_message
+from xlmr_colbert.indexing.loaders import ALIASES_FILENAME
+
+DIGEST_SIZE = 16
+
+
+def get_passage_text(line):
+    """
+    The pid and the text to encode (with its title, if any) of a line of the collection.
+    """
+
+    pid, passage, *other = line.strip().split("\t")
+
+    if len(other) >= 1:
+        title, *_ = other
+        passage = title + " | " + passage
+
+    return pid, passage
+
+
+def normalize_passage(passage):
+    # The tokenizer applies NFKC itself, and whitespace only separates words.
+    return " ".join(unicodedata.normalize("NFKC", passage).split())
+
+
+def hash_passage(passage):
+    return hashlib.blake2b(
+        normalize_passage(passage).encode(), digest_size=DIGEST_SIZE
+    ).digest()
+
+
+def save_aliases(collection_path, directory):
+    """
+    Hash the normalized text of every passage of the collection, and map each pid to the
+    first pid with the same hash (see load_aliases()).
+    """
+
+    print_message(f"#> Hashing the passages of {collection_path} ..")
+
+    digests, num_bytes = [], []
+
+    with open(collection_path) as f:
+        for line in f:
+            _, passage = get_passage_text(line)
+
+            digests.append(hash_passage(passage))
+            num_bytes.append(len(passage))
+
+    digests = np.frombuffer(b"".join(digests), dtype=np.uint64).reshape(-1, 2)
+    num_bytes = np.array(num_bytes, dtype=np.int64)
+
+    _, first, inverse = np.unique(
+        digests, axis=0, return_index=True, return_inverse=True
+    )
+    aliases = first[inverse.reshape(-1)].astype(np.int64)
+
+    path = os.path.join(directory, ALIASES_FILENAME)
+
+    with open(path + ".tmp", "wb") as f:
+        np.save(f, aliases)
+
+    os.replace(path + ".tmp", path)
+
+    duplicates = aliases != np.arange(len(aliases))
+
+    print_message(
+        f"#> Found {duplicates.sum()} duplicates among {len(aliases)} passages "
+        f"({num_bytes[duplicates].sum()} of {num_bytes.sum()} characters), "
+        f"which will not be encoded."
+    )
+
+    return aliases
@@ -1,3 +1,4 @@
+import io
 import os
 import time
 import torch
@@ -8,19 +9,39 @@ import itertools
 import threading
 import queue
 
+from xlmr_colbert.parameters import DEVICE
 from xlmr_colbert.modeling.inference import ModelInference
+from xlmr_colbert.modeling.tokenization import DocTokenizer
+from xlmr_colbert.modeling.pruning import build_pruner
 from xlmr_colbert.evaluation.loaders import load_colbert
 from xlmr_colbert.utils.utils import print_message
 
 from xlmr_colbert.indexing.index_manager import IndexManager
+from xlmr_colbert.indexing.manifest import Manifest
+from xlmr_colbert.indexing.dedup import get_passage_text
+from xlmr_colbert.indexing.loaders import (
+    get_part_doclens_path,
+    load_line_offsets,
+    load_aliases,
+)
+
+# Seconds between checks, by the prefetch thread, of whether encoding has stopped.
+PREFETCH_TIMEOUT = 1.0
 
 
 class CollectionEncoder:
-    def __init__(self, args, process_idx, num_processes):
+    def __init__(self, args, process_idx, num_processes, part_offset=0, pid_offset=0):
+        """
+        With `part_offset` and `pid_offset` (see append.py), the collection holds the passages
+        pid_offset, pid_offset + 1, ... and they are saved as parts part_offset, part_offset + 1, ...
+        """
+
         self.args = args
         self.collection = args.collection
         self.process_idx = process_idx
         self.num_processes = num_processes
+        self.part_offset = part_offset
+        self.pid_offset = pid_offset
 
         assert 0.5 <= args.chunksize <= 128.0
         max_bytes_per_file = args.chunksize * (1024 * 1024 * 1024)
@@ -39,9 +60,39 @@ class CollectionEncoder:
 
         self._load_model()
         self.indexmgr = IndexManager(args.dim)
+        self.line_offsets = (
+            load_line_offsets(args.index_path) if num_processes > 1 else None
+        )
+        self.aliases = (
+            load_aliases(args.index_path) if getattr(args, "dedup", False) else None
+        )
+
+        # Everything that decides the contents, sizes and owners of the parts.
+        settings = {
+            "collection": os.path.abspath(self.collection),
+            "checkpoint": args.checkpoint,
+            "doc_maxlen": args.doc_maxlen,
+            "dim": args.dim,
+            "num_processes": num_processes,
+            "possible_subset_sizes": self.possible_subset_sizes,
+            "part_offset": part_offset,
+            "pid_offset": pid_offset,
+            "dedup": self.aliases is not None,
+            "pruning": None
+            if self.colbert.pruner is None
+            else self.colbert.pruner.settings,
+        }
+
+        self.manifest = Manifest(args.index_path, process_idx, settings, part_offset)
+
+        if args.resume:
+            self.manifest.load()
         self.iterator = self._initialize_iterator()
 
     def _initialize_iterator(self):
+        if self.line_offsets is not None:
+            return open(self.collection, "rb")
+
         return open(self.collection)
 
     def _saver_thread(self):
@@ -52,8 +103,12 @@ class CollectionEncoder:
         self.colbert, self.checkpoint = load_colbert(
             self.args, do_print=(self.process_idx == 0)
         )
-        self.colbert = self.colbert.cuda()
+        self.colbert = self.colbert.to(DEVICE)
         self.colbert.eval()
+        self.colbert.pruner = build_pruner(self.colbert.tokenizer, self.args)
+
+        if self.colbert.pruner is not None:
+            self.print_main(f"#> Pruning tokens: {self.colbert.pruner.settings}")
 
         self.inference = ModelInference(self.colbert, amp=self.args.amp)
 
@@ -62,44 +117,187 @@ class CollectionEncoder:
         thread = threading.Thread(target=self._saver_thread)
         thread.start()
 
+        if self.args.prefetch:
+            batches = self._prefetch_batches()
+        else:
+            batches = self._tokenize_batches()
+
         t0 = time.time()
         local_docs_processed = 0
-
-        for batch_idx, (offset, lines, owner) in enumerate(
-            self._batch_passages(self.iterator)
-        ):
-            if owner != self.process_idx:
-                continue
+        local_tokens_processed = 0
+        num_duplicates, duplicates_time, duplicates_bytes = 0, 0.0, 0
+
+        t3 = time.time()
+        for (
+            batch_idx,
+            offset,
+            num_lines,
+            unique,
+            tensorized,
+            tokenization_time,
+        ) in batches:
             self.print(f"encoding batch #{batch_idx} (starting at passage #{offset})")
 
             t1 = time.time()
-            batch = self._preprocess_batch(offset, lines)
-            embs, doclens, ids = self._encode_batch(batch_idx, batch)
+            embs, doclens, ids = self._encode_batch(batch_idx, tensorized, unique)
 
             t2 = time.time()
             self.saver_queue.put((batch_idx, embs, offset, doclens, ids))
 
-            t3 = time.time()
-            local_docs_processed += len(lines)
+            waiting_time, t3 = t1 - t3, time.time()
+            local_docs_processed += num_lines
             overall_throughput = compute_throughput(local_docs_processed, t0, t3)
-            this_encoding_throughput = compute_throughput(len(lines), t1, t2)
-            this_saving_throughput = compute_throughput(len(lines), t2, t3)
+            this_encoding_throughput = compute_throughput(num_lines, t1, t2)
+            this_saving_throughput = compute_throughput(num_lines, t2, t3)
+
+            local_tokens_processed += embs.size(0)
+            overall_tokens_throughput = int(local_tokens_processed / (t3 - t0))
+            this_tokens_throughput = int(embs.size(0) / (t2 - t1))
 
             self.print(
                 f"#> Completed batch #{batch_idx} (starting at passage #{offset}) \t\t"
                 f"Passages/min: {overall_throughput} (overall), ",
                 f"{this_encoding_throughput} (this encoding), ",
-                f"{this_saving_throughput} (this saving)",
+                f"{this_saving_throughput} (this saving) \t\t",
+                f"Tokens/sec: {overall_tokens_throughput} (overall), ",
+                f"{this_tokens_throughput} (this encoding)",
+            )
+            self.print(
+                f"#> Seconds: {round(tokenization_time, 1)} (tokenizing), ",
+                f"{round(waiting_time, 1)} (waiting for tokenization), ",
+                f"{round(t2 - t1, 1)} (encoding), ",
+                f"{round(t3 - t2, 1)} (waiting for the saver)",
             )
+
+            if unique is not None:
+                # What the duplicates would have cost, at this batch's rates.
+                num_encoded = max(int(unique.sum()), 1)
+                batch_duplicates = num_lines - int(unique.sum())
+
+                num_duplicates += batch_duplicates
+                duplicates_time += (t2 - t1) / num_encoded * batch_duplicates
+                batch_bytes = embs.numel() * embs.element_size()
+                batch_bytes += ids.numel() * ids.element_size()
+                duplicates_bytes += batch_bytes // num_encoded * batch_duplicates
+
         self.saver_queue.put(None)
 
+        if self.aliases is not None:
+            self.print(
+                f"#> Skipped {num_duplicates} duplicate passages, saving about "
+                f"{round(duplicates_time, 1)} seconds of encoding and "
+                f"{round(duplicates_bytes / (1024 * 1024), 1)} MiB of embeddings."
+            )
+
         self.print("#> Joining saver thread.")
         thread.join()
 
+    def _tokenize_batches(self, doc_tokenizer=None):
+        doc_tokenizer = doc_tokenizer or self.inference.doc_tokenizer
+
+        for batch_idx, (offset, lines, owner) in enumerate(
+            self._batch_passages(self.iterator), start=self.part_offset
+        ):
+            if owner != self.process_idx:
+                continue
+
+            if batch_idx in self.manifest:
+                self.print(f"#> Skipping batch #{batch_idx}, saved by a previous run.")
+                continue
+
+            t1 = time.time()
+            batch = self._preprocess_batch(offset, lines)
+            unique = self._unique_mask(offset, len(lines))
+
+            if unique is not None:
+                batch = [passage for passage, u in zip(batch, unique.tolist()) if u]
+
+            tensorized = None
+            if len(batch) > 0:
+                tensorized = doc_tokenizer.tensorize(
+                    batch, bsize=self.args.bsize, max_tokens=self.args.max_tokens
+                )
+
+            yield batch_idx, offset, len(lines), unique, tensorized, time.time() - t1
+
+    def _unique_mask(self, offset, num_lines):
+        """
+        Which of the passages starting at `offset` are not duplicates (see save_aliases()), or
+        None without deduplication.
+        """
+
+        if self.aliases is None:
+            return None
+
+        pids = torch.arange(offset, offset + num_lines) + self.pid_offset
+
+        return self.aliases[pids] == pids
+
+    def _prefetch_batches(self):
+        """
+        Run _tokenize_batches() on a separate thread (the fast tokenizer releases the GIL), so
+        that the next chunk is read and tokenized while the current one is being encoded.
+        """
+
+        prefetch_queue = queue.Queue(maxsize=1)
+        stop = threading.Event()
+        errors = []
+
+        # The shared tokenizer is not thread-safe (see load_tokenizer).
+        doc_tokenizer = DocTokenizer(
+            self.inference.doc_tokenizer.doc_maxlen, shared=False
+        )
+
+        def _put(item):
+            while not stop.is_set():
+                try:
+                    prefetch_queue.put(item, timeout=PREFETCH_TIMEOUT)
+                    return
+                except queue.Full:
+                    pass
+
+        def _prefetch_thread():
+            try:
+                for tokenized_batch in self._tokenize_batches(doc_tokenizer):
+                    if stop.is_set():
+                        break
+
+                    _put(tokenized_batch)
+            except BaseException as e:
+                errors.append(e)
+            finally:
+                _put(None)
+
+        thread = threading.Thread(target=_prefetch_thread, daemon=True)
+        thread.start()
+
+        # If encoding fails (or is interrupted), the producer is stopped rather than left
+        # blocked on the full queue.
+        try:
+            yield from iter(prefetch_queue.get, None)
+        finally:
+            stop.set()
+
+            while thread.is_alive():
+                try:
+                    prefetch_queue.get(timeout=PREFETCH_TIMEOUT)
+                except queue.Empty:
+                    pass
+
+            thread.join()
+
+        if errors:
+            raise errors[0]
+
     def _batch_passages(self, fi):
         """
         Must use the same seed across processes!
         """
+
+        if self.line_offsets is not None:
+            yield from self._seek_batch_passages(fi)
+            return
+
         np.random.seed(0)
 
         offset = 0
@@ -121,40 +319,87 @@ class CollectionEncoder:
 
         return
 
+    def _seek_batch_passages(self, fi):
+        """
+        The same batches and owners as reading the collection line by line, but only the lines
+        of this process's batches are read, by seeking with the index of save_line_offsets().
+        Others' batches are yielded with None for their lines.
+        """
+
+        np.random.seed(0)
+
+        num_lines = len(self.line_offsets) - 1
+
+        offset = 0
+        for owner in itertools.cycle(range(self.num_processes)):
+            batch_size = np.random.choice(self.possible_subset_sizes)
+            endpos = min(offset + batch_size, num_lines)
+
+            if endpos == offset:
+                break  # EOF
+
+            L = None
+
+            if owner == self.process_idx:
+                start, end = self.line_offsets[offset], self.line_offsets[endpos]
+
+                fi.seek(start)
+                L = list(io.TextIOWrapper(io.BytesIO(fi.read(end - start))))
+
+                assert len(L) == endpos - offset, (len(L), offset, endpos)
+
+            yield (offset, L, owner)
+
+            if endpos - offset < batch_size:
+                break  # EOF
+
+            offset = endpos
+
+        self.print("[NOTE] Done with local share.")
+
     def _preprocess_batch(self, offset, lines):
         endpos = offset + len(lines)
 
         batch = []
 
         for line_idx, line in zip(range(offset, endpos), lines):
-            line_parts = line.strip().split("\t")
-
-            pid, passage, *other = line_parts
+            pid, passage = get_passage_text(line)
 
             assert len(passage) >= 1
 
-            if len(other) >= 1:
-                title, *_ = other
-                passage = title + " | " + passage
-
             batch.append(passage)
 
-            assert pid == "id" or int(pid) == line_idx
+            assert pid == "id" or int(pid) == self.pid_offset + line_idx
 
         return batch
 
-    def _encode_batch(self, batch_idx, batch):
+    def _encode_batch(self, batch_idx, tensorized, unique=None):
+        """
+        With `unique`, only its passages were tokenized, and the duplicates get a doclen of zero.
+        """
+
+        if tensorized is None:  # all duplicates
+            embs = torch.zeros(0, self.args.dim, dtype=torch.float16)
+            return embs, [0] * len(unique), torch.zeros(0, dtype=torch.long)
+
+        batch_ids, reverse_indices = tensorized
+
         with torch.no_grad():
-            embs, ids = self.inference.docFromText(
-                batch, bsize=self.args.bsize, keep_dims=False, with_ids=True
+            embs, ids = self.inference.docFromTensorized(
+                batch_ids, reverse_indices, keep_dims=False, with_ids=True
             )
             assert type(embs) is list
-            assert len(embs) == len(batch)
+            assert len(embs) == len(reverse_indices)
 
             local_doclens = [d.size(0) for d in embs]
             embs = torch.cat(embs)
             ids = torch.cat(ids)
 
+        if unique is not None:
+            doclens = torch.zeros(len(unique), dtype=torch.long)
+            doclens[unique] = torch.tensor(local_doclens)
+            local_doclens = doclens.tolist()
+
         return embs, local_doclens, ids
 
     def _save_batch(self, batch_idx, embs, offset, doclens, ids):
@@ -167,21 +412,23 @@ class CollectionEncoder:
         output_sample_path = os.path.join(
             self.args.index_path, "{}.sample".format(batch_idx)
         )
-        doclens_path = os.path.join(
-            self.args.index_path, "doclens.{}.json".format(batch_idx)
-        )
+        doclens_path = get_part_doclens_path(self.args.index_path, batch_idx)
 
         # Save the embeddings.
         self.indexmgr.save(embs, output_path)
         self.indexmgr.save(ids, output_path_ids)
         self.indexmgr.save(
-            embs[torch.randint(0, high=embs.size(0), size=(embs.size(0) // 20,))],
+            embs[torch.randperm(embs.size(0))[: embs.size(0) // 20]],
             output_sample_path,
         )
 
         # Save the doclens.
-        with open(doclens_path, "w") as output_doclens:
-            ujson.dump(doclens, output_doclens)
+        self.indexmgr.save_doclens(doclens, doclens_path)
+
+        # Record the part as complete only once all of its files are written.
+        self.manifest.add(
+            batch_idx, [output_path, output_path_ids, output_sample_path, doclens_path]
+        )
 
         throughput = compute_throughput(len(doclens), start_time, time.time())
         self.print_main(
@@ -1,23 +1,47 @@
 import os
+import copy
 import math
+import time
 import faiss
 import torch
 import numpy as np
 
 import threading
 import queue
-
-from xlmr_colbert.utils.utils import print_message, grouper
-from xlmr_colbert.indexing.loaders import get_parts
-from xlmr_colbert.indexing.index_manager import load_index_part
-from xlmr_colbert.indexing.faiss_index import FaissIndex
+import multiprocessing
+
+from xlmr_colbert.utils.utils import print_message
+from xlmr_colbert.indexing.loaders import get_parts, load_doclens_arrays
+from xlmr_colbert.indexing.index_manager import (
+    load_index_part,
+    load_contiguous_index,
+    get_emb2pid_path,
+    build_emb2pid,
+    save_emb2pid,
+)
+from xlmr_colbert.indexing.faiss_index import (
+    FAISS_FACTORIES,
+    DEFAULT_FAISS_FACTORY,
+    get_faiss_factory_string,
+    FaissIndex,
+    load_faiss_index,
+    get_faiss_metadata_path,
+)
 
 
 def get_faiss_index_name(args, offset=None, endpos=None):
+    factory = getattr(args, "faiss_factory", None) or DEFAULT_FAISS_FACTORY
     partitions_info = "" if args.partitions is None else f".{args.partitions}"
+    labels_info = ".pids" if getattr(args, "pid_labels", False) else ""
     range_info = "" if offset is None else f".{offset}-{endpos}"
 
-    return f"ivfpq{partitions_info}{range_info}.faiss"
+    # e.g., "OPQ16,IVF{partitions}_HNSW32,PQ16x8" is named opq16+ivf65536_hnsw32+pq16x8.
+    if factory not in FAISS_FACTORIES:
+        factory = get_faiss_factory_string(factory, args.partitions)
+        factory = factory.lower().replace(",", "+").replace("-", "_")
+        partitions_info = ""
+
+    return f"{factory}{partitions_info}{labels_info}{range_info}.faiss"
 
 
 def load_sample(samples_paths, sample_fraction=None):
@@ -27,108 +51,510 @@ def load_sample(samples_paths, sample_fraction=None):
         print_message(f"#> Loading {filename} ...")
         part = load_index_part(filename)
         if sample_fraction:
-            part = part[
-                torch.randint(
-                    0, high=part.size(0), size=(int(part.size(0) * sample_fraction),)
-                )
-            ]
-        sample.append(part)
+            num_samples = int(part.size(0) * sample_fraction)
+            part = part[torch.randperm(part.size(0))[:num_samples]]
+        sample.append(part.float().numpy())
 
-    sample = torch.cat(sample).float().numpy()
+    sample = np.concatenate(sample)
 
     print("#> Sample has shape", sample.shape)
 
     return sample
 
 
-def prepare_faiss_index(slice_samples_paths, partitions, sample_fraction=None):
-    training_sample = load_sample(slice_samples_paths, sample_fraction=sample_fraction)
+def sample_embeddings(parts_paths, parts_num_embeddings, num_samples, seed=12345):
+    """
+    Draw exactly `num_samples` of the embeddings of the parts uniformly, without replacement.
+    How many come from each part is drawn upfront (a multivariate hypergeometric over their
+    sizes), so parts are loaded one at a time and only their drawn rows are converted to float32,
+    into the preallocated output.
+    """
+
+    rng = np.random.default_rng(seed)
+
+    parts_num_embeddings = np.asarray(parts_num_embeddings, dtype=np.int64)
+    num_samples = min(num_samples, int(parts_num_embeddings.sum()))
+    assert num_samples > 0, "There are no embeddings to draw the training sample from."
+
+    parts_num_samples = rng.multivariate_hypergeometric(
+        parts_num_embeddings, num_samples
+    )
+
+    sample, offset = None, 0
+
+    for filename, num_embeddings, part_num_samples in zip(
+        parts_paths, parts_num_embeddings, parts_num_samples
+    ):
+        if part_num_samples == 0:
+            continue
+
+        print_message(f"#> Drawing {part_num_samples} embeddings from {filename} ...")
+        part = load_index_part(filename)
+        assert part.size(0) == num_embeddings, (filename, part.size(0), num_embeddings)
+
+        if sample is None:
+            sample = np.empty((num_samples, part.size(-1)), dtype=np.float32)
+
+        rows = np.sort(rng.choice(num_embeddings, part_num_samples, replace=False))
+        sample[offset : offset + part_num_samples] = (
+            part[torch.from_numpy(rows)].float().numpy()
+        )
+
+        offset += part_num_samples
+        del part
+
+    print("#> Sample has shape", sample.shape)
+
+    return sample
+
+
+# Training embeddings per partition when no sample size is given. FAISS's k-means warns below
+# 39 and subsamples above 256.
+DEFAULT_SAMPLES_PER_PARTITION = 64
+
+
+def get_default_partitions(num_embeddings):
+    return 1 << math.ceil(math.log2(8 * math.sqrt(num_embeddings)))
+
+
+def get_num_samples(args, num_embeddings):
+    """
+    The number of training embeddings asked for with --samples_per_partition, --num_samples
+    or --sample (a fraction), else DEFAULT_SAMPLES_PER_PARTITION per partition, or None (for
+    indexes without partitions) to train on the .sample files of the parts.
+    """
+
+    if getattr(args, "samples_per_partition", None) is not None:
+        assert args.partitions is not None, "--samples_per_partition needs partitions."
+        num_samples = args.samples_per_partition * args.partitions
+    elif getattr(args, "num_samples", None) is not None:
+        num_samples = args.num_samples
+    elif args.sample is not None:
+        num_samples = int(args.sample * num_embeddings)
+    elif args.partitions is not None:
+        num_samples = min(
+            num_embeddings, DEFAULT_SAMPLES_PER_PARTITION * args.partitions
+        )
+    else:
+        return None
+
+    assert num_samples > 0, (
+        f"No training embeddings to draw ({num_samples}, out of {num_embeddings}): "
+        "raise --samples_per_partition, --num_samples or --sample, or use fewer --slices."
+    )
+
+    return num_samples
 
+
+def prepare_faiss_index(
+    training_sample,
+    partitions,
+    pid_labels=False,
+    factory=DEFAULT_FAISS_FACTORY,
+    search_params="",
+    kmeans="auto",
+):
     dim = training_sample.shape[-1]
-    index = FaissIndex(dim, partitions)
+    index = FaissIndex(dim, partitions, pid_labels, None, factory, search_params)
 
     print_message("#> Training with the vectors...")
 
-    index.train(training_sample)
+    index.train(training_sample, kmeans)
 
     print_message("Done training!\n")
 
     return index
 
 
-SPAN = 1
+# Rows per float32 slice handed to FAISS when no --memory_budget is given (64 MiB at dim=128).
+FAISS_ADD_BSIZE = 1 << 17
+
+
+def get_add_bsize(dim, memory_budget=None, threads=1, prefetch=2):
+    """
+    The rows per slice such that the float32 slices (and int64 labels) buffered by the loader
+    threads of iterate_slices() fit in `memory_budget` MiB.
+    """
+
+    if memory_budget is None:
+        return FAISS_ADD_BSIZE
+
+    bsize = int(memory_budget * 2**20) // (threads * prefetch * (dim * 4 + 8))
+    assert bsize > 0, f"--memory_budget {memory_budget} is too small."
+
+    return bsize
+
+
+def get_part_loader(index_path, contiguous=False):
+    """
+    A function from a part to its float16 embeddings: a view of the memory-mapped embeddings.bin
+    when it covers the part (resident only as page cache), or else the loaded .pt file.
+
+    With `contiguous`, embeddings.bin must cover every part, so that no part is ever loaded.
+    """
+
+    _, parts_paths, _ = get_parts(index_path)
+    tensor, metadata = load_contiguous_index(index_path)
+    layout = [] if metadata is None else metadata["parts"]
+
+    assert not contiguous or len(layout) == len(parts_paths), (
+        f"--memory_budget needs an embeddings.bin that covers all {len(parts_paths)} parts of "
+        f"{index_path} (it covers {len(layout)}): run convert_index.py first."
+    )
+
+    def load_part(part):
+        if part < len(layout):
+            return tensor[layout[part]["emb_offset"] : layout[part]["emb_endpos"]]
+
+        return load_index_part(parts_paths[part])
+
+    return load_part
+
+
+def iterate_slices(load_part, parts, dim, bsize, get_ids=None, threads=1, prefetch=2):
+    """
+    Yield the float32 embeddings of `parts`, in order, as slices of at most `bsize` rows, along
+    with their labels (get_ids(part, offset, endpos) for the rows offset..endpos of the part, or
+    None).
+
+    Parts are taken in turn by `threads` loader threads, each of which converts its slices into
+    `prefetch` reused buffers: a slice is only valid until the next one is drawn, and at most
+    threads * prefetch slices (plus, for .pt files, one float16 part per thread) are in memory.
+    """
+
+    assert threads >= 1 and prefetch >= 1, (threads, prefetch)
+
+    free_buffers = [queue.Queue() for _ in range(threads)]
+    loaded_slices = [queue.Queue() for _ in range(threads)]
+
+    for thread_idx in range(threads):
+        for _ in range(prefetch):
+            free_buffers[thread_idx].put(np.empty((bsize, dim), dtype=np.float32))
+
+    def _loader_thread(thread_idx):
+        try:
+            for part in parts[thread_idx::threads]:
+                embs = load_part(part)
+                assert embs.size(-1) == dim, (part, embs.size(), dim)
+
+                for offset in range(0, embs.size(0), bsize):
+                    rows = embs[offset : offset + bsize]
+                    buffer = free_buffers[thread_idx].get()
+
+                    torch.from_numpy(buffer[: rows.size(0)]).copy_(rows)
+
+                    slice_ids = None
+                    if get_ids is not None:
+                        slice_ids = get_ids(part, offset, offset + rows.size(0))
+                        assert len(slice_ids) == rows.size(0), (part, offset)
+
+                    loaded_slices[thread_idx].put((buffer, rows.size(0), slice_ids))
+
+                del embs
+                loaded_slices[thread_idx].put(None)  # the end of the part
+        except Exception as e:
+            loaded_slices[thread_idx].put(e)
+
+    for thread_idx in range(threads):
+        threading.Thread(target=_loader_thread, args=(thread_idx,), daemon=True).start()
+
+    for idx, part in enumerate(parts):
+        thread_idx = idx % threads
+
+        while True:
+            loaded = loaded_slices[thread_idx].get()
+
+            if loaded is None:
+                break
+
+            if isinstance(loaded, Exception):
+                raise loaded
+
+            buffer, num_rows, slice_ids = loaded
+            yield buffer[:num_rows], slice_ids
+
+            free_buffers[thread_idx].put(buffer)
+
+
+def add_parts(
+    index, index_path, parts, doclens, doclens_pfxsum, parts_doc_offsets, args=None
+):
+    """
+    Stream the embeddings of `parts` of `index_path` into `index` (see iterate_slices), with
+    the slice size, loader threads and prefetch depth of Arguments.add_faiss_adding_parameters().
+    With a memory budget, the embeddings must be in embeddings.bin (see get_part_loader()).
+    """
+
+    if len(parts) == 0:
+        return
+
+    threads = getattr(args, "faiss_threads", 1)
+    prefetch = getattr(args, "faiss_prefetch", 2)
+    memory_budget = getattr(args, "memory_budget", None)
+    bsize = get_add_bsize(index.dim, memory_budget, threads, prefetch)
+
+    get_ids = None
+    if index.pid_labels:
+
+        def get_ids(part, offset, endpos):
+            # The pids of the passages that span the rows offset..endpos of the part.
+            emb_offset = int(doclens_pfxsum[parts_doc_offsets[part]])
+            emb_offset, emb_endpos = emb_offset + offset, emb_offset + endpos
+
+            pid_offset = int(np.searchsorted(doclens_pfxsum, emb_offset, "right")) - 1
+            pid_endpos = int(np.searchsorted(doclens_pfxsum, emb_endpos, "left"))
+
+            ids = build_emb2pid(
+                doclens[pid_offset:pid_endpos], pid_offset, dtype=torch.int64
+            )
+            skip = emb_offset - int(doclens_pfxsum[pid_offset])
+
+            return ids[skip : skip + endpos - offset].numpy()
+
+    print_message(
+        f"#> Adding parts {parts[0]}..{parts[-1]} in slices of {bsize} embeddings, "
+        f"with {threads} loader thread(s) and a prefetch depth of {prefetch} .."
+    )
+
+    load_part = get_part_loader(index_path, contiguous=memory_budget is not None)
+    slices = iterate_slices(
+        load_part, parts, index.dim, bsize, get_ids, threads, prefetch
+    )
+
+    for sub_collection, sub_collection_ids in slices:
+        index.add(sub_collection, ids=sub_collection_ids)
+
+
+def get_slices(num_parts, num_slices):
+    num_parts_per_slice = math.ceil(num_parts / num_slices)
+
+    return [
+        (part_offset, min(part_offset + num_parts_per_slice, num_parts))
+        for part_offset in range(0, num_parts, num_parts_per_slice)
+    ]
 
 
 def index_faiss(args):
-    print_message("#> Starting..")
+    """
+    Build one FAISS index per slice of the parts. With args.slice_workers > 1, slices are built
+    concurrently by as many processes, which split args.nthreads and args.memory_budget. They
+    train and add on CPU, as each would otherwise claim all of the GPUs.
+    """
 
-    parts, parts_paths, samples_paths = get_parts(args.index_path)
+    print_message("#> Starting..")
 
-    if args.sample is not None:
-        assert args.sample, args.sample
-        print_message(
-            f"#> Training with {round(args.sample * 100.0, 1)}% of *all* embeddings (provided --sample)."
-        )
-        samples_paths = parts_paths
+    parts, _, _ = get_parts(args.index_path)
+    slices = get_slices(len(parts), args.slices)
+    workers = min(getattr(args, "slice_workers", 1), len(slices))
 
-    num_parts_per_slice = math.ceil(len(parts) / args.slices)
+    s = time.time()
 
-    for slice_idx, part_offset in enumerate(range(0, len(parts), num_parts_per_slice)):
-        part_endpos = min(part_offset + num_parts_per_slice, len(parts))
+    if workers == 1:
+        all_stats = [
+            index_faiss_slice(args, slice_idx, part_offset, part_endpos)
+            for slice_idx, (part_offset, part_endpos) in enumerate(slices)
+        ]
+    else:
+        slice_args = copy.copy(args)
+        slice_args.nthreads = max(1, args.nthreads // workers)
+        if getattr(args, "memory_budget", None) is not None:
+            slice_args.memory_budget = args.memory_budget / workers
 
-        slice_parts_paths = parts_paths[part_offset:part_endpos]
-        slice_samples_paths = samples_paths[part_offset:part_endpos]
+        print_message(
+            f"#> Building {len(slices)} slices with {workers} processes "
+            f"of {slice_args.nthreads} FAISS threads each.."
+        )
 
-        if args.slices == 1:
-            faiss_index_name = get_faiss_index_name(args)
-        else:
-            faiss_index_name = get_faiss_index_name(
-                args, offset=part_offset, endpos=part_endpos
+        # Spawned, so that workers do not inherit the OpenMP (or CUDA) state of this process.
+        with multiprocessing.get_context("spawn").Pool(workers) as pool:
+            all_stats = pool.starmap(
+                _index_faiss_slice_worker,
+                [
+                    (slice_args, slice_idx, part_offset, part_endpos)
+                    for slice_idx, (part_offset, part_endpos) in enumerate(slices)
+                ],
             )
 
-        output_path = os.path.join(args.index_path, faiss_index_name)
+    elapsed = time.time() - s
+    num_embeddings = sum(stats["num_embeddings"] for stats in all_stats)
+
+    for slice_idx, stats in enumerate(all_stats):
         print_message(
-            f"#> Processing slice #{slice_idx+1} of {args.slices} (range {part_offset}..{part_endpos})."
+            f"#> Slice #{slice_idx+1}: {stats['num_embeddings']} embeddings, "
+            f"trained in {stats['train_time']:.1f}s, "
+            f"added in {stats['add_time']:.1f}s "
+            f"({stats['num_embeddings'] / max(stats['add_time'], 1e-6):.0f} embeddings/s)"
+            + (
+                ""
+                if stats["imbalance"] is None
+                else f", list imbalance = {stats['imbalance']:.2f}"
+            )
+            + "."
         )
-        print_message(f"#> Will write to {output_path}.")
 
-        assert not os.path.exists(output_path), output_path
+    print_message(
+        f"#> Built {len(slices)} slices ({num_embeddings} embeddings) in {elapsed:.1f}s."
+    )
 
-        index = prepare_faiss_index(slice_samples_paths, args.partitions, args.sample)
 
-        loaded_parts = queue.Queue(maxsize=1)
+def _index_faiss_slice_worker(args, slice_idx, part_offset, part_endpos):
+    os.environ["CUDA_VISIBLE_DEVICES"] = ""
 
-        def _loader_thread(thread_parts_paths):
-            for filenames in grouper(thread_parts_paths, SPAN, fillvalue=None):
-                sub_collection = [
-                    load_index_part(filename)
-                    for filename in filenames
-                    if filename is not None
-                ]
-                sub_collection = torch.cat(sub_collection)
-                sub_collection = sub_collection.float().numpy()
-                loaded_parts.put(sub_collection)
+    faiss.omp_set_num_threads(args.nthreads)
+    torch.set_num_threads(args.nthreads)
 
-        thread = threading.Thread(target=_loader_thread, args=(slice_parts_paths,))
-        thread.start()
+    return index_faiss_slice(args, slice_idx, part_offset, part_endpos)
 
-        print_message("#> Indexing the vectors...")
 
-        for filenames in grouper(slice_parts_paths, SPAN, fillvalue=None):
-            print_message("#> Loading", filenames, "(from queue)...")
-            sub_collection = loaded_parts.get()
+def index_faiss_slice(args, slice_idx, part_offset, part_endpos):
+    parts, parts_paths, samples_paths = get_parts(args.index_path)
+    doclens, doclens_pfxsum, parts_doc_offsets = load_doclens_arrays(args.index_path)
 
-            print_message(
-                "#> Processing a sub_collection with shape", sub_collection.shape
-            )
-            index.add(sub_collection)
+    parts_emb_offsets = [int(doclens_pfxsum[pid]) for pid in parts_doc_offsets]
+    parts_num_embeddings = np.diff(parts_emb_offsets)
 
-        print_message("Done indexing!")
+    slice_parts = parts[part_offset:part_endpos]
+    slice_samples_paths = samples_paths[part_offset:part_endpos]
+    slice_num_embeddings = parts_num_embeddings[part_offset:part_endpos]
 
-        index.save(output_path)
+    if args.slices == 1:
+        faiss_index_name = get_faiss_index_name(args)
+    else:
+        faiss_index_name = get_faiss_index_name(
+            args, offset=part_offset, endpos=part_endpos
+        )
+
+    output_path = os.path.join(args.index_path, faiss_index_name)
+    print_message(
+        f"#> Processing slice #{slice_idx+1} of {args.slices} (range {part_offset}..{part_endpos})."
+    )
+    print_message(f"#> Will write to {output_path}.")
+
+    assert not os.path.exists(output_path), output_path
+
+    s = time.time()
+    num_samples = get_num_samples(args, int(slice_num_embeddings.sum()))
+
+    if num_samples is None:
+        training_sample = load_sample(slice_samples_paths)
+    else:
+        print_message(
+            f"#> Training with {num_samples} of the {slice_num_embeddings.sum()} "
+            f"embeddings of the slice, drawn uniformly without replacement."
+        )
+        training_sample = sample_embeddings(
+            parts_paths[part_offset:part_endpos], slice_num_embeddings, num_samples
+        )
 
+    index = prepare_faiss_index(
+        training_sample,
+        args.partitions,
+        args.pid_labels,
+        args.faiss_factory,
+        args.faiss_params,
+        getattr(args, "kmeans", "auto"),
+    )
+    del training_sample
+
+    train_time = time.time() - s
+
+    print_message(f"#> Slice #{slice_idx+1}: indexing the vectors...")
+
+    s = time.time()
+    add_parts(
+        index,
+        args.index_path,
+        slice_parts,
+        doclens,
+        doclens_pfxsum,
+        parts_doc_offsets,
+        args,
+    )
+    add_time = time.time() - s
+
+    print_message(
+        f"#> Slice #{slice_idx+1}: added {index.offset} embeddings in {add_time:.1f}s "
+        f"({index.offset / max(add_time, 1e-6):.0f} embeddings/s)."
+    )
+
+    imbalance = index.get_imbalance()
+    if imbalance is not None:
         print_message(
-            f"\n\nDone! All complete (for slice #{slice_idx+1} of {args.slices})!"
+            f"#> Slice #{slice_idx+1}: list imbalance = {imbalance['imbalance']:.2f}, "
+            f"{imbalance['empty_lists']} empty lists, "
+            f"largest list = {imbalance['max_list_size']}."
+        )
+
+    index.save(output_path, ondisk=getattr(args, "ondisk", False))
+
+    # With pid labels, FAISS returns the pids directly and no emb2pid table is needed.
+    if not args.pid_labels:
+        pid_offset, pid_endpos = (
+            parts_doc_offsets[part_offset],
+            parts_doc_offsets[part_endpos],
+        )
+        save_emb2pid(
+            get_emb2pid_path(output_path),
+            doclens[pid_offset:pid_endpos],
+            pid_offset,
         )
 
-        thread.join()
+    print_message(
+        f"\n\nDone! All complete (for slice #{slice_idx+1} of {args.slices})!"
+    )
+
+    return {
+        "num_embeddings": index.offset,
+        "train_time": train_time,
+        "add_time": add_time,
+        "imbalance": None if imbalance is None else imbalance["imbalance"],
+    }
+
+
+def append_faiss(args, first_part):
+    """
+    Add the embeddings of parts first_part.. to the existing, unsliced FAISS index of
+    args.index_path, without retraining it, and rewrite its emb2pid table.
+    """
+
+    parts, _, _ = get_parts(args.index_path)
+
+    # doclens.bin does not cover the new parts yet.
+    doclens, doclens_pfxsum, parts_doc_offsets = load_doclens_arrays(
+        args.index_path, memmap=False
+    )
+    parts_emb_offsets = [int(doclens_pfxsum[pid]) for pid in parts_doc_offsets]
+
+    faiss_index_path = os.path.join(args.index_path, args.faiss_name)
+    index = load_faiss_index(faiss_index_path)
+
+    # Parts added by an interrupted run are not added again.
+    assert index.offset in parts_emb_offsets[first_part:], (
+        "Only an index over all of the previous parts (i.e., unsliced) can be appended to.",
+        index.offset,
+    )
+    first_part = parts_emb_offsets.index(index.offset, first_part)
+
+    print_message(f"#> Appending parts {first_part}.. to {faiss_index_path} ..")
+
+    add_parts(
+        index,
+        args.index_path,
+        parts[first_part:],
+        doclens,
+        doclens_pfxsum,
+        parts_doc_offsets,
+        args,
+    )
+
+    index.save(faiss_index_path + ".tmp")
+    os.replace(faiss_index_path + ".tmp", faiss_index_path)
+    os.replace(
+        get_faiss_metadata_path(faiss_index_path + ".tmp"),
+        get_faiss_metadata_path(faiss_index_path),
+    )
+
+    if not index.pid_labels:
+        save_emb2pid(get_emb2pid_path(faiss_index_path), doclens)
+
+    print_message("#> Done appending to the FAISS index.")
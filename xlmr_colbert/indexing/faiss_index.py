@@ -1,31 +1,247 @@
+import os
 import sys
 import time
 import math
 import faiss
 import torch
+import ujson
 
 import numpy as np
 
 from xlmr_colbert.indexing.faiss_index_gpu import FaissIndexGPU
 from xlmr_colbert.utils.utils import print_message
 
+# Named factory strings for index_faiss.py --faiss_factory, which also takes any FAISS factory
+# string; "{partitions}" stands for --partitions.
+FAISS_FACTORIES = {
+    "ivfpq": "IVF{partitions},PQ16x8",
+    "opqpq": "OPQ32,IVF{partitions},PQ32x8",
+    "ivfsq8": "IVF{partitions},SQ8",
+    "ivfhnsw": "IVF{partitions}_HNSW32,PQ16x8",
+    "hnsw": "HNSW32",
+}
+DEFAULT_FAISS_FACTORY = "ivfpq"
+
+KMEANS_MODES = ["auto", "faiss", "two_level"]
+
+# From this many partitions, "auto" trains the coarse quantizer of CPU builds with
+# two_level_kmeans() rather than FAISS's own (flat) k-means.
+TWO_LEVEL_MIN_PARTITIONS = 1 << 16
+
+
+def get_faiss_factory_string(factory, partitions):
+    factory = FAISS_FACTORIES.get(factory, factory)
+
+    assert partitions is not None or "{partitions}" not in factory, (
+        "--partitions is needed for",
+        factory,
+    )
+
+    return factory.format(partitions=partitions)
+
+
+def is_ivf_factory(factory):
+    """
+    Whether `factory` (a key of FAISS_FACTORIES or a factory string) builds an index with
+    inverted lists, e.g., "OPQ16,IVF{partitions}_HNSW32,PQ16x8" but not "HNSW32".
+    """
+
+    factory = FAISS_FACTORIES.get(factory, factory)
+
+    return any(
+        component.strip().startswith(("IVF", "IMI")) for component in factory.split(",")
+    )
+
+
+def allocate_centroids(sizes, k):
+    """
+    Split `k` centroids among groups of `sizes` points, in proportion to their sizes, with at
+    least one centroid per non-empty group and at most one per point.
+    """
+
+    n = sizes.sum()
+    assert n >= k, (n, k)
+
+    counts = np.minimum(np.maximum(sizes * k // n, sizes > 0), sizes).astype(np.int64)
+
+    while counts.sum() < k:
+        gains = np.where(counts < sizes, sizes / (counts + 1), -1)
+        counts[np.argmax(gains)] += 1
+
+    while counts.sum() > k:
+        losses = np.where(counts > 1, sizes / np.maximum(counts, 1), np.inf)
+        counts[np.argmin(losses)] -= 1
+
+    return counts
+
+
+def two_level_kmeans(x, k, niter=20, seed=12345):
+    """
+    Approximate k-means: cluster `x` into about sqrt(k) groups, then split every group into its
+    share of the `k` centroids (see allocate_centroids). Each level costs O(n * sqrt(k))
+    distances per iteration, instead of O(n * k) for flat k-means.
+    """
+
+    n, dim = x.shape
+    num_groups = max(1, int(round(math.sqrt(k))))
+
+    kmeans = faiss.Kmeans(dim, num_groups, niter=niter, seed=seed)
+    kmeans.train(x)
+
+    _, assignments = kmeans.index.search(x, 1)
+    assignments = assignments.ravel()
+
+    sizes = np.bincount(assignments, minlength=num_groups)
+    counts = allocate_centroids(sizes, k)
+
+    order = np.argsort(assignments, kind="stable")
+    offsets = np.concatenate([[0], np.cumsum(sizes)])
+
+    print_message(
+        f"#> Split {n} vectors into {num_groups} groups of {sizes.min()} to "
+        f"{sizes.max()} vectors, for {counts.min()} to {counts.max()} centroids each.."
+    )
+
+    centroids = []
+
+    for group, count in enumerate(counts):
+        if count == 0:
+            continue
+
+        group_x = x[order[offsets[group] : offsets[group + 1]]]
+
+        if count == len(group_x):
+            centroids.append(group_x)
+            continue
+
+        group_kmeans = faiss.Kmeans(dim, int(count), niter=niter, seed=seed + group + 1)
+        group_kmeans.train(group_x)
+        centroids.append(group_kmeans.centroids)
+
+    return np.ascontiguousarray(np.concatenate(centroids), dtype=np.float32)
+
+
+def get_faiss_metadata_path(faiss_index_path):
+    return faiss_index_path + ".json"
+
+
+def get_ivfdata_path(faiss_index_path):
+    return faiss_index_path + ".ivfdata"
+
+
+def load_faiss_metadata(faiss_index_path):
+    """
+    Read the sidecar written by FaissIndex.save(). Indexes built before it existed hold
+    embedding ordinals, i.e., they use the defaults below.
+    """
+
+    metadata = {
+        "pid_labels": False,
+        "factory": DEFAULT_FAISS_FACTORY,
+        "search_params": "",
+        "ondisk": False,
+    }
+    metadata_path = get_faiss_metadata_path(faiss_index_path)
+
+    if os.path.exists(metadata_path):
+        with open(metadata_path) as f:
+            metadata.update(ujson.load(f))
+
+    return metadata
+
+
+def load_faiss_index(faiss_index_path):
+    """
+    A trained (and populated) index written by FaissIndex.save(), to add more vectors to.
+    """
+
+    metadata = load_faiss_metadata(faiss_index_path)
+    assert not metadata["ondisk"], (
+        f"{faiss_index_path} has on-disk inverted lists, which are read-only: "
+        "rebuild it with index_faiss instead."
+    )
+
+    index = faiss.read_index(faiss_index_path)
+
+    index_ivf = faiss.try_extract_index_ivf(index)
+
+    return FaissIndex(
+        index.d,
+        None if index_ivf is None else index_ivf.nlist,
+        metadata["pid_labels"],
+        index=index,
+        factory=metadata["factory"],
+        search_params=metadata["search_params"],
+    )
+
 
 class FaissIndex:
-    def __init__(self, dim, partitions):
+    """
+    An index built by faiss.index_factory() from `factory` (a key of FAISS_FACTORIES or a
+    factory string), e.g., IVF-PQ with or without OPQ, IVF-SQ8, IVF with an HNSW coarse
+    quantizer, or HNSW. `search_params` (e.g., "efSearch=128") are the defaults for searching
+    it, applied with faiss.ParameterSpace along with --nprobe (see ranking/faiss_index.py).
+    """
+
+    def __init__(
+        self,
+        dim,
+        partitions,
+        pid_labels=False,
+        index=None,
+        factory=DEFAULT_FAISS_FACTORY,
+        search_params="",
+    ):
         self.dim = dim
         self.partitions = partitions
+        self.pid_labels = pid_labels
+        self.factory = get_faiss_factory_string(factory, partitions)
+        self.search_params = search_params
 
         self.gpu = FaissIndexGPU()
-        self.quantizer, self.index = self._create_index()
-        self.offset = 0
+
+        if index is None:
+            self.index = self._create_index()
+            self.offset = 0
+        else:
+            self.index = index
+            self.offset = index.ntotal
+
+            # The GPU path copies a fresh index over; additions to a populated one stay on CPU.
+            self.gpu.ngpu = 0
+
+        self.quantizer = None
+        index_ivf = faiss.try_extract_index_ivf(self.index)
+        if index_ivf is not None:
+            self.quantizer = index_ivf.quantizer
+
+        # The GPU helpers train and fill a bare IVF index with a flat coarse quantizer.
+        if not isinstance(self.index, faiss.IndexIVF) or not isinstance(
+            self.quantizer, faiss.IndexFlat
+        ):
+            self.gpu.ngpu = 0
 
     def _create_index(self):
-        quantizer = faiss.IndexFlatL2(self.dim)  # faiss.IndexHNSWFlat(dim, 32)
-        index = faiss.IndexIVFPQ(quantizer, self.dim, self.partitions, 16, 8)
+        print_message(f"#> Creating a FAISS index with the factory {self.factory} ..")
 
-        return quantizer, index
+        index = faiss.index_factory(self.dim, self.factory)
+
+        # Only IVF indexes take arbitrary labels.
+        if self.pid_labels and faiss.try_extract_index_ivf(index) is None:
+            index = faiss.IndexIDMap(index)
+
+        return index
+
+    def train(self, train_data, kmeans="auto"):
+        assert kmeans in KMEANS_MODES, kmeans
+
+        if kmeans == "auto":
+            large = (self.partitions or 0) >= TWO_LEVEL_MIN_PARTITIONS
+            kmeans = "two_level" if large and self.gpu.ngpu == 0 else "faiss"
+
+        if kmeans == "two_level":
+            self._train_quantizer(train_data)
 
-    def train(self, train_data):
         print_message(f"#> Training now (using {self.gpu.ngpu} GPUs)...")
 
         if self.gpu.ngpu > 0:
@@ -33,26 +249,131 @@ class FaissIndex:
 
         s = time.time()
         self.index.train(train_data)
-        print(time.time() - s)
+        print_message(f"#> Trained in {time.time() - s:.1f}s.")
 
         if self.gpu.ngpu > 0:
             self.gpu.training_finalize()
 
-    def add(self, data):
+    def _train_quantizer(self, train_data):
+        """
+        Fill the coarse quantizer with the centroids of two_level_kmeans(), which IndexIVF.train
+        then keeps as they are.
+        """
+
+        index_ivf = faiss.try_extract_index_ivf(self.index)
+        assert index_ivf is not None, "Two-level k-means needs an IVF index."
+
+        s = time.time()
+
+        # e.g., with OPQ, the centroids live in the rotated space.
+        if isinstance(self.index, faiss.IndexPreTransform):
+            for i in range(self.index.chain.size()):
+                transform = self.index.chain.at(i)
+
+                if not transform.is_trained:
+                    transform.train(train_data)
+
+                train_data = transform.apply(train_data)
+
+        centroids = two_level_kmeans(train_data, index_ivf.nlist)
+
+        self.quantizer.train(centroids)
+        self.quantizer.add(centroids)
+
+        print_message(
+            f"#> Two-level k-means of {len(train_data)} vectors into {index_ivf.nlist} "
+            f"centroids took {time.time() - s:.1f}s."
+        )
+
+    def get_imbalance(self):
+        """
+        The imbalance factor of the inverted lists, i.e., the cost of a search relative to
+        perfectly balanced lists (1.0), the number of empty lists and the largest list. None for
+        indexes without inverted lists.
+        """
+
+        index_ivf = faiss.try_extract_index_ivf(self.index)
+
+        if index_ivf is None or index_ivf.ntotal == 0:
+            return None
+
+        invlists = index_ivf.invlists
+        sizes = np.array(
+            [invlists.list_size(i) for i in range(index_ivf.nlist)], dtype=np.float64
+        )
+
+        return {
+            "imbalance": float(len(sizes) * (sizes**2).sum() / sizes.sum() ** 2),
+            "empty_lists": int((sizes == 0).sum()),
+            "max_list_size": int(sizes.max()),
+        }
+
+    def add(self, data, ids=None):
+        """
+        With pid_labels, `ids` holds the pid of every row of `data`, and searching the index
+        returns pids rather than embedding ordinals.
+        """
+
         print_message(f"Add data with shape {data.shape} (offset = {self.offset})..")
+        assert self.pid_labels == (ids is not None)
 
         if self.gpu.ngpu > 0 and self.offset == 0:
             self.gpu.adding_initialize(self.index)
 
         if self.gpu.ngpu > 0:
-            self.gpu.add(self.index, data, self.offset)
+            self.gpu.add(self.index, data, self.offset, ids=ids)
+        elif ids is not None:
+            self.index.add_with_ids(data, ids)
         else:
             self.index.add(data)
 
         self.offset += data.shape[0]
 
-    def save(self, output_path):
+    def save(self, output_path, ondisk=False):
+        """
+        With `ondisk`, the inverted lists go to get_ivfdata_path(output_path), which searches
+        memory-map, and output_path only holds the quantizer and codebooks.
+        """
+
         print_message(f"Writing index to {output_path} ...")
 
-        self.index.nprobe = 10  # just a default
+        if ondisk:
+            self._move_invlists_to_disk(get_ivfdata_path(output_path))
+
         faiss.write_index(self.index, output_path)
+
+        metadata = {
+            "dim": self.dim,
+            "partitions": self.partitions,
+            "pid_labels": self.pid_labels,
+            "num_embeddings": self.offset,
+            "factory": self.factory,
+            "search_params": self.search_params,
+            "ondisk": ondisk,
+        }
+
+        with open(get_faiss_metadata_path(output_path), "w") as f:
+            ujson.dump(metadata, f)
+
+    def _move_invlists_to_disk(self, ivfdata_path):
+        index_ivf = faiss.try_extract_index_ivf(self.index)
+        assert (
+            index_ivf is not None
+        ), "Only IVF indexes have inverted lists to store on disk."
+
+        print_message(f"#> Writing the inverted lists to {ivfdata_path} ..")
+
+        invlists = faiss.OnDiskInvertedLists(
+            index_ivf.nlist, index_ivf.code_size, ivfdata_path
+        )
+
+        all_invlists = faiss.InvertedListsPtrVector()
+        all_invlists.push_back(index_ivf.invlists)
+
+        # Renamed in FAISS 1.7.4, where merge_from() takes a single InvertedLists.
+        merge = getattr(invlists, "merge_from_multiple", invlists.merge_from)
+        merge(all_invlists.data(), all_invlists.size())
+
+        # The index now owns the on-disk lists; the written index refers to them by filename.
+        index_ivf.replace_invlists(invlists, True)
+        invlists.this.disown()
@@ -100,26 +100,36 @@ class FaissIndexGPU:
             self.vres, self.vdev, index, self.co
         )
 
-    def add(self, index, data, offset):
+    def add(self, index, data, offset, ids=None):
+        """
+        Without `ids`, vectors are labelled with their ordinal (offset + i).
+        """
+
         assert self.ngpu > 0
 
         t0 = time.time()
         nb = data.shape[0]
 
+        if ids is None:
+            ids = np.arange(offset, offset + nb)
+
+        # Labels are increasing, so [ids[0], ids[-1]] covers exactly this batch.
+        id_range = (int(ids[0]), int(ids[-1]) + 1) if nb > 0 else (offset, offset)
+
         for i0 in range(0, nb, self.add_batch_size):
             i1 = min(i0 + self.add_batch_size, nb)
             xs = data[i0:i1]
 
-            self.gpu_index.add_with_ids(xs, np.arange(offset + i0, offset + i1))
+            self.gpu_index.add_with_ids(xs, ids[i0:i1])
 
             if self.max_add > 0 and self.gpu_index.ntotal > self.max_add:
-                self._flush_to_cpu(index, nb, offset)
+                self._flush_to_cpu(index, *id_range)
 
             print("\r%d/%d (%.3f s)  " % (i0, nb, time.time() - t0), end=" ")
             sys.stdout.flush()
 
         if self.gpu_index.ntotal > 0:
-            self._flush_to_cpu(index, nb, offset)
+            self._flush_to_cpu(index, *id_range)
 
         assert index.ntotal == offset + nb, (index.ntotal, offset + nb, offset, nb)
         print(
@@ -127,7 +137,7 @@ class FaissIndexGPU:
             % (time.time() - t0)
         )
 
-    def _flush_to_cpu(self, index, nb, offset):
+    def _flush_to_cpu(self, index, id_offset, id_endpos):
         print("Flush indexes to CPU")
 
         for i in range(self.ngpu):
@@ -136,7 +146,7 @@ class FaissIndexGPU:
             )
             index_src = faiss.index_gpu_to_cpu(index_src_gpu)
 
-            index_src.copy_subset_to(index, 0, offset, offset + nb)
+            index_src.copy_subset_to(index, 0, id_offset, id_endpos)
             index_src_gpu.reset()
             index_src_gpu.reserveMemory(self.max_add)
 
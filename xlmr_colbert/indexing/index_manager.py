@@ -1,8 +1,36 @@
+import os
+import shutil
 import torch
 import faiss
+import ujson
 import numpy as np
 
 from xlmr_colbert.utils.utils import print_message
+from xlmr_colbert.indexing.loaders import (
+    get_parts,
+    get_part_doclens_path,
+    load_part_doclens,
+    load_deleted,
+    DELETED_FILENAME,
+    DOCLENS_FILENAME,
+    DOCLENS_PFXSUM_FILENAME,
+    DOCLENS_DTYPE,
+    DOCLENS_PFXSUM_DTYPE,
+    LINE_OFFSETS_FILENAME,
+)
+
+EMBEDDINGS_FILENAME = "embeddings.bin"
+EMBEDDINGS_METADATA_FILENAME = "embeddings.json"
+
+# Passages per repeat_interleave() call when writing emb2pid, to bound the temporaries.
+EMB2PID_CHUNKSIZE = 1 << 22
+
+# Bytes per read when scanning the collection for line offsets.
+LINE_OFFSETS_BLOCKSIZE = 1 << 26
+
+# Zero rows written after the last embedding, so that strided views of up to
+# this many tokens can start at any passage (see IndexRanker._create_views).
+EMBEDDINGS_PADDING = 512
 
 
 class IndexManager:
@@ -12,6 +40,9 @@ class IndexManager:
     def save(self, tensor, path_prefix):
         torch.save(tensor, path_prefix)
 
+    def save_doclens(self, doclens, path):
+        np.asarray(doclens, dtype=DOCLENS_DTYPE).tofile(path)
+
 
 def load_index_part(filename, verbose=True):
     part = torch.load(filename)
@@ -20,3 +51,342 @@ def load_index_part(filename, verbose=True):
         part = torch.cat(part)
 
     return part
+
+
+def save_contiguous_index(directory, dim, append=False):
+    """
+    Stream the per-part embeddings into a single raw float16 file (row-major, `dim` columns),
+    followed by EMBEDDINGS_PADDING zero rows, and describe its layout in a JSON sidecar.
+    Only one part is held in memory at a time.
+
+    With `append`, only the parts that are not yet in the file are written, in place of its
+    padding. Either way, the file is written to a copy that replaces it atomically, so processes
+    that have it mapped keep reading the old one, and the sidecar is replaced last, so an
+    interrupted run can simply be re-run.
+    """
+
+    parts, parts_paths, _ = get_parts(directory)
+
+    embeddings_path = os.path.join(directory, EMBEDDINGS_FILENAME)
+    metadata_path = os.path.join(directory, EMBEDDINGS_METADATA_FILENAME)
+
+    layout = []
+    doc_offset, emb_offset = 0, 0
+
+    if append:
+        with open(metadata_path) as f:
+            metadata = ujson.load(f)
+
+        assert metadata["dim"] == dim, (metadata["dim"], dim)
+
+        layout = metadata["parts"]
+        doc_offset, emb_offset = layout[-1]["doc_endpos"], layout[-1]["emb_endpos"]
+
+        print_message(f"#> Appending parts {len(layout)}.. to", embeddings_path, "..")
+
+        shutil.copyfile(embeddings_path, embeddings_path + ".tmp")
+
+        f = open(embeddings_path + ".tmp", "r+b")
+        f.truncate(emb_offset * dim * 2)
+        f.seek(0, os.SEEK_END)
+    else:
+        print_message("#> Writing the contiguous embeddings to", embeddings_path, "..")
+
+        f = open(embeddings_path + ".tmp", "wb")
+
+    with f:
+        for part_idx, filename in zip(parts[len(layout) :], parts_paths[len(layout) :]):
+            print_message("#> Appending", filename, "...")
+
+            doclens = load_part_doclens(directory, part_idx)
+            num_embeddings = int(doclens.sum())
+
+            part = load_index_part(filename).to(dtype=torch.float16).contiguous()
+            assert part.size() == (num_embeddings, dim), (part.size(), num_embeddings)
+
+            f.write(part.numpy().data)
+
+            layout.append(
+                {
+                    "doc_offset": doc_offset,
+                    "doc_endpos": doc_offset + len(doclens),
+                    "emb_offset": emb_offset,
+                    "emb_endpos": emb_offset + part.size(0),
+                }
+            )
+
+            doc_offset += len(doclens)
+            emb_offset += part.size(0)
+
+        f.write(bytes(EMBEDDINGS_PADDING * dim * 2))
+
+        # On disk before it replaces the old file.
+        f.flush()
+        os.fsync(f.fileno())
+
+    metadata = {
+        "dim": dim,
+        "dtype": "float16",
+        "num_embeddings": emb_offset,
+        "padding": EMBEDDINGS_PADDING,
+        "parts": layout,
+    }
+
+    with open(metadata_path + ".tmp", "w") as f:
+        ujson.dump(metadata, f)
+
+    os.replace(embeddings_path + ".tmp", embeddings_path)
+    os.replace(metadata_path + ".tmp", metadata_path)
+
+    print_message(f"#> Wrote {emb_offset} embeddings for {doc_offset} passages.")
+
+    return metadata
+
+
+def load_contiguous_index(directory):
+    """
+    Memory-map the file written by save_contiguous_index(). Returns (None, None) for indexes
+    that only have per-part .pt files.
+
+    The mapping is private and read-only in practice, so pages come straight from (and stay in)
+    the OS page cache, shared by every process that serves the same index.
+    """
+
+    metadata_path = os.path.join(directory, EMBEDDINGS_METADATA_FILENAME)
+
+    if not os.path.exists(metadata_path):
+        return None, None
+
+    with open(metadata_path) as f:
+        metadata = ujson.load(f)
+
+    assert metadata["dtype"] == "float16", metadata["dtype"]
+
+    dim = metadata["dim"]
+    num_rows = metadata["num_embeddings"] + metadata["padding"]
+
+    tensor = torch.from_file(
+        os.path.join(directory, EMBEDDINGS_FILENAME),
+        shared=False,
+        size=num_rows * dim,
+        dtype=torch.float16,
+    )
+
+    return tensor.view(num_rows, dim), metadata
+
+
+def save_doclens_arrays(directory):
+    """
+    Concatenate the per-part doclens into doclens.bin and write their prefix sum (with a leading
+    zero) to doclens_pfxsum.bin. Parts that only have doclens.{part}.json also get a .bin copy.
+    """
+
+    parts, _, _ = get_parts(directory)
+
+    doclens_path = os.path.join(directory, DOCLENS_FILENAME)
+    doclens_pfxsum_path = os.path.join(directory, DOCLENS_PFXSUM_FILENAME)
+
+    print_message("#> Writing", doclens_path, "and", doclens_pfxsum_path, "..")
+
+    num_docs, num_embeddings = 0, 0
+
+    with open(doclens_path + ".tmp", "wb") as f, open(
+        doclens_pfxsum_path + ".tmp", "wb"
+    ) as g:
+        g.write(np.zeros(1, dtype=DOCLENS_PFXSUM_DTYPE).data)
+
+        for part in parts:
+            part_doclens = load_part_doclens(directory, part)
+
+            part_doclens_path = get_part_doclens_path(directory, part)
+            if not os.path.exists(part_doclens_path):
+                part_doclens.tofile(part_doclens_path)
+
+            part_pfxsum = np.cumsum(part_doclens, dtype=DOCLENS_PFXSUM_DTYPE)
+            part_pfxsum += num_embeddings
+
+            f.write(part_doclens.data)
+            g.write(part_pfxsum.data)
+
+            num_docs += len(part_doclens)
+            num_embeddings += int(part_doclens.sum(dtype=DOCLENS_PFXSUM_DTYPE))
+
+    os.replace(doclens_path + ".tmp", doclens_path)
+    os.replace(doclens_pfxsum_path + ".tmp", doclens_pfxsum_path)
+
+    print_message(
+        f"#> Wrote the doclens of {num_docs} passages ({num_embeddings} embeddings)."
+    )
+
+
+def get_emb2pid_path(faiss_index_path):
+    return faiss_index_path + ".emb2pid"
+
+
+def get_emb2pid_dtype(num_embeddings, pid_endpos):
+    return torch.int32 if max(num_embeddings, pid_endpos) < (1 << 31) else torch.int64
+
+
+def build_emb2pid(doclens, pid_offset=0, dtype=None):
+    """
+    Map every embedding of the passages `pid_offset + i` (with lengths `doclens[i]`) to its pid.
+    """
+
+    doclens = torch.as_tensor(doclens).long()
+    pid_endpos = pid_offset + doclens.size(0)
+
+    if dtype is None:
+        dtype = get_emb2pid_dtype(doclens.sum().item(), pid_endpos)
+
+    pids = torch.arange(pid_offset, pid_endpos, dtype=dtype)
+
+    return torch.repeat_interleave(pids, doclens)
+
+
+def save_emb2pid(path, doclens, pid_offset=0):
+    """
+    Write the raw emb2pid table of build_emb2pid() to `path`, a chunk of passages at a time.
+    Its dtype (int32, or int64 past 2^31 embeddings or pids) is implied by the file size.
+    """
+
+    num_embeddings = int(np.sum(doclens, dtype=np.int64))
+    dtype = get_emb2pid_dtype(num_embeddings, pid_offset + len(doclens))
+
+    print_message(f"#> Writing emb2pid ({num_embeddings} x {dtype}) to {path} ..")
+
+    with open(path + ".tmp", "wb") as f:
+        for offset in range(0, len(doclens), EMB2PID_CHUNKSIZE):
+            endpos = min(offset + EMB2PID_CHUNKSIZE, len(doclens))
+
+            emb2pid = build_emb2pid(
+                np.asarray(doclens[offset:endpos]), pid_offset + offset, dtype=dtype
+            )
+            f.write(emb2pid.numpy().data)
+
+    os.replace(path + ".tmp", path)
+
+
+def load_emb2pid(path, num_embeddings):
+    """
+    Memory-map the file written by save_emb2pid(). Returns None if it does not exist.
+    """
+
+    if not os.path.exists(path):
+        return None
+
+    size = os.path.getsize(path)
+    dtypes = {num_embeddings * 4: torch.int32, num_embeddings * 8: torch.int64}
+
+    assert size in dtypes, f"{path} does not match {num_embeddings} embeddings."
+
+    return torch.from_file(path, shared=False, size=num_embeddings, dtype=dtypes[size])
+
+
+def save_line_offsets(collection_path, directory):
+    """
+    Write the byte offset of the start of every line of the collection, followed by its size, as
+    an int64 .npy array, so that each process can seek to its own lines (see load_line_offsets).
+    """
+
+    path = os.path.join(directory, LINE_OFFSETS_FILENAME)
+    print_message("#> Indexing the lines of", collection_path, "into", path, "..")
+
+    offsets = [np.zeros(1, dtype=np.int64)]
+    size = 0
+
+    # Lines end as in text mode (universal newlines), which the encoder reads otherwise: at
+    # "\n", "\r\n" and a lone "\r". A "\r" at the end of a block is settled by the next one.
+    pending_cr = False
+
+    with open(collection_path, "rb") as f:
+        for block in iter(lambda: f.read(LINE_OFFSETS_BLOCKSIZE), b""):
+            data = np.frombuffer(block, dtype=np.uint8)
+            lf, cr = data == ord("\n"), data == ord("\r")
+
+            if pending_cr and not lf[0]:
+                offsets.append(np.array([size], dtype=np.int64))
+
+            lone_cr = cr.copy()
+            lone_cr[:-1] &= ~lf[1:]
+            lone_cr[-1] = False
+            pending_cr = bool(cr[-1])
+
+            newlines = np.flatnonzero(lf | lone_cr)
+            offsets.append(newlines.astype(np.int64) + (size + 1))
+            size += len(block)
+
+    if pending_cr:
+        offsets.append(np.array([size], dtype=np.int64))
+
+    offsets = np.concatenate(offsets)
+
+    # Without a trailing newline, the last line ends at EOF.
+    if offsets[-1] != size:
+        offsets = np.append(offsets, size)
+
+    with open(path + ".tmp", "wb") as f:
+        np.save(f, offsets)
+
+    os.replace(path + ".tmp", path)
+
+    print_message(f"#> Found {len(offsets) - 1} lines.")
+
+
+def save_deleted(directory, pids, num_docs, deleted=True):
+    """
+    Mark `pids` as deleted (or, with deleted=False, live again) in the bitmap of load_deleted(),
+    which is rewritten atomically. Returns the number of deleted pids.
+    """
+
+    path = os.path.join(directory, DELETED_FILENAME)
+
+    bitmap = load_deleted(directory, num_docs)
+    bitmap = (
+        np.zeros(num_docs, dtype=np.bool_) if bitmap is None else bitmap.numpy().copy()
+    )
+
+    pids = np.asarray(pids, dtype=np.int64)
+    assert ((pids >= 0) & (pids < num_docs)).all(), "Out-of-range pids!"
+
+    bitmap[pids] = deleted
+
+    with open(path + ".tmp", "wb") as f:
+        f.write(np.packbits(bitmap, bitorder="little").data)
+
+    os.replace(path + ".tmp", path)
+
+    return int(bitmap.sum())
+
+
+def save_token_df(directory, output_path):
+    """
+    Count, from the .tokenids of the index in `directory`, the passages each token occurs in,
+    for TokenPruner's IDF (see load_token_df()).
+    """
+
+    parts, _, _ = get_parts(directory)
+
+    df, num_docs = np.zeros(0, dtype=np.int64), 0
+
+    for part in parts:
+        ids = load_index_part(
+            os.path.join(directory, "{}.tokenids".format(part))
+        ).long()
+        doclens = torch.from_numpy(load_part_doclens(directory, part)).long()
+
+        # Count every (passage, token) pair once.
+        vocab_size = int(ids.max()) + 1 if ids.numel() > 0 else 0
+        pids = torch.repeat_interleave(torch.arange(len(doclens)), doclens)
+        ids = torch.unique(pids * vocab_size + ids) % max(vocab_size, 1)
+
+        part_df = np.bincount(ids.numpy(), minlength=vocab_size)
+        df = np.pad(df, (0, max(len(part_df) - len(df), 0)))
+        df[: len(part_df)] += part_df
+
+        num_docs += len(doclens)
+
+    np.savez(output_path, num_docs=num_docs, df=df)
+
+    print_message(
+        f"#> Saved the document frequencies of {len(df)} tokens to {output_path}."
+    )
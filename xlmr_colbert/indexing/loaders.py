@@ -1,11 +1,21 @@
 import os
 import torch
 import ujson
+import numpy as np
 
 from math import ceil
 from itertools import accumulate
 from xlmr_colbert.utils.utils import print_message
 
+DOCLENS_FILENAME = "doclens.bin"
+DOCLENS_PFXSUM_FILENAME = "doclens_pfxsum.bin"
+LINE_OFFSETS_FILENAME = "collection.offsets.npy"
+DELETED_FILENAME = "deleted.bin"
+ALIASES_FILENAME = "aliases.npy"
+
+DOCLENS_DTYPE = np.int32
+DOCLENS_PFXSUM_DTYPE = np.int64
+
 
 def get_parts(directory):
     extension = ".pt"
@@ -32,16 +42,154 @@ def get_parts(directory):
     return parts, parts_paths, samples_paths
 
 
+def get_part_doclens_path(directory, part, binary=True):
+    extension = "bin" if binary else "json"
+    return os.path.join(directory, "doclens.{}.{}".format(part, extension))
+
+
+def load_part_doclens(directory, part):
+    """
+    Read the doclens of one part, from doclens.{part}.bin or (older indexes) doclens.{part}.json.
+    """
+
+    path = get_part_doclens_path(directory, part)
+
+    if os.path.exists(path):
+        return np.fromfile(path, dtype=DOCLENS_DTYPE)
+
+    with open(get_part_doclens_path(directory, part, binary=False)) as f:
+        return np.array(ujson.load(f), dtype=DOCLENS_DTYPE)
+
+
+def load_parts_num_docs(directory, parts):
+    num_docs = []
+
+    for part in parts:
+        path = get_part_doclens_path(directory, part)
+
+        if os.path.exists(path):
+            num_docs.append(os.path.getsize(path) // np.dtype(DOCLENS_DTYPE).itemsize)
+        else:
+            num_docs.append(len(load_part_doclens(directory, part)))
+
+    return num_docs
+
+
 def load_doclens(directory, flatten=True):
     parts, _, _ = get_parts(directory)
 
-    doclens_filenames = [
-        os.path.join(directory, "doclens.{}.json".format(filename))
-        for filename in parts
-    ]
-    all_doclens = [ujson.load(open(filename)) for filename in doclens_filenames]
+    all_doclens = [load_part_doclens(directory, part).tolist() for part in parts]
 
     if flatten:
         all_doclens = [x for sub_doclens in all_doclens for x in sub_doclens]
 
     return all_doclens
+
+
+def load_doclens_arrays(directory, memmap=True):
+    """
+    Returns (doclens, doclens_pfxsum, parts_doc_offsets) for the whole index, where
+    doclens_pfxsum[pid] is the offset of the first embedding of `pid` and
+    parts_doc_offsets[part] is the first pid of `part` (with the total count appended).
+
+    The two arrays are memory-mapped copy-on-write from doclens.bin and doclens_pfxsum.bin
+    when present (and `memmap`), and rebuilt from the per-part doclens otherwise.
+    """
+
+    parts, _, _ = get_parts(directory)
+    parts_doc_offsets = [0] + list(accumulate(load_parts_num_docs(directory, parts)))
+
+    doclens_path = os.path.join(directory, DOCLENS_FILENAME)
+    doclens_pfxsum_path = os.path.join(directory, DOCLENS_PFXSUM_FILENAME)
+
+    if memmap and os.path.exists(doclens_path) and os.path.exists(doclens_pfxsum_path):
+        doclens = np.memmap(doclens_path, dtype=DOCLENS_DTYPE, mode="c")
+        doclens_pfxsum = np.memmap(
+            doclens_pfxsum_path, dtype=DOCLENS_PFXSUM_DTYPE, mode="c"
+        )
+
+        assert len(doclens) == parts_doc_offsets[-1], "Stale doclens.bin!"
+        assert len(doclens_pfxsum) == len(doclens) + 1
+
+        return doclens, doclens_pfxsum, parts_doc_offsets
+
+    print_message(f"#> Reading the per-part doclens of {directory} ..")
+
+    doclens = np.concatenate(
+        [np.zeros(0, dtype=DOCLENS_DTYPE)]
+        + [load_part_doclens(directory, part) for part in parts]
+    )
+
+    doclens_pfxsum = np.zeros(len(doclens) + 1, dtype=DOCLENS_PFXSUM_DTYPE)
+    np.cumsum(doclens, out=doclens_pfxsum[1:])
+
+    return doclens, doclens_pfxsum, parts_doc_offsets
+
+
+def load_line_offsets(directory):
+    """
+    The array written by save_line_offsets(): line i of the collection spans the bytes
+    offsets[i] to offsets[i+1]. Returns None if there is none.
+    """
+
+    path = os.path.join(directory, LINE_OFFSETS_FILENAME)
+
+    if not os.path.exists(path):
+        return None
+
+    return np.load(path, mmap_mode="r")
+
+
+def load_deleted(directory, num_docs):
+    """
+    The bitmap of deleted pids written by save_deleted(), as a [num_docs] bool tensor, or None
+    if nothing was ever deleted. Pids past the end of the bitmap (e.g., appended since) are live.
+    """
+
+    path = os.path.join(directory, DELETED_FILENAME)
+
+    if not os.path.exists(path):
+        return None
+
+    bitmap = np.memmap(path, dtype=np.uint8, mode="r")
+    deleted = np.unpackbits(bitmap, count=num_docs, bitorder="little")
+
+    return torch.from_numpy(deleted.view(np.bool_))
+
+
+class AliasTable:
+    """
+    The memory-mapped table of save_aliases(), indexed with tensors of pids. Pids past its end
+    (e.g., appended since) are their own canonical pids.
+    """
+
+    def __init__(self, table):
+        self.table = table
+
+    def __getitem__(self, pids):
+        pids = torch.as_tensor(pids)
+        canonical = pids.clone()
+
+        known = pids < len(self.table)
+        canonical[known] = torch.from_numpy(
+            np.asarray(self.table[pids[known].numpy()], dtype=np.int64)
+        )
+
+        return canonical
+
+
+def load_aliases(directory):
+    """
+    The canonical pid of every pid, as written by save_aliases(), or None without deduplication.
+    A duplicate passage has no embeddings of its own (its doclen is zero) and is scored through
+    its canonical pid, the first one with the same text.
+
+    The table is memory-mapped, so the processes that serve an index share its pages.
+    """
+
+    path = os.path.join(directory, ALIASES_FILENAME)
+
+    if not os.path.exists(path):
+        return None
+
+    return AliasTable(np.load(path, mmap_mode="r"))
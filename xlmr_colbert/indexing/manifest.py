@@ -0,0 +1,96 @@
+import os
+import zlib
+import ujson
+
+from xlmr_colbert.utils.utils import print_message
+
+CHECKSUM_BLOCKSIZE = 1 << 24
+
+
+def get_manifest_path(directory, process_idx, part_offset=0):
+    if part_offset > 0:
+        filename = "manifest.append-{}.{}.json".format(part_offset, process_idx)
+    else:
+        filename = "manifest.{}.json".format(process_idx)
+
+    return os.path.join(directory, filename)
+
+
+def checksum_file(path):
+    crc32 = 0
+
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(CHECKSUM_BLOCKSIZE), b""):
+            crc32 = zlib.crc32(block, crc32)
+
+    return crc32
+
+
+class Manifest:
+    """
+    The parts saved by one indexing process, with the size and CRC-32 of each of their files.
+    It is rewritten atomically after every part, so that index.py --resume can skip the parts
+    that were fully saved before a crash.
+
+    `settings` are whatever determines the parts (e.g., their sizes and owners): resuming
+    under different settings is an error.
+    """
+
+    def __init__(self, directory, process_idx, settings, part_offset=0):
+        self.directory = directory
+        self.path = get_manifest_path(directory, process_idx, part_offset)
+        self.settings = settings
+        self.parts = {}
+
+    def load(self):
+        if not os.path.exists(self.path):
+            print_message(f"#> No manifest at {self.path}, nothing to resume.")
+            return
+
+        with open(self.path) as f:
+            manifest = ujson.load(f)
+
+        assert manifest["settings"] == self.settings, (
+            "Cannot resume with different settings.",
+            manifest["settings"],
+            self.settings,
+        )
+
+        for part, files in manifest["parts"].items():
+            if all(self._is_valid(filename, v) for filename, v in files.items()):
+                self.parts[int(part)] = files
+            else:
+                print_message(f"#> Part #{part} is incomplete, it will be re-encoded.")
+
+        print_message(f"#> Resuming after {len(self.parts)} complete parts.")
+
+    def _is_valid(self, filename, expected):
+        path = os.path.join(self.directory, filename)
+
+        return (
+            os.path.exists(path)
+            and os.path.getsize(path) == expected["size"]
+            and checksum_file(path) == expected["crc32"]
+        )
+
+    def add(self, part, paths):
+        self.parts[part] = {
+            os.path.basename(path): {
+                "size": os.path.getsize(path),
+                "crc32": checksum_file(path),
+            }
+            for path in paths
+        }
+
+        manifest = {
+            "settings": self.settings,
+            "parts": {str(part): files for part, files in sorted(self.parts.items())},
+        }
+
+        with open(self.path + ".tmp", "w") as f:
+            ujson.dump(manifest, f, indent=4)
+
+        os.replace(self.path + ".tmp", self.path)
+
+    def __contains__(self, part):
+        return part in self.parts
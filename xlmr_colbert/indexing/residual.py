@@ -0,0 +1,175 @@
+import os
+import torch
+import numpy as np
+
+from xlmr_colbert.utils.utils import print_message
+
+RESIDUAL_CODEC_FILENAME = "residual.codec.pt"
+
+# Entries of the (rows x centroids) fp32 score matrix per block when assigning embeddings to
+# their nearest centroids, i.e., 1 GiB however many centroids there are.
+COMPRESSION_BUDGET = 1 << 28
+
+
+def get_codes_path(directory, part):
+    return os.path.join(directory, "{}.codes".format(part))
+
+
+def get_residuals_path(directory, part):
+    return os.path.join(directory, "{}.residuals".format(part))
+
+
+class ResidualCodec:
+    """
+    Stores each embedding as the id of its nearest centroid (of a trained FAISS quantizer) and
+    its residual, with every dimension quantized to one of 2**nbits buckets and bit-packed: at
+    dim=128, 4 + 16 * nbits bytes instead of 256. Bucket boundaries and values are quantiles of
+    the residuals of a training sample.
+    """
+
+    def __init__(self, centroids, bucket_cutoffs, bucket_weights, nbits):
+        self.centroids = centroids
+        self.bucket_cutoffs = bucket_cutoffs
+        self.bucket_weights = bucket_weights
+        self.nbits = nbits
+        self.dim = centroids.size(-1)
+
+        assert (self.dim * nbits) % 8 == 0, (self.dim, nbits)
+        assert bucket_weights.size(0) == 1 << nbits
+
+        self.device = centroids.device
+        self.bit_shifts = torch.arange(nbits, device=self.device, dtype=torch.uint8)
+        self.byte_shifts = torch.arange(8, device=self.device, dtype=torch.uint8)
+
+    @classmethod
+    def train(cls, centroids, sample, nbits):
+        centroids = torch.as_tensor(centroids).float()
+        sample = torch.as_tensor(sample).float()
+
+        codec = cls(
+            centroids, torch.zeros((1 << nbits) - 1), torch.zeros(1 << nbits), nbits
+        )
+        residuals = (sample - centroids[codec.assign(sample)]).flatten().numpy()
+
+        num_buckets = 1 << nbits
+        cutoffs = np.quantile(residuals, np.arange(1, num_buckets) / num_buckets)
+        weights = np.quantile(residuals, (np.arange(num_buckets) + 0.5) / num_buckets)
+
+        print_message(f"#> Residual bucket cutoffs = {cutoffs}, weights = {weights}")
+
+        return cls(
+            centroids,
+            torch.from_numpy(cutoffs).float(),
+            torch.from_numpy(weights).float(),
+            nbits,
+        )
+
+    @classmethod
+    def load(cls, directory, device="cpu"):
+        state = torch.load(os.path.join(directory, RESIDUAL_CODEC_FILENAME))
+
+        return cls(
+            state["centroids"].to(device),
+            state["bucket_cutoffs"].to(device),
+            state["bucket_weights"].to(device),
+            state["nbits"],
+        )
+
+    def save(self, directory):
+        state = {
+            "centroids": self.centroids.cpu(),
+            "bucket_cutoffs": self.bucket_cutoffs.cpu(),
+            "bucket_weights": self.bucket_weights.cpu(),
+            "nbits": self.nbits,
+        }
+
+        torch.save(state, os.path.join(directory, RESIDUAL_CODEC_FILENAME))
+
+    def to(self, device):
+        return ResidualCodec(
+            self.centroids.to(device),
+            self.bucket_cutoffs.to(device),
+            self.bucket_weights.to(device),
+            self.nbits,
+        )
+
+    def assign(self, embs):
+        """
+        The nearest (in L2) centroid of every row of `embs`.
+        """
+
+        half_norms = (self.centroids**2).sum(-1) / 2
+        bsize = max(1, COMPRESSION_BUDGET // self.centroids.size(0))
+
+        return torch.cat(
+            [
+                (block.float() @ self.centroids.T - half_norms).argmax(-1)
+                for block in embs.split(bsize)
+            ]
+        )
+
+    def compress(self, embs):
+        codes = self.assign(embs)
+
+        residuals = embs.float() - self.centroids[codes]
+        buckets = torch.bucketize(residuals, self.bucket_cutoffs).to(torch.uint8)
+
+        # [n, dim] buckets -> [n, dim * nbits] bits -> [n, dim * nbits / 8] bytes
+        bits = (buckets.unsqueeze(-1) >> self.bit_shifts) & 1
+        bits = bits.reshape(embs.size(0), -1, 8)
+        packed = (bits << self.byte_shifts).sum(-1, dtype=torch.uint8)
+
+        return codes.int(), packed
+
+    def decompress(self, codes, packed):
+        bits = (packed.unsqueeze(-1) >> self.byte_shifts) & 1
+        bits = bits.reshape(packed.size(0), self.dim, self.nbits)
+        buckets = (bits << self.bit_shifts).sum(-1).long()
+
+        embs = self.centroids[codes.long()] + self.bucket_weights[buckets]
+        embs = torch.nn.functional.normalize(embs, p=2, dim=-1)
+
+        return embs.half()
+
+
+class ResidualTensor:
+    """
+    A read-only stand-in for the [num_embeddings, dim] float16 tensor of IndexRanker, whose
+    rows are only decompressed when gathered (as segmented_maxsim does). Slicing rows keeps
+    them compressed.
+    """
+
+    def __init__(self, codec, codes, residuals):
+        assert codes.size(0) == residuals.size(0)
+
+        self.codec = codec
+        self.codes = codes
+        self.residuals = residuals
+        self.dtype = torch.float16
+
+    @property
+    def device(self):
+        return self.codes.device
+
+    @property
+    def nbytes(self):
+        return (
+            self.codes.numel() * self.codes.element_size()
+            + self.residuals.numel() * self.residuals.element_size()
+        )
+
+    def size(self, dim=None):
+        size = torch.Size((self.codes.size(0), self.codec.dim))
+
+        return size if dim is None else size[dim]
+
+    def to(self, device):
+        return ResidualTensor(
+            self.codec.to(device), self.codes.to(device), self.residuals.to(device)
+        )
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return ResidualTensor(self.codec, self.codes[index], self.residuals[index])
+
+        return self.codec.decompress(self.codes[index], self.residuals[index])
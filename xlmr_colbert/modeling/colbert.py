@@ -4,10 +4,11 @@ import torch.nn as nn
 from transformers import (
     RobertaPreTrainedModel,
     XLMRobertaConfig,
-    XLMRobertaTokenizer,
     XLMRobertaModel,
 )
 from xlmr_colbert.parameters import DEVICE
+from xlmr_colbert.modeling.tokenization import load_tokenizer
+from xlmr_colbert.modeling.pruning import punctuation_token_ids
 
 
 class ColBERT(RobertaPreTrainedModel):
@@ -33,9 +34,15 @@ class ColBERT(RobertaPreTrainedModel):
         self.mask_punctuation = mask_punctuation
         self.skiplist = {}
 
-        self.tokenizer = XLMRobertaTokenizer.from_pretrained("xlm-roberta-large")
-        self.tokenizer.add_tokens(["[unused1]"])
-        self.tokenizer.add_tokens(["[unused2]"])
+        self.tokenizer = load_tokenizer()
+
+        if self.mask_punctuation:
+            self.skiplist = {w: True for w in punctuation_token_ids(self.tokenizer)}
+
+        self.skiplist_ids = torch.tensor(list(self.skiplist), dtype=torch.long)
+
+        # The (index-time) TokenPruner of documents, see CollectionEncoder.
+        self.pruner = None
 
         self.roberta = XLMRobertaModel(config)
         # self.roberta.resize_token_embeddings(len(self.tokenizer))
@@ -60,20 +67,33 @@ class ColBERT(RobertaPreTrainedModel):
 
         return torch.nn.functional.normalize(Q, p=2, dim=2)
 
-    def doc(self, input_ids, attention_mask, keep_dims=True):
+    def doc(self, input_ids, attention_mask, keep_dims=True, with_ids=False):
+        """
+        Without `keep_dims`, a list of the embeddings of the tokens kept of every passage (and,
+        `with_ids`, a list of their ids), after any pruning.
+        """
+
         input_ids, attention_mask = input_ids.to(DEVICE), attention_mask.to(DEVICE)
         D = self.roberta(input_ids, attention_mask=attention_mask)[0]
         D = self.linear(D)
 
-        mask = torch.tensor(self.mask(input_ids), device=DEVICE).unsqueeze(2).float()
-        D = D * mask
+        mask = self.mask(input_ids)
+
+        if not keep_dims and self.pruner is not None:
+            mask &= self.pruner.keep(input_ids, D)
+
+        D = D * mask.unsqueeze(2).float()
 
         D = torch.nn.functional.normalize(D, p=2, dim=2)
 
         if not keep_dims:
-            D, mask = D.cpu().to(dtype=torch.float16), mask.cpu().bool().squeeze(-1)
+            D, mask = D.cpu().to(dtype=torch.float16), mask.cpu()
             D = [d[mask[idx]] for idx, d in enumerate(D)]
 
+            if with_ids:
+                ids = [d[mask[idx]] for idx, d in enumerate(input_ids.cpu())]
+                return D, ids
+
         return D
 
     def score(self, Q, D):
@@ -88,8 +108,7 @@ class ColBERT(RobertaPreTrainedModel):
         )
 
     def mask(self, input_ids):
-        mask = [
-            [(x not in self.skiplist) and (x != 1) for x in d]
-            for d in input_ids.cpu().tolist()
-        ]
-        return mask
+        if self.skiplist_ids.device != input_ids.device:
+            self.skiplist_ids = self.skiplist_ids.to(input_ids.device)
+
+        return (input_ids != 1) & ~torch.isin(input_ids, self.skiplist_ids)
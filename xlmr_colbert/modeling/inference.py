@@ -61,55 +61,80 @@ class ModelInference:
         return self.query(input_ids, attention_mask)
 
     def docFromText(
-        self, docs, bsize=None, keep_dims=True, to_cpu=False, with_ids=False
+        self,
+        docs,
+        bsize=None,
+        keep_dims=True,
+        to_cpu=False,
+        with_ids=False,
+        max_tokens=None,
     ):
-        if bsize:
+        if bsize or max_tokens:
             # print("docFromText on %d documents" % len(docs))
-            batch_ids, reverse_indices = self.doc_tokenizer.tensorize(docs, bsize=bsize)
-            # batch_ids contain batches; each batch is a 2-tuple, of which the left is
-            # the ids of each document, and the right is the masks of each document
-            # print("tokens doc 0: %d" % len(batch_ids[0][0][0]))
-            # print("total tokens %d" % sum([len(d) for ids, mark in batch_ids for d in ids]))
-            # batch_ids = [ input_ids for input_ids in batches]
-
-            # print("batch_ids len=%d" % len(batch_ids))
-            # print("reverse_indices.shape=" + str(reverse_indices.shape))
-
-            batches = [
-                self.doc(input_ids, attention_mask, keep_dims=keep_dims, to_cpu=to_cpu)
-                for input_ids, attention_mask in tqdm(batch_ids)
-            ]
-            # print("batches len = %d " % len(batches))
-
-            if keep_dims:
-                D = _stack_3D_tensors(batches)
-                if with_ids:
-                    Dids = _stack_3D_tensors(batch_ids)
-                    return D[reverse_indices], Dids
-                return D[reverse_indices]
-            # print(batches[0][0])
-            D = [d for batch in batches for d in batch]
-            # print("lenD = %d " % len(D))
-            if with_ids:
-                # the masking code assumes that args.mask_punctuation is false.
-                assert len(self.colbert.skiplist) == 0
-
-                D_i = [
-                    d[(mask > 0) & (d != 1)]
-                    for input_ids, attention_masks in batch_ids
-                    for d, mask in zip(input_ids, attention_masks)
-                ]
-                # print("len D_i = %d" % len(D_i))
-                left = [D[idx] for idx in reverse_indices.tolist()]
-                right = [D_i[idx] for idx in reverse_indices.tolist()]
-                return left, right
-            return [D[idx] for idx in reverse_indices.tolist()]
+            batch_ids, reverse_indices = self.doc_tokenizer.tensorize(
+                docs, bsize=bsize, max_tokens=max_tokens
+            )
+            return self.docFromTensorized(
+                batch_ids, reverse_indices, keep_dims, to_cpu, with_ids
+            )
 
         input_ids, attention_mask = self.doc_tokenizer.tensorize(docs)
         if with_ids:
             return self.doc(input_ids, attention_mask, keep_dims=keep_dims), input_ids
         return self.doc(input_ids, attention_mask, keep_dims=keep_dims)
 
+    def docFromTensorized(
+        self, batch_ids, reverse_indices, keep_dims=True, to_cpu=False, with_ids=False
+    ):
+        """
+        The second half of docFromText(docs, bsize=...): encode the output of
+        DocTokenizer.tensorize(docs, bsize=...), e.g. as tokenized ahead by another thread.
+        """
+
+        # batch_ids contain batches; each batch is a 2-tuple, of which the left is
+        # the ids of each document, and the right is the masks of each document
+        # print("tokens doc 0: %d" % len(batch_ids[0][0][0]))
+        # print("total tokens %d" % sum([len(d) for ids, mark in batch_ids for d in ids]))
+        # batch_ids = [ input_ids for input_ids in batches]
+
+        # print("batch_ids len=%d" % len(batch_ids))
+        # print("reverse_indices.shape=" + str(reverse_indices.shape))
+
+        # batch_ids may be a generator that pads each batch as it is drawn.
+        if keep_dims and with_ids:
+            batch_ids = list(batch_ids)
+
+        batches = [
+            self.doc(
+                input_ids,
+                attention_mask,
+                keep_dims=keep_dims,
+                to_cpu=to_cpu,
+                with_ids=with_ids and not keep_dims,
+            )
+            for input_ids, attention_mask in tqdm(batch_ids)
+        ]
+        # print("batches len = %d " % len(batches))
+
+        if keep_dims:
+            D = _stack_3D_tensors(batches)
+            if with_ids:
+                Dids = _stack_3D_tensors(batch_ids)
+                return D[reverse_indices], Dids
+            return D[reverse_indices]
+        # print(batches[0][0])
+        if with_ids:
+            # The ids of exactly the tokens kept by ColBERT.doc (e.g., after pruning).
+            D = [d for batch, _ in batches for d in batch]
+            D_i = [d for _, ids in batches for d in ids]
+            # print("len D_i = %d" % len(D_i))
+            left = [D[idx] for idx in reverse_indices.tolist()]
+            right = [D_i[idx] for idx in reverse_indices.tolist()]
+            return left, right
+        D = [d for batch in batches for d in batch]
+        # print("lenD = %d " % len(D))
+        return [D[idx] for idx in reverse_indices.tolist()]
+
     #    def docFromText(self, docs, bsize=None, keep_dims=True, to_cpu=False):
     #        if bsize:
     #            batches, reverse_indices = self.doc_tokenizer.tensorize(docs, bsize=bsize)
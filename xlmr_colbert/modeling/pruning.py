@@ -0,0 +1,164 @@
+import torch
+import unicodedata
+import numpy as np
+
+# The sentencepiece marker of the first piece of a word.
+WORD_START = "▁"
+
+
+def punctuation_token_ids(tokenizer):
+    """
+    The ids of the tokens made only of punctuation (in any script), with or without a leading
+    WORD_START, e.g., ",", "▁," and "。".
+    """
+
+    tokens = tokenizer.convert_ids_to_tokens(list(range(len(tokenizer))))
+
+    return [
+        idx
+        for idx, token in enumerate(tokens)
+        if len(token.lstrip(WORD_START)) > 0
+        and all(
+            unicodedata.category(c).startswith("P") for c in token.lstrip(WORD_START)
+        )
+    ]
+
+
+def load_stopwords(paths):
+    stopwords = set()
+
+    for path in paths:
+        with open(path) as f:
+            stopwords.update(line.strip().lower() for line in f if line.strip())
+
+    return stopwords
+
+
+def load_token_df(path):
+    """
+    The number of passages and the per-token document frequencies written by save_token_df().
+    """
+
+    token_df = np.load(path)
+
+    return int(token_df["num_docs"]), token_df["df"]
+
+
+class TokenPruner:
+    """
+    Decides which passage tokens are not stored at indexing time (see ColBERT.doc): punctuation,
+    stopwords (only when they are whole words), tokens with an IDF below `min_idf`, by the
+    document frequencies in `token_df`, and embeddings whose norm before normalization is below
+    `min_norm`. Special tokens, like [CLS] and [D], are always kept.
+    """
+
+    def __init__(
+        self,
+        tokenizer,
+        punctuation=False,
+        stopwords=(),
+        token_df=None,
+        min_idf=None,
+        min_norm=None,
+    ):
+        self.settings = {
+            "punctuation": punctuation,
+            "stopwords": list(stopwords),
+            "token_df": token_df,
+            "min_idf": min_idf,
+            "min_norm": min_norm,
+        }
+
+        vocab_size = len(tokenizer)
+        tokens = tokenizer.convert_ids_to_tokens(list(range(vocab_size)))
+
+        protected = list(tokenizer.all_special_ids)
+        protected += tokenizer.convert_tokens_to_ids(["[unused1]", "[unused2]"])
+        punctuation_ids = punctuation_token_ids(tokenizer)
+
+        self.protected = torch.zeros(vocab_size, dtype=torch.bool)
+        self.protected[protected] = True
+
+        self.skip = torch.zeros(vocab_size, dtype=torch.bool)
+        self.stopword = torch.zeros(vocab_size, dtype=torch.bool)
+
+        # Whether a token ends the word before it.
+        self.boundary = torch.tensor([token.startswith(WORD_START) for token in tokens])
+        self.boundary[protected] = True
+        self.boundary[punctuation_ids] = True
+
+        if punctuation:
+            self.skip[punctuation_ids] = True
+
+        if len(stopwords) > 0:
+            stopwords = load_stopwords(stopwords)
+            self.stopword = torch.tensor(
+                [
+                    token.startswith(WORD_START)
+                    and token[len(WORD_START) :].lower() in stopwords
+                    for token in tokens
+                ]
+            )
+
+        if min_idf is not None:
+            assert token_df is not None, "--min_idf needs --token_df."
+
+            num_docs, df = load_token_df(token_df)
+            df = np.pad(df, (0, max(vocab_size - len(df), 0)))[:vocab_size]
+            idf = torch.from_numpy(np.log((num_docs + 1) / (df + 1)))
+
+            self.skip |= idf < min_idf
+
+        self.skip &= ~self.protected
+        self.stopword &= ~self.protected
+
+        self.min_norm = min_norm
+
+    def keep(self, input_ids, D=None):
+        """
+        The mask of the tokens of `input_ids` to store, given `D`, their embeddings before
+        normalization.
+        """
+
+        device = input_ids.device
+        if self.skip.device != device:
+            self.protected, self.skip = self.protected.to(device), self.skip.to(device)
+            self.stopword, self.boundary = self.stopword.to(device), self.boundary.to(
+                device
+            )
+
+        keep = ~self.skip[input_ids]
+
+        # A stopword may also be the first piece of a longer word.
+        next_boundary = torch.ones_like(keep)
+        next_boundary[:, :-1] = self.boundary[input_ids[:, 1:]]
+        keep &= ~(self.stopword[input_ids] & next_boundary)
+
+        if self.min_norm is not None and D is not None:
+            keep &= (D.norm(dim=-1) >= self.min_norm) | self.protected[input_ids]
+
+        return keep
+
+
+def build_pruner(tokenizer, args):
+    """
+    The TokenPruner configured by Arguments.add_index_pruning_parameters(), or None.
+    """
+
+    settings = {
+        "punctuation": getattr(args, "prune_punctuation", False),
+        "stopwords": getattr(args, "stopwords", None) or (),
+        "token_df": getattr(args, "token_df", None),
+        "min_idf": getattr(args, "min_idf", None),
+        "min_norm": getattr(args, "min_norm", None),
+    }
+
+    if not (
+        settings["punctuation"]
+        or settings["stopwords"]
+        or settings["min_idf"] is not None
+        or settings["min_norm"] is not None
+    ):
+        return None
+
+    return TokenPruner(tokenizer, **settings)
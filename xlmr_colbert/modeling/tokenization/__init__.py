@@ -3,4 +3,6 @@ from xlmr_colbert.modeling.tokenization.doc_tokenization import *
 from xlmr_colbert.modeling.tokenization.utils import (
     tensorize_triples,
     tensorize_queries_documents,
+    load_tokenizer,
+    create_tokenizer,
 )
@@ -1,17 +1,18 @@
 import torch
 
-from transformers import XLMRobertaTokenizer
+from math import ceil
 from xlmr_colbert.modeling.tokenization.utils import (
-    _split_into_batches,
-    _sort_by_length,
+    load_tokenizer,
+    create_tokenizer,
+    _sort_by_length_indices,
+    _split_by_tokens,
+    _pad_into_batches,
 )
 
 
 class DocTokenizer:
-    def __init__(self, doc_maxlen):
-        self.tok = XLMRobertaTokenizer.from_pretrained("xlm-roberta-large")
-        self.tok.add_tokens(["[unused1]"])
-        self.tok.add_tokens(["[unused2]"])
+    def __init__(self, doc_maxlen, fast=True, shared=True):
+        self.tok = load_tokenizer(fast) if shared else create_tokenizer(fast)
         self.doc_maxlen = doc_maxlen
 
         self.D_marker_token, self.D_marker_token_id = "[D]", 250003
@@ -23,7 +24,8 @@ class DocTokenizer:
     def tokenize(self, batch_text, add_special_tokens=False):
         assert type(batch_text) in [list, tuple], type(batch_text)
 
-        tokens = [self.tok.tokenize(x, add_special_tokens=False) for x in batch_text]
+        ids = self.tok(batch_text, add_special_tokens=False)["input_ids"]
+        tokens = [self.tok.convert_ids_to_tokens(lst) for lst in ids]
 
         if not add_special_tokens:
             return tokens
@@ -48,12 +50,15 @@ class DocTokenizer:
 
         return ids
 
-    def tensorize(self, batch_text, bsize=None):
+    def tensorize(self, batch_text, bsize=None, max_tokens=None):
         assert type(batch_text) in [list, tuple], type(batch_text)
 
         # add placehold for the [D] marker
         batch_text = [". " + x for x in batch_text]
 
+        if bsize or max_tokens:
+            return self._tensorize_batches(batch_text, bsize, max_tokens)
+
         obj = self.tok(
             batch_text,
             padding="longest",
@@ -67,9 +72,51 @@ class DocTokenizer:
         # postprocess for the [D] marker
         ids[:, 1] = self.D_marker_token_id
 
-        if bsize:
-            ids, mask, reverse_indices = _sort_by_length(ids, mask, bsize)
-            batches = _split_into_batches(ids, mask, bsize)
-            return batches, reverse_indices
-
         return ids, mask
+
+    def _tensorize_batches(self, batch_text, bsize, max_tokens=None):
+        """
+        Same batches as padding all of batch_text at once and then sorting and splitting it, but
+        returned as a generator that pads each batch only when it is drawn (e.g., by
+        ModelInference.docFromTensorized), so that only one padded batch is alive at a time.
+
+        With `max_tokens`, batches are instead as large as fits in `max_tokens` padded tokens,
+        and each is only as wide as its longest passage.
+        """
+
+        ids = self.tok(
+            batch_text, truncation="longest_first", max_length=self.doc_maxlen
+        )["input_ids"]
+
+        lengths = torch.tensor([len(x) for x in ids])
+
+        if max_tokens:
+            indices = lengths.sort().indices
+            reverse_indices = indices.sort().indices
+
+            sizes = _split_by_tokens(lengths[indices], max_tokens)
+            batches = _pad_into_batches(
+                ids, lengths, indices, sizes, self.tok.pad_token_id
+            )
+        else:
+            indices, reverse_indices = _sort_by_length_indices(lengths, bsize)
+
+            # Every batch keeps the width of the longest passage overall, as before, so that
+            # the embeddings stay bit-identical.
+            sizes = [bsize] * ceil(len(ids) / bsize)
+            batches = _pad_into_batches(
+                ids,
+                lengths,
+                indices,
+                sizes,
+                self.tok.pad_token_id,
+                maxlen=lengths.max().item(),
+            )
+
+        return self._add_marker(batches), reverse_indices
+
+    def _add_marker(self, batches):
+        # postprocess for the [D] marker
+        for batch_ids, batch_mask in batches:
+            batch_ids[:, 1] = self.D_marker_token_id
+            yield batch_ids, batch_mask
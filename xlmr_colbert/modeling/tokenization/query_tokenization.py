@@ -1,14 +1,11 @@
 import torch
 
-from transformers import XLMRobertaTokenizer
-from xlmr_colbert.modeling.tokenization.utils import _split_into_batches
+from xlmr_colbert.modeling.tokenization.utils import load_tokenizer, _split_into_batches
 
 
 class QueryTokenizer:
-    def __init__(self, query_maxlen):
-        self.tok = XLMRobertaTokenizer.from_pretrained("xlm-roberta-large")
-        self.tok.add_tokens(["[unused1]"])
-        self.tok.add_tokens(["[unused2]"])
+    def __init__(self, query_maxlen, fast=True):
+        self.tok = load_tokenizer(fast)
         self.query_maxlen = query_maxlen
 
         self.Q_marker_token, self.Q_marker_token_id = "[Q]", 250002
@@ -24,7 +21,8 @@ class QueryTokenizer:
     def tokenize(self, batch_text, add_special_tokens=False):
         assert type(batch_text) in [list, tuple], type(batch_text)
 
-        tokens = [self.tok.tokenize(x, add_special_tokens=False) for x in batch_text]
+        ids = self.tok(batch_text, add_special_tokens=False)["input_ids"]
+        tokens = [self.tok.convert_ids_to_tokens(lst) for lst in ids]
 
         if not add_special_tokens:
             return tokens
@@ -1,9 +1,55 @@
 import torch
 
+from functools import lru_cache
+from transformers import XLMRobertaTokenizer, XLMRobertaTokenizerFast
+
+TOKENIZER_NAME = "xlm-roberta-large"
+
+
+@lru_cache(maxsize=None)
+def load_tokenizer(fast=True):
+    """
+    The XLM-R tokenizer with the [unused1] and [unused2] tokens added, loaded once per process
+    and shared by ColBERT, QueryTokenizer and DocTokenizer. The fast (Rust) backend encodes
+    whole batches in parallel and yields the same ids as the sentencepiece one (fast=False), as
+    checked by tests/test_tokenizers.py and, on a sample of the collection, by
+    benchmarks/tokenizer.py.
+
+    Calls on the shared instance set its truncation and padding, so it must not be used from
+    several threads at once: other threads should use their own create_tokenizer().
+    """
+
+    return create_tokenizer(fast)
+
+
+def create_tokenizer(fast=True):
+    """
+    A new, unshared instance of the tokenizer of load_tokenizer().
+    """
+
+    tokenizer_class = XLMRobertaTokenizerFast if fast else XLMRobertaTokenizer
+
+    tok = tokenizer_class.from_pretrained(TOKENIZER_NAME)
+    tok.add_tokens(["[unused1]"])
+    tok.add_tokens(["[unused2]"])
+
+    return tok
+
 
 def tensorize_triples(
-    query_tokenizer, doc_tokenizer, queries, positives, negatives, bsize
+    query_tokenizer,
+    doc_tokenizer,
+    queries,
+    positives,
+    negatives,
+    bsize,
+    max_tokens=None,
 ):
+    """
+    With `max_tokens`, the triples are split into as many sub-batches as needed for each to
+    hold at most `max_tokens` (padded) passage tokens, instead of into sub-batches of `bsize`.
+    """
+
     assert len(queries) == len(positives) == len(negatives)
     assert bsize is None or len(queries) % bsize == 0
 
@@ -22,6 +68,15 @@ def tensorize_triples(
 
     (positive_ids, negative_ids), (positive_mask, negative_mask) = D_ids, D_mask
 
+    if max_tokens is not None:
+        return _split_triples_by_tokens(
+            (Q_ids, Q_mask),
+            (positive_ids, positive_mask),
+            (negative_ids, negative_mask),
+            maxlens[indices],
+            max_tokens,
+        )
+
     query_batches = _split_into_batches(Q_ids, Q_mask, bsize)
     positive_batches = _split_into_batches(positive_ids, positive_mask, bsize)
     negative_batches = _split_into_batches(negative_ids, negative_mask, bsize)
@@ -37,6 +92,32 @@ def tensorize_triples(
     return batches
 
 
+def _split_triples_by_tokens(queries, positives, negatives, maxlens, max_tokens):
+    (Q_ids, Q_mask), (p_ids, p_mask), (n_ids, n_mask) = queries, positives, negatives
+
+    batches = []
+    offset = 0
+    for size in _split_by_tokens(2 * maxlens, max_tokens):
+        endpos = offset + size
+
+        # Both passages of every triple fit in the longest one of the sub-batch.
+        width = maxlens[offset:endpos].max().item()
+
+        Q = (
+            torch.cat((Q_ids[offset:endpos], Q_ids[offset:endpos])),
+            torch.cat((Q_mask[offset:endpos], Q_mask[offset:endpos])),
+        )
+        D = (
+            torch.cat((p_ids[offset:endpos, :width], n_ids[offset:endpos, :width])),
+            torch.cat((p_mask[offset:endpos, :width], n_mask[offset:endpos, :width])),
+        )
+        batches.append((Q, D))
+
+        offset = endpos
+
+    return batches
+
+
 def tensorize_queries_documents(
     query_tokenizer,
     doc_tokenizer,
@@ -111,13 +192,19 @@ def tensorize_queries_documents(
 
 
 def _sort_by_length(ids, mask, bsize):
-    if ids.size(0) <= bsize:
-        return ids, mask, torch.arange(ids.size(0))
+    indices, reverse_indices = _sort_by_length_indices(mask.sum(-1), bsize)
 
-    indices = mask.sum(-1).sort().indices
+    return ids[indices], mask[indices], reverse_indices
+
+
+def _sort_by_length_indices(lengths, bsize):
+    if lengths.size(0) <= bsize:
+        return torch.arange(lengths.size(0)), torch.arange(lengths.size(0))
+
+    indices = lengths.sort().indices
     reverse_indices = indices.sort().indices
 
-    return ids[indices], mask[indices], reverse_indices
+    return indices, reverse_indices
 
 
 def _split_into_batches(ids, mask, bsize):
@@ -126,3 +213,44 @@ def _split_into_batches(ids, mask, bsize):
         batches.append((ids[offset : offset + bsize], mask[offset : offset + bsize]))
 
     return batches
+
+
+def _split_by_tokens(lengths, max_tokens):
+    """
+    Sizes of the consecutive batches of the (ascending) `lengths`, each as large as possible
+    with len(batch) * max(lengths in batch) <= max_tokens, or of a single item.
+    """
+
+    sizes, size = [], 0
+    for length in lengths.tolist():
+        if size > 0 and (size + 1) * length > max_tokens:
+            sizes.append(size)
+            size = 0
+
+        size += 1
+
+    return sizes + [size] if size > 0 else sizes
+
+
+def _pad_into_batches(ids, lengths, indices, sizes, pad_token_id, maxlen=None):
+    """
+    Yield the lists ids[indices[offset : offset + size]] padded into [size, maxlen] ids and
+    masks, for consecutive batch `sizes`. Without `maxlen`, each batch is as wide as its
+    longest list. Batches are only padded as they are drawn.
+    """
+
+    offset = 0
+    for size in sizes:
+        batch_indices = indices[offset : offset + size]
+        batch_lengths = lengths[batch_indices]
+        offset += size
+
+        width = batch_lengths.max().item() if maxlen is None else maxlen
+
+        mask = torch.arange(width).unsqueeze(0) < batch_lengths.unsqueeze(-1)
+        batch_ids = torch.full(mask.size(), pad_token_id, dtype=torch.long)
+        batch_ids[mask] = torch.cat(
+            [torch.tensor(ids[idx], dtype=torch.long) for idx in batch_indices.tolist()]
+        )
+
+        yield batch_ids, mask.long()
@@ -1,6 +1,6 @@
 import torch
 
-DEVICE = torch.device("cuda")
+DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
 SAVED_CHECKPOINTS = [
     32 * 1000,
@@ -11,13 +11,22 @@ from xlmr_colbert.modeling.inference import ModelInference
 from xlmr_colbert.evaluation.ranking_logger import RankingLogger
 
 from xlmr_colbert.utils.utils import print_message, flatten, zipstar
-from xlmr_colbert.indexing.loaders import get_parts
+from xlmr_colbert.indexing.loaders import get_parts, load_aliases
 from xlmr_colbert.ranking.index_part import IndexPart
+from xlmr_colbert.ranking.index_ranker import BUFFER_POOL
 
 # MAX_DEPTH_LOGGED = 1000  # TODO: Use args.depth
 
 
-def prepare_ranges(index_path, dim, step, part_range):
+def prepare_ranges(
+    index_path,
+    dim,
+    step,
+    part_range,
+    maxsim="strided",
+    maxsim_threads=None,
+    compressed=False,
+):
     print_message("#> Launching a separate thread to load index parts asynchronously.")
     parts, _, _ = get_parts(index_path)
 
@@ -31,7 +40,13 @@ def prepare_ranges(index_path, dim, step, part_range):
     def _loader_thread(index_path, dim, positions):
         for offset, endpos in positions:
             index = IndexPart(
-                index_path, dim=dim, part_range=range(offset, endpos), verbose=True
+                index_path,
+                dim=dim,
+                part_range=range(offset, endpos),
+                verbose=True,
+                maxsim=maxsim,
+                maxsim_threads=maxsim_threads,
+                compressed=compressed,
             )
             loaded_parts.put(index, block=True)
 
@@ -49,13 +64,29 @@ def prepare_ranges(index_path, dim, step, part_range):
 
 
 def score_by_range(
-    positions, loaded_parts, all_query_embeddings, all_query_rankings, all_pids
+    positions,
+    loaded_parts,
+    all_query_embeddings,
+    all_query_rankings,
+    all_pids,
+    aliases=None,
 ):
+    """
+    With `aliases` (see load_aliases()), the pairs are split into ranges by canonical pid.
+    """
+
     print_message("#> Sorting by PID..")
-    all_query_indexes, all_pids = zipstar(all_pids)
-    sorting_pids = torch.tensor(all_pids).sort()
-    all_query_indexes, all_pids = (
+    all_query_indexes, all_original_pids = zipstar(all_pids)
+    all_original_pids = torch.tensor(all_original_pids)
+
+    all_pids = all_original_pids
+    if aliases is not None:
+        all_pids = aliases[all_original_pids]
+
+    sorting_pids = all_pids.sort()
+    all_query_indexes, all_original_pids, all_pids = (
         torch.tensor(all_query_indexes)[sorting_pids.indices],
+        all_original_pids[sorting_pids.indices],
         sorting_pids.values,
     )
 
@@ -71,7 +102,7 @@ def score_by_range(
         )
         range_end = range_end + (all_pids[range_end:] < index.pids_range.stop).sum()
 
-        pids = all_pids[range_start:range_end]
+        pids = all_original_pids[range_start:range_end]
         query_indexes = all_query_indexes[range_start:range_end]
 
         print_message(f"#> Got {len(pids)} query--passage pairs in this range.")
@@ -89,13 +120,22 @@ def score_by_range(
         for query_index, pid, score in zip(
             query_indexes.tolist(), pids.tolist(), scores
         ):
+            if score == float("-inf"):
+                continue  # deleted
+
             all_query_rankings[0][query_index].append(pid)
             all_query_rankings[1][query_index].append(score)
 
 
 def batch_rerank(args):
     positions, loaded_parts, thread = prepare_ranges(
-        args.index_path, args.dim, args.step, args.part_range
+        args.index_path,
+        args.dim,
+        args.step,
+        args.part_range,
+        args.maxsim,
+        args.maxsim_threads,
+        args.compressed,
     )
 
     inference = ModelInference(args.colbert, amp=args.amp)
@@ -127,13 +167,22 @@ def batch_rerank(args):
     )
     all_query_rankings = [defaultdict(list), defaultdict(list)]
 
+    aliases = load_aliases(args.index_path)
+
     print_message(f"#> Will process {len(all_pids)} query--document pairs in total.")
 
     with torch.no_grad():
         score_by_range(
-            positions, loaded_parts, all_query_embeddings, all_query_rankings, all_pids
+            positions,
+            loaded_parts,
+            all_query_embeddings,
+            all_query_rankings,
+            all_pids,
+            aliases,
         )
 
+    BUFFER_POOL.report()
+
     ranking_logger = RankingLogger(Run.path, qrels=None, log_scores=args.log_scores)
 
     with ranking_logger.context("ranking.tsv", also_save_annotations=False) as rlogger:
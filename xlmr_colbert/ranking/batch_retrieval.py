@@ -19,7 +19,12 @@ def batch_retrieve(args):
     ), "TODO: Combine batch (multi-query) retrieval with batch re-ranking"
 
     faiss_index = FaissIndex(
-        args.index_path, args.faiss_index_path, args.nprobe, args.part_range
+        args.index_path,
+        args.faiss_index_path,
+        args.nprobe,
+        args.part_range,
+        search_params=args.faiss_params,
+        mmap=args.faiss_mmap,
     )
     inference = ModelInference(args.colbert, amp=args.amp)
 
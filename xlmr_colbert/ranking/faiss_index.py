@@ -4,15 +4,43 @@ import faiss
 import random
 import torch
 
-from multiprocessing import Pool
 from xlmr_colbert.modeling.inference import ModelInference
 
 from xlmr_colbert.utils.utils import print_message, flatten, batch
-from xlmr_colbert.indexing.loaders import load_doclens
+from xlmr_colbert.indexing.loaders import load_doclens_arrays, load_deleted
+from xlmr_colbert.indexing.faiss_index import load_faiss_metadata
+from xlmr_colbert.indexing.index_manager import (
+    get_emb2pid_path,
+    build_emb2pid,
+    save_emb2pid,
+    load_emb2pid,
+)
+
+
+DEDUP_BSIZE = 1 << 10
 
 
 class FaissIndex:
-    def __init__(self, index_path, faiss_index_path, nprobe, part_range=None):
+    def __init__(
+        self,
+        index_path,
+        faiss_index_path,
+        nprobe,
+        part_range=None,
+        search_params=None,
+        mmap=False,
+    ):
+        """
+        `nprobe` applies to IVF indexes; `search_params` (e.g., "efSearch=128" for HNSW, or
+        "quantizer_efSearch=64" for an HNSW coarse quantizer) default to those saved with
+        the index.
+
+        The inverted lists of indexes exported with index_faiss --ondisk are always
+        memory-mapped from their .ivfdata file; with `mmap`, those of other IVF indexes are
+        memory-mapped from the index file itself. Either way, they are paged in on demand and
+        shared (through the page cache) by every process that serves the index.
+        """
+
         print_message("#> Loading the FAISS index from", faiss_index_path, "..")
 
         faiss_part_range = os.path.basename(faiss_index_path).split(".")[-2].split("-")
@@ -27,52 +55,114 @@ class FaissIndex:
         self.part_range = part_range
         self.faiss_part_range = faiss_part_range
 
-        self.faiss_index = faiss.read_index(faiss_index_path)
-        self.faiss_index.nprobe = nprobe
+        metadata = load_faiss_metadata(faiss_index_path)
+
+        io_flags = 0
+        if metadata["ondisk"]:
+            io_flags = faiss.IO_FLAG_ONDISK_SAME_DIR
+        elif mmap:
+            io_flags = faiss.IO_FLAG_MMAP
+
+        self.faiss_index = faiss.read_index(faiss_index_path, io_flags)
+
+        self.pid_labels = metadata["pid_labels"]
+
+        if search_params is None:
+            search_params = metadata["search_params"]
+
+        params = [] if search_params == "" else [search_params]
+        if faiss.try_extract_index_ivf(self.faiss_index) is not None:
+            params.insert(0, f"nprobe={nprobe}")
+
+        print_message(
+            f"#> Searching the {metadata['factory']} index with {','.join(params)}.."
+        )
+        faiss.ParameterSpace().set_index_parameters(self.faiss_index, ",".join(params))
 
-        print_message("#> Building the emb2pid mapping..")
-        all_doclens = load_doclens(index_path, flatten=False)
+        print_message("#> Loading the doclens..")
+        all_doclens, doclens_pfxsum, parts_doc_offsets = load_doclens_arrays(index_path)
+        num_parts = len(parts_doc_offsets) - 1
 
-        pid_offset = 0
+        pid_offset, pid_endpos = 0, len(all_doclens)
         if faiss_part_range is not None:
             print(f"#> Restricting all_doclens to the range {faiss_part_range}.")
-            pid_offset = len(flatten(all_doclens[: faiss_part_range.start]))
-            all_doclens = all_doclens[faiss_part_range.start : faiss_part_range.stop]
+            pid_offset = parts_doc_offsets[faiss_part_range.start]
+            pid_endpos = parts_doc_offsets[min(faiss_part_range.stop, num_parts)]
 
         self.relative_range = None
         if self.part_range is not None:
             start = (
                 self.faiss_part_range.start if self.faiss_part_range is not None else 0
             )
-            a = len(flatten(all_doclens[: self.part_range.start - start]))
-            b = len(flatten(all_doclens[: self.part_range.stop - start]))
-            self.relative_range = range(a, b)
+            a = parts_doc_offsets[min(self.part_range.start, num_parts)]
+            b = parts_doc_offsets[min(self.part_range.stop, num_parts)]
+            self.relative_range = range(
+                a - parts_doc_offsets[start], b - parts_doc_offsets[start]
+            )
             print(f"self.relative_range = {self.relative_range}")
 
-        all_doclens = flatten(all_doclens)
+        total_num_embeddings = int(
+            doclens_pfxsum[pid_endpos] - doclens_pfxsum[pid_offset]
+        )
+        assert total_num_embeddings == self.faiss_index.ntotal, (
+            total_num_embeddings,
+            self.faiss_index.ntotal,
+        )
+
+        self.deleted = load_deleted(index_path, len(all_doclens))
+
+        if self.deleted is not None:
+            print_message(f"#> Filtering out {self.deleted.sum()} deleted pids.")
+
+        self.emb2pid = None
+
+        if self.pid_labels:
+            print_message("#> The FAISS index is labelled with pids, skipping emb2pid.")
+        else:
+            self.emb2pid = self._load_emb2pid(
+                faiss_index_path, all_doclens, pid_offset, pid_endpos
+            )
+
+    def _load_emb2pid(self, faiss_index_path, all_doclens, pid_offset, pid_endpos):
+        print_message("#> Loading the emb2pid mapping..")
 
-        total_num_embeddings = sum(all_doclens)
-        self.emb2pid = torch.zeros(total_num_embeddings, dtype=torch.int)
+        total_num_embeddings = self.faiss_index.ntotal
 
-        offset_doclens = 0
-        for pid, dlength in enumerate(all_doclens):
-            self.emb2pid[offset_doclens : offset_doclens + dlength] = pid_offset + pid
-            offset_doclens += dlength
+        emb2pid_path = get_emb2pid_path(faiss_index_path)
+        emb2pid = load_emb2pid(emb2pid_path, total_num_embeddings)
 
-        print_message("len(self.emb2pid) =", len(self.emb2pid))
+        if emb2pid is None:
+            print_message(f"#> No {emb2pid_path}, building it once..")
+            all_doclens = all_doclens[pid_offset:pid_endpos]
 
-        self.parallel_pool = Pool(16)
+            try:
+                save_emb2pid(emb2pid_path, all_doclens, pid_offset)
+                emb2pid = load_emb2pid(emb2pid_path, total_num_embeddings)
+            except OSError as ex:
+                print_message(
+                    f"#> Could not save {emb2pid_path} ({ex}), keeping it in memory."
+                )
+                emb2pid = build_emb2pid(all_doclens, pid_offset)
+
+        print_message("len(self.emb2pid) =", len(emb2pid))
+
+        return emb2pid
+
+    def retrieve(self, faiss_depth, Q, verbose=False, as_csr=False):
+        """
+        Returns the unique candidate pids of each query, as a list of lists or, with `as_csr`,
+        as (pids, offsets) tensors where the pids of query i are pids[offsets[i]:offsets[i+1]].
+        """
 
-    def retrieve(self, faiss_depth, Q, verbose=False):
         embedding_ids = self.queries_to_embedding_ids(faiss_depth, Q, verbose=verbose)
-        pids = self.embedding_ids_to_pids(embedding_ids, verbose=verbose)
+        pids, offsets = self.embedding_ids_to_pids(embedding_ids, verbose=verbose)
 
-        if self.relative_range is not None:
-            pids = [
-                [pid for pid in pids_ if pid in self.relative_range] for pids_ in pids
-            ]
+        if as_csr:
+            return pids, offsets
+
+        pids, offsets = pids.tolist(), offsets.tolist()
 
-        return pids
+        return [pids[offset:endpos] for offset, endpos in zip(offsets, offsets[1:])]
 
     def queries_to_embedding_ids(self, faiss_depth, Q, verbose=True):
         # Flatten into a matrix for the faiss search.
@@ -110,28 +200,47 @@ class FaissIndex:
         return embedding_ids
 
     def embedding_ids_to_pids(self, embedding_ids, verbose=True):
-        # Find unique PIDs per query.
-        print_message("#> Lookup the PIDs..", condition=verbose)
-        all_pids = self.emb2pid[embedding_ids]
+        # Find unique PIDs per query, a block of rows at a time to bound the temporaries.
+        print_message("#> Lookup and deduplicate the PIDs..", condition=verbose)
 
-        print_message(
-            f"#> Converting to a list [shape = {all_pids.size()}]..", condition=verbose
-        )
-        all_pids = all_pids.tolist()
+        all_pids, all_counts = [], []
 
-        print_message(
-            "#> Removing duplicates (in parallel if large enough)..", condition=verbose
-        )
+        for offset in range(0, embedding_ids.size(0), DEDUP_BSIZE):
+            pids, counts = self._unique_pids(
+                embedding_ids[offset : offset + DEDUP_BSIZE]
+            )
 
-        if len(all_pids) > 5000:
-            all_pids = list(self.parallel_pool.map(uniq, all_pids))
-        else:
-            all_pids = list(map(uniq, all_pids))
+            all_pids.append(pids)
+            all_counts.append(counts)
+
+        all_counts = torch.cat(all_counts)
+        offsets = torch.zeros(all_counts.size(0) + 1, dtype=torch.long)
+        torch.cumsum(all_counts, dim=0, out=offsets[1:])
 
         print_message("#> Done with embedding_ids_to_pids().", condition=verbose)
 
-        return all_pids
+        return torch.cat(all_pids), offsets
+
+    def _unique_pids(self, embedding_ids):
+        # FAISS pads missing results with -1.
+        valid = embedding_ids >= 0
+
+        if self.pid_labels:
+            pids = embedding_ids
+        else:
+            pids = self.emb2pid[embedding_ids.clamp(min=0)].long()
+
+        pids = pids.masked_fill(~valid, -1).sort(dim=-1).values
+
+        keep = pids >= 0
+        keep[:, 1:] &= pids[:, 1:] != pids[:, :-1]
+
+        if self.deleted is not None:
+            keep &= ~self.deleted[pids.clamp(min=0)]
 
+        if self.relative_range is not None:
+            keep &= (pids >= self.relative_range.start) & (
+                pids < self.relative_range.stop
+            )
 
-def uniq(l):
-    return list(set(l))
+        return pids[keep], keep.sum(-1)
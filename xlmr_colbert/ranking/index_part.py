@@ -4,44 +4,95 @@ import ujson
 
 from math import ceil
 from itertools import accumulate
+from xlmr_colbert.parameters import DEVICE
 from xlmr_colbert.utils.utils import print_message, dotdict, flatten
 
-from xlmr_colbert.indexing.loaders import get_parts, load_doclens
-from xlmr_colbert.indexing.index_manager import load_index_part
+from xlmr_colbert.indexing.loaders import (
+    get_parts,
+    load_doclens_arrays,
+    load_deleted,
+    load_aliases,
+)
+from xlmr_colbert.indexing.index_manager import (
+    load_index_part,
+    load_contiguous_index,
+)
+from xlmr_colbert.indexing.residual import (
+    ResidualCodec,
+    ResidualTensor,
+    get_codes_path,
+    get_residuals_path,
+)
 from xlmr_colbert.ranking.index_ranker import IndexRanker
 
 
 class IndexPart:
-    def __init__(self, directory, dim=128, part_range=None, verbose=True):
+    def __init__(
+        self,
+        directory,
+        dim=128,
+        part_range=None,
+        verbose=True,
+        maxsim="strided",
+        maxsim_threads=None,
+        compressed=False,
+    ):
         first_part, last_part = (
             (0, None) if part_range is None else (part_range.start, part_range.stop)
         )
 
         # Load parts metadata
         all_parts, all_parts_paths, _ = get_parts(directory)
+        self.num_parts = len(all_parts)
         self.parts = all_parts[first_part:last_part]
         self.parts_paths = all_parts_paths[first_part:last_part]
 
         # Load doclens metadata
-        all_doclens = load_doclens(directory, flatten=False)
+        doclens, doclens_pfxsum, parts_doc_offsets = load_doclens_arrays(directory)
 
-        self.doc_offset = sum(
-            [len(part_doclens) for part_doclens in all_doclens[:first_part]]
-        )
-        self.doc_endpos = sum(
-            [len(part_doclens) for part_doclens in all_doclens[:last_part]]
+        self.parts_doc_offsets = parts_doc_offsets[
+            first_part : len(self.parts) + first_part + 1
+        ]
+        self.doc_offset, self.doc_endpos = (
+            self.parts_doc_offsets[0],
+            self.parts_doc_offsets[-1],
         )
         self.pids_range = range(self.doc_offset, self.doc_endpos)
 
-        self.parts_doclens = all_doclens[first_part:last_part]
-        self.doclens = flatten(self.parts_doclens)
-        self.num_embeddings = sum(self.doclens)
+        self.doclens = doclens[self.doc_offset : self.doc_endpos]
+        self.doclens_pfxsum = doclens_pfxsum[self.doc_offset : self.doc_endpos + 1]
+        self.num_embeddings = int(self.doclens_pfxsum[-1] - self.doclens_pfxsum[0])
+
+        # Over all pids: a duplicate may alias a passage of another part.
+        self.deleted = load_deleted(directory, len(doclens))
+        self.aliases = load_aliases(directory)
 
-        self.tensor = self._load_parts(dim, verbose)
-        self.ranker = IndexRanker(self.tensor, self.doclens)
+        self.directory = directory
+        self.maxsim = maxsim
+        self.device = "cpu" if maxsim == "cpu" else DEVICE
+        self.tensor = (
+            self._load_compressed_parts(dim, verbose)
+            if compressed
+            else self._load_parts(dim, verbose)
+        )
+        self.ranker = IndexRanker(
+            self.tensor,
+            self.doclens,
+            self.doclens_pfxsum,
+            maxsim=maxsim,
+            device=self.device,
+            threads=maxsim_threads,
+        )
 
     def _load_parts(self, dim, verbose):
-        tensor = torch.zeros(self.num_embeddings + 512, dim, dtype=torch.float16)
+        store, metadata = load_contiguous_index(self.directory)
+
+        if store is not None:
+            return self._map_parts(store, metadata, dim, verbose)
+
+        # Only the strided views of IndexRanker read past the last passage.
+        padding = 512 if self.maxsim == "strided" else 0
+        tensor = torch.zeros(self.num_embeddings + padding, dim, dtype=torch.float16)
 
         if verbose:
             print_message("tensor.size() = ", tensor.size())
@@ -50,7 +101,11 @@ class IndexPart:
         for idx, filename in enumerate(self.parts_paths):
             print_message("|> Loading", filename, "...", condition=verbose)
 
-            endpos = offset + sum(self.parts_doclens[idx])
+            part_offset, part_endpos = self.parts_doc_offsets[idx : idx + 2]
+            endpos = offset + int(
+                self.doclens_pfxsum[part_endpos - self.doc_offset]
+                - self.doclens_pfxsum[part_offset - self.doc_offset]
+            )
             part = load_index_part(filename, verbose=verbose)
 
             tensor[offset:endpos] = part
@@ -58,35 +113,151 @@ class IndexPart:
 
         return tensor
 
+    def _load_compressed_parts(self, dim, verbose):
+        """
+        The centroid ids and residuals written by compress_index.py, decompressed on the fly.
+        """
+
+        codec = ResidualCodec.load(self.directory)
+        assert codec.dim == dim, (codec.dim, dim)
+
+        codes, residuals = [], []
+
+        for part in self.parts:
+            print_message("|> Loading compressed part", part, "...", condition=verbose)
+
+            codes.append(load_index_part(get_codes_path(self.directory, part)))
+            residuals.append(load_index_part(get_residuals_path(self.directory, part)))
+
+        # Small enough to be resident where MaxSim runs.
+        tensor = ResidualTensor(codec, torch.cat(codes), torch.cat(residuals))
+        tensor = tensor.to(self.device)
+
+        assert tensor.size(0) == self.num_embeddings, "Stale compressed index!"
+
+        print_message(
+            f"#> Loaded {tensor.size(0)} compressed embeddings "
+            f"({round(tensor.nbytes / 2**20, 1)} MiB, "
+            f"{codec.nbits} bits per dimension of the residuals)",
+            condition=verbose,
+        )
+
+        return tensor
+
+    def _map_parts(self, store, metadata, dim, verbose):
+        assert metadata["dim"] == dim, (metadata["dim"], dim)
+        assert len(metadata["parts"]) == self.num_parts, "Stale contiguous index!"
+
+        parts = metadata["parts"][self.parts[0] : self.parts[-1] + 1]
+        offset, endpos = parts[0]["emb_offset"], parts[-1]["emb_endpos"]
+
+        assert endpos - offset == self.num_embeddings, (offset, endpos)
+        assert parts[0]["doc_offset"] == self.doc_offset, parts[0]
+        assert parts[-1]["doc_endpos"] == self.doc_endpos, parts[-1]
+
+        # Keep the padding: rows past `endpos` are either zeros or embeddings of the next parts,
+        # and both are masked out by the ranker.
+        tensor = store[offset : endpos + metadata["padding"]]
+
+        print_message(
+            f"#> Memory-mapped embeddings {offset}..{endpos} from the contiguous index, "
+            f"tensor.size() = {tensor.size()}",
+            condition=verbose,
+        )
+
+        return tensor
+
     def pid_in_range(self, pid):
         return pid in self.pids_range
 
+    def owns(self, pids):
+        """
+        The mask of the pids whose canonical pids are in this range, i.e., those it can score.
+        Under --part-range, the others are scored by the range that holds their canonical pids.
+        """
+
+        pids = torch.as_tensor(pids)
+        canonical = pids if self.aliases is None else self.aliases[pids]
+
+        return (canonical >= self.pids_range.start) & (canonical < self.pids_range.stop)
+
     def rank(self, Q, pids):
         """
-        Rank a single batch of Q x pids (e.g., 1k--10k pairs).
+        Rank a single batch of Q x pids (e.g., 1k--10k pairs), all owned by this range (see
+        owns()). Duplicates are scored through their canonical pids. Deleted pids are not
+        scored, and get a score of -inf.
         """
 
         assert Q.size(0) in [1, len(pids)], (Q.size(0), len(pids))
-        assert all(pid in self.pids_range for pid in pids), self.pids_range
 
-        pids_ = [pid - self.doc_offset for pid in pids]
-        scores = self.ranker.rank(Q, pids_)
+        pids = torch.tensor(pids)
+        pids_ = self._resolve(pids)
+        alive = self._alive(pids)
+
+        if alive is None:
+            return self.ranker.rank(Q, pids_.tolist())
 
-        return scores
+        scores = torch.full((len(pids_),), float("-inf"))
+
+        if alive.any():
+            Q = Q if Q.size(0) == 1 else Q[alive]
+            scores[alive] = torch.tensor(self.ranker.rank(Q, pids_[alive].tolist()))
+
+        return scores.tolist()
 
     def batch_rank(self, all_query_embeddings, query_indexes, pids, sorted_pids):
         """
         Rank a large, fairly dense set of query--passage pairs (e.g., 1M+ pairs).
-        Higher overhead, much faster for large batches.
+        Higher overhead, much faster for large batches. With `sorted_pids`, the pairs are sorted
+        by canonical pid.
         """
 
+        pids_ = self._resolve(pids)
+        alive = self._alive(pids)
+
+        if alive is None:
+            return self.ranker.batch_rank(
+                all_query_embeddings, query_indexes, pids_, sorted_pids
+            )
+
+        scores = torch.full((pids_.size(0),), float("-inf"))
+
+        if alive.any():
+            scores[alive] = torch.tensor(
+                self.ranker.batch_rank(
+                    all_query_embeddings,
+                    query_indexes[alive],
+                    pids_[alive],
+                    sorted_pids,
+                )
+            )
+
+        return scores.tolist()
+
+    def _resolve(self, pids):
+        """
+        The canonical pids of `pids`, relative to this range.
+        """
+
+        if self.aliases is not None:
+            pids = self.aliases[pids]
+
         assert (
             (pids >= self.pids_range.start) & (pids < self.pids_range.stop)
-        ).sum() == pids.size(0)
-
-        pids_ = pids - self.doc_offset
-        scores = self.ranker.batch_rank(
-            all_query_embeddings, query_indexes, pids_, sorted_pids
+        ).all(), (
+            f"Pids whose canonical pids are outside of {self.pids_range}: see owns()."
         )
 
-        return scores
+        return pids - self.doc_offset
+
+    def _alive(self, pids):
+        """
+        The mask of the pids that are not deleted, or None if none of them is.
+        """
+
+        if self.deleted is None:
+            return None
+
+        alive = ~self.deleted[pids]
+
+        return None if alive.all() else alive
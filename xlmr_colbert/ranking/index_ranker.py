@@ -2,28 +2,83 @@ import os
 import math
 import torch
 import ujson
+import threading
 import traceback
 
+from concurrent.futures import ThreadPoolExecutor
 from itertools import accumulate
 from xlmr_colbert.parameters import DEVICE
 from xlmr_colbert.utils.utils import print_message, dotdict, flatten
 
 BSIZE = 1 << 14
 
+# Tokens per block when every passage has its own query (see segmented_maxsim).
+SEGMENT_BSIZE = 1 << 12
+
+# Tokens per block of the cpu engine, so that their fp32 copy (1 MiB at dim=128) stays in cache.
+CPU_BLOCK_TOKENS = 1 << 11
+
+MAXSIM_MODES = ["strided", "segmented", "cpu"]
+DEFAULT_MAXSIM = "strided" if DEVICE.type == "cuda" else "cpu"
+
 
 class IndexRanker:
-    def __init__(self, tensor, doclens):
+    """
+    MaxSim over the passages of a flat [num_embeddings, dim] token matrix.
+
+    With maxsim="strided", passages are bucketed by length and gathered as padded
+    [n, stride, dim] views. With maxsim="segmented", only their real tokens are gathered and
+    the per-passage max is a segmented reduction, so no padding is computed (or needed after
+    the last passage). With maxsim="cpu", the same reduction runs block by block on a pool of
+    `threads` CPU threads (see CPUMaxSim).
+
+    `tensor` may also be a ResidualTensor, whose gathered rows are decompressed on the fly; it
+    has no strided views.
+    """
+
+    def __init__(
+        self,
+        tensor,
+        doclens,
+        doclens_pfxsum=None,
+        maxsim="strided",
+        device=DEVICE,
+        threads=None,
+    ):
+        assert maxsim in MAXSIM_MODES, maxsim
+        assert maxsim != "cpu" or torch.device(device).type == "cpu", device
+        assert maxsim != "strided" or isinstance(
+            tensor, torch.Tensor
+        ), "Compressed indexes need --maxsim segmented or cpu."
+
         self.tensor = tensor
         self.doclens = doclens
+        self.maxsim = maxsim
+        self.device = torch.device(device)
 
         self.maxsim_dtype = torch.float32
-        self.doclens_pfxsum = [0] + list(accumulate(self.doclens))
 
-        self.doclens = torch.tensor(self.doclens)
-        self.doclens_pfxsum = torch.tensor(self.doclens_pfxsum)
+        if doclens_pfxsum is None:
+            doclens_pfxsum = [0] + list(accumulate(self.doclens))
+
+        self.doclens = torch.as_tensor(self.doclens)
+        self.doclens_pfxsum = torch.as_tensor(doclens_pfxsum)
+
+        # The prefix sums may come from a slice of the whole index's; offsets into `tensor` are
+        # relative to its first entry.
+        self.doclens_pfxsum_base = self.doclens_pfxsum[0].item()
 
         self.dim = self.tensor.size(-1)
 
+        if self.maxsim == "cpu":
+            self.cpu_maxsim = CPUMaxSim(threads)
+            print_message(
+                f"#> Using the cpu engine with {self.cpu_maxsim.threads} threads.."
+            )
+
+        if self.maxsim != "strided":
+            return
+
         self.strides = [torch_percentile(self.doclens, p) for p in [90]]
         self.strides.append(self.doclens.max().item())
         self.strides = sorted(list(set(self.strides)))
@@ -31,7 +86,6 @@ class IndexRanker:
         print_message(f"#> Using strides {self.strides}..")
 
         self.views = self._create_views(self.tensor)
-        self.buffers = self._create_buffers(BSIZE, self.tensor.dtype, {"cpu", "cuda:0"})
 
     def _create_views(self, tensor):
         views = []
@@ -45,39 +99,23 @@ class IndexRanker:
 
         return views
 
-    def _create_buffers(self, max_bsize, dtype, devices):
-        buffers = {}
-
-        for device in devices:
-            buffers[device] = [
-                torch.zeros(
-                    max_bsize,
-                    stride,
-                    self.dim,
-                    dtype=dtype,
-                    device=device,
-                    pin_memory=(device == "cpu"),
-                )
-                for stride in self.strides
-            ]
-
-        return buffers
-
     def rank(self, Q, pids, views=None, shift=0):
         assert len(pids) > 0
         assert Q.size(0) in [1, len(pids)]
 
-        Q = Q.contiguous().to(DEVICE).to(dtype=self.maxsim_dtype)
+        if self.maxsim != "strided":
+            return self._segmented_rank(Q, pids, self.tensor)
+
+        Q = Q.contiguous().to(self.device).to(dtype=self.maxsim_dtype)
 
         views = self.views if views is None else views
         VIEWS_DEVICE = views[0].device
 
-        D_buffers = self.buffers[str(VIEWS_DEVICE)]
-
         raw_pids = pids if type(pids) is list else pids.tolist()
         pids = torch.tensor(pids) if type(pids) is list else pids
 
-        doclens, offsets = self.doclens[pids], self.doclens_pfxsum[pids]
+        doclens = self.doclens[pids]
+        offsets = self.doclens_pfxsum[pids] - self.doclens_pfxsum_base
 
         assignments = (
             doclens.unsqueeze(1) > torch.tensor(self.strides).unsqueeze(0) + 1e-6
@@ -105,17 +143,17 @@ class IndexRanker:
             )
 
             D_size = group_offsets_uniq.size(0)
+            D_buffer = BUFFER_POOL.get(
+                (D_size, stride, self.dim), self.tensor.dtype, VIEWS_DEVICE
+            )
             D = torch.index_select(
-                views[group_idx],
-                0,
-                group_offsets_uniq,
-                out=D_buffers[group_idx][:D_size],
+                views[group_idx], 0, group_offsets_uniq, out=D_buffer
             )
-            D = D.to(DEVICE)
-            D = D[group_offsets_expand.to(DEVICE)].to(dtype=self.maxsim_dtype)
+            D = D.to(self.device)
+            D = D[group_offsets_expand.to(self.device)].to(dtype=self.maxsim_dtype)
 
-            mask = torch.arange(stride, device=DEVICE) + 1
-            mask = mask.unsqueeze(0) <= group_doclens.to(DEVICE).unsqueeze(-1)
+            mask = torch.arange(stride, device=self.device) + 1
+            mask = mask.unsqueeze(0) <= group_doclens.to(self.device).unsqueeze(-1)
 
             scores = (D @ group_Q) * mask.unsqueeze(-1)
             scores = scores.max(1).values.sum(-1).cpu()
@@ -134,6 +172,18 @@ class IndexRanker:
 
         return output_scores
 
+    def _segmented_rank(self, Q, pids, tensor, shift=0):
+        Q = Q.contiguous().to(self.device).to(dtype=self.maxsim_dtype)
+        pids = torch.as_tensor(pids)
+
+        doclens = self.doclens[pids]
+        offsets = self.doclens_pfxsum[pids] - self.doclens_pfxsum_base - shift
+
+        maxsim = self.cpu_maxsim if self.maxsim == "cpu" else segmented_maxsim
+        scores = maxsim(tensor, Q, offsets, doclens)
+
+        return scores.cpu().tolist()
+
     def batch_rank(
         self, all_query_embeddings, all_query_indexes, all_pids, sorted_pids
     ):
@@ -164,11 +214,17 @@ class IndexRanker:
                 f"###--> Ranking in batches the pairs #{range_start} through #{range_end} in this sub-range."
             )
 
-            tensor_offset = self.doclens_pfxsum[pid_offset].item()
-            tensor_endpos = self.doclens_pfxsum[pid_endpos].item() + 512
+            tensor_offset = (
+                self.doclens_pfxsum[pid_offset].item() - self.doclens_pfxsum_base
+            )
+            tensor_endpos = (
+                self.doclens_pfxsum[pid_endpos].item() - self.doclens_pfxsum_base + 512
+            )
+
+            collection = self.tensor[tensor_offset:tensor_endpos].to(self.device)
 
-            collection = self.tensor[tensor_offset:tensor_endpos].to(DEVICE)
-            views = self._create_views(collection)
+            if self.maxsim == "strided":
+                views = self._create_views(collection)
 
             print_message(f"#> Ranking in batches of {BSIZE} query--passage pairs...")
 
@@ -184,13 +240,168 @@ class IndexRanker:
 
                 Q = all_query_embeddings[batch_query_index]
 
-                scores.extend(self.rank(Q, batch_pids, views, shift=tensor_offset))
+                if self.maxsim != "strided":
+                    scores.extend(
+                        self._segmented_rank(
+                            Q, batch_pids, collection, shift=tensor_offset
+                        )
+                    )
+                else:
+                    scores.extend(self.rank(Q, batch_pids, views, shift=tensor_offset))
 
         return scores
 
 
+class BufferPool:
+    """
+    Staging buffers for the strided gathers of IndexRanker.rank(), one per (device, dtype) and
+    shared by all instances. Each grows (in powers of two) to the largest gather seen, instead of
+    BSIZE x stride x dim per stride being allocated upfront for every IndexRanker.
+
+    A gathered group is consumed before the next one is gathered, so a single buffer suffices,
+    but rank() must not run concurrently on the same device.
+    """
+
+    def __init__(self):
+        self.buffers = {}
+        self.lock = threading.Lock()
+
+        self.nbytes = 0
+        self.high_water_mark = 0
+
+    def get(self, size, dtype, device):
+        key, numel = (str(device), dtype), math.prod(size)
+
+        with self.lock:
+            buffer = self.buffers.get(key)
+
+            if buffer is None or buffer.numel() < numel:
+                buffer = self._grow(key, numel)
+
+        return buffer[:numel].view(size)
+
+    def _grow(self, key, numel):
+        device, dtype = key
+
+        if key in self.buffers:
+            buffer = self.buffers.pop(key)
+            self.nbytes -= buffer.numel() * buffer.element_size()
+
+        buffer = torch.empty(
+            1 << max(numel - 1, 0).bit_length(),
+            dtype=dtype,
+            device=device,
+            pin_memory=(device == "cpu" and torch.cuda.is_available()),
+        )
+
+        self.buffers[key] = buffer
+        self.nbytes += buffer.numel() * buffer.element_size()
+        self.high_water_mark = max(self.high_water_mark, self.nbytes)
+
+        return buffer
+
+    def report(self):
+        print_message(
+            f"#> Buffer pool: {len(self.buffers)} buffers, "
+            f"{round(self.nbytes / 2**20, 1)} MiB now, "
+            f"{round(self.high_water_mark / 2**20, 1)} MiB at most."
+        )
+
+
+BUFFER_POOL = BufferPool()
+
+
 def torch_percentile(tensor, p):
     assert p in range(1, 100 + 1)
     assert tensor.dim() == 1
 
     return tensor.kthvalue(int(p * tensor.size(0) / 100.0)).values.item()
+
+
+def segmented_maxsim(tensor, Q, offsets, doclens):
+    """
+    Score passage i, made of the rows tensor[offsets[i] : offsets[i] + doclens[i]], against
+    Q[i] (or Q[0] for all passages), a [dim, query_maxlen] matrix. Only real tokens are
+    gathered, and computation happens on Q's device and in its dtype.
+    """
+
+    doclens = doclens.long()
+    num_docs, device = doclens.size(0), Q.device
+
+    # The (global) row of every token, and the passage it belongs to.
+    segment_ids = torch.repeat_interleave(torch.arange(num_docs), doclens)
+    segment_starts = torch.cumsum(doclens, dim=0) - doclens
+    token_ids = torch.arange(segment_ids.size(0)) - segment_starts[segment_ids]
+    token_ids += offsets.long()[segment_ids]
+
+    D = tensor[token_ids.to(tensor.device)].to(device=device, dtype=Q.dtype)
+    segment_ids = segment_ids.to(device)
+
+    if Q.size(0) == 1 or D.size(0) == 0:
+        token_scores = D @ Q[0]
+    else:
+        token_scores = torch.cat(
+            [
+                (
+                    D[offset : offset + SEGMENT_BSIZE].unsqueeze(1)
+                    @ Q[segment_ids[offset : offset + SEGMENT_BSIZE]]
+                ).squeeze(1)
+                for offset in range(0, D.size(0), SEGMENT_BSIZE)
+            ]
+        )
+
+    scores = torch.full(
+        (num_docs, Q.size(-1)), float("-inf"), device=device, dtype=Q.dtype
+    )
+    scores.scatter_reduce_(
+        0,
+        segment_ids.unsqueeze(-1).expand_as(token_scores),
+        token_scores,
+        reduce="amax",
+    )
+
+    return scores.sum(-1)
+
+
+class CPUMaxSim:
+    """
+    segmented_maxsim() for CPU-only serving. Candidates are cut into consecutive blocks of about
+    CPU_BLOCK_TOKENS tokens, so that only one block at a time is gathered and upcast from fp16,
+    and the blocks are scored by `threads` workers.
+    """
+
+    def __init__(self, threads=None):
+        self.threads = threads or torch.get_num_threads()
+        self.executor = None
+
+        if self.threads > 1:
+            self.executor = ThreadPoolExecutor(self.threads)
+
+    def __call__(self, tensor, Q, offsets, doclens):
+        doclens = doclens.long()
+
+        # Passages go to the block in which their last token falls.
+        block_ids = torch.div(
+            torch.cumsum(doclens, dim=0) - 1, CPU_BLOCK_TOKENS, rounding_mode="floor"
+        )
+        counts = torch.unique_consecutive(block_ids, return_counts=True)[1].tolist()
+
+        all_Q = [Q] * len(counts) if Q.size(0) == 1 else Q.split(counts)
+        blocks = zip(all_Q, offsets.split(counts), doclens.split(counts))
+
+        run = lambda block: segmented_maxsim(tensor, *block)
+
+        if self.executor is None:
+            return torch.cat(list(map(run, blocks)))
+
+        # The (process-wide) intra-op threads are split between the workers for the duration
+        # of the call, and restored after it.
+        num_threads = torch.get_num_threads()
+        torch.set_num_threads(max(1, num_threads // self.threads))
+
+        try:
+            scores = list(self.executor.map(run, blocks))
+        finally:
+            torch.set_num_threads(num_threads)
+
+        return torch.cat(scores)
@@ -18,6 +18,8 @@ class Ranker:
                 args.faiss_index_path,
                 args.nprobe,
                 part_range=args.part_range,
+                search_params=args.faiss_params,
+                mmap=args.faiss_mmap,
             )
             self.retrieve = partial(self.faiss_index.retrieve, self.faiss_depth)
 
@@ -26,6 +28,9 @@ class Ranker:
             dim=inference.colbert.dim,
             part_range=args.part_range,
             verbose=True,
+            maxsim=args.maxsim,
+            maxsim_threads=args.maxsim_threads,
+            compressed=args.compressed,
         )
 
     def encode(self, queries):
@@ -44,14 +49,23 @@ class Ranker:
         assert Q.size(0) == 1, (len(pids), Q.size())
         assert all(type(pid) is int for pid in pids)
 
+        # Under --part-range, the pairs whose canonical pids are in other parts (e.g., duplicates)
+        # are left to the runs over those parts, like in batch_reranking.score_by_range().
+        if len(pids) > 0:
+            pids = torch.tensor(pids)[self.index.owns(pids)].tolist()
+
         scores = []
         if len(pids) > 0:
             Q = Q.permute(0, 2, 1)
-            scores = self.index.rank(Q, pids)
+            scores = torch.tensor(self.index.rank(Q, pids))
+
+            # Deleted passages are scored -inf: drop them.
+            alive = scores > float("-inf")
+            pids, scores = torch.tensor(pids)[alive], scores[alive]
 
-            scores_sorter = torch.tensor(scores).sort(descending=True)
+            scores_sorter = scores.sort(descending=True)
             pids, scores = (
-                torch.tensor(pids)[scores_sorter.indices].tolist(),
+                pids[scores_sorter.indices].tolist(),
                 scores_sorter.values.tolist(),
             )
 
@@ -12,6 +12,7 @@ from xlmr_colbert.evaluation.ranking_logger import RankingLogger
 
 from xlmr_colbert.utils.utils import print_message, batch
 from xlmr_colbert.ranking.rankers import Ranker
+from xlmr_colbert.ranking.index_ranker import BUFFER_POOL
 
 
 def retrieve(args):
@@ -31,13 +32,15 @@ def retrieve(args):
             rankings = []
 
             for query_idx, q in enumerate(qbatch_text):
-                torch.cuda.synchronize("cuda:0")
+                if torch.cuda.is_available():
+                    torch.cuda.synchronize("cuda:0")
                 s = time.time()
 
                 Q = ranker.encode([q])
                 pids, scores = ranker.rank(Q)
 
-                torch.cuda.synchronize()
+                if torch.cuda.is_available():
+                    torch.cuda.synchronize()
                 milliseconds += (time.time() - s) * 1000.0
 
                 if len(pids):
@@ -66,6 +69,8 @@ def retrieve(args):
                 ]
                 rlogger.log(qid, ranking, is_ranked=True)
 
+    BUFFER_POOL.report()
+
     print("\n\n")
     print(ranking_logger.filename)
     print("#> Done.")
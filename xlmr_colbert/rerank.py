@@ -3,6 +3,7 @@ import random
 
 from xlmr_colbert.utils.parser import Arguments
 from xlmr_colbert.utils.runs import Run
+from xlmr_colbert.ranking.index_ranker import MAXSIM_MODES, DEFAULT_MAXSIM
 
 from xlmr_colbert.evaluation.loaders import (
     load_colbert,
@@ -26,6 +27,13 @@ def main():
 
     parser.add_argument("--step", dest="step", default=1, type=int)
     parser.add_argument("--part-range", dest="part_range", default=None, type=str)
+    parser.add_argument(
+        "--maxsim", dest="maxsim", default=DEFAULT_MAXSIM, choices=MAXSIM_MODES
+    )
+    parser.add_argument("--threads", dest="maxsim_threads", default=None, type=int)
+    parser.add_argument(
+        "--compressed", dest="compressed", default=False, action="store_true"
+    )
     parser.add_argument(
         "--log-scores", dest="log_scores", default=False, action="store_true"
     )
@@ -3,6 +3,7 @@ import random
 
 from xlmr_colbert.utils.parser import Arguments
 from xlmr_colbert.utils.runs import Run
+from xlmr_colbert.ranking.index_ranker import MAXSIM_MODES, DEFAULT_MAXSIM
 
 from xlmr_colbert.evaluation.loaders import load_colbert, load_qrels, load_queries
 from xlmr_colbert.indexing.faiss import get_faiss_index_name
@@ -23,6 +24,13 @@ def main():
     parser.add_argument("--faiss_name", dest="faiss_name", default=None, type=str)
     parser.add_argument("--faiss_depth", dest="faiss_depth", default=1024, type=int)
     parser.add_argument("--part-range", dest="part_range", default=None, type=str)
+    parser.add_argument(
+        "--maxsim", dest="maxsim", default=DEFAULT_MAXSIM, choices=MAXSIM_MODES
+    )
+    parser.add_argument("--threads", dest="maxsim_threads", default=None, type=int)
+    parser.add_argument(
+        "--compressed", dest="compressed", default=False, action="store_true"
+    )
     parser.add_argument("--batch", dest="batch", default=False, action="store_true")
     parser.add_argument("--depth", dest="depth", default=1000, type=int)
     parser.add_argument(
@@ -0,0 +1,30 @@
+import os
+import random
+
+from xlmr_colbert.utils.runs import Run
+from xlmr_colbert.utils.parser import Arguments
+from xlmr_colbert.indexing.index_manager import save_token_df
+
+
+def main():
+    random.seed(12345)
+
+    parser = Arguments(
+        description="Counting token document frequencies, for index.py --min_idf."
+    )
+
+    parser.add_argument("--index_root", dest="index_root", required=True)
+    parser.add_argument("--index_name", dest="index_name", required=True)
+    parser.add_argument("--output", dest="output", required=True)
+
+    args = parser.parse()
+
+    with Run.context():
+        args.index_path = os.path.join(args.index_root, args.index_name)
+        assert os.path.exists(args.index_path), args.index_path
+
+        save_token_df(args.index_path, args.output)
+
+
+if __name__ == "__main__":
+    main()
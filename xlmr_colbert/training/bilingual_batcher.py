@@ -20,7 +20,10 @@ class BilingualBatcher:
         self.query_tokenizer = QueryTokenizer(args.query_maxlen)
         self.doc_tokenizer = DocTokenizer(args.doc_maxlen)
         self.tensorize_triples = partial(
-            tensorize_triples, self.query_tokenizer, self.doc_tokenizer
+            tensorize_triples,
+            self.query_tokenizer,
+            self.doc_tokenizer,
+            max_tokens=args.max_tokens,
         )
         self.position = 0
 
@@ -100,6 +100,7 @@ def train(args):
 
     start_time = time.time()
     train_loss = 0.0
+    num_tokens = 0
 
     start_batch_idx = 0
 
@@ -116,13 +117,20 @@ def train(args):
             with amp.context():
                 scores = colbert(queries, passages).view(2, -1).permute(1, 0)
                 loss = criterion(scores, labels[: scores.size(0)])
-                loss = loss / args.accumsteps
+
+                if args.max_tokens is None:
+                    loss = loss / args.accumsteps
+                else:
+                    # Sub-batches vary in size: weigh each by its share of the batch.
+                    loss = loss * (scores.size(0) / args.bsize)
 
             if args.rank < 1:
                 print_progress(scores)
 
             amp.backward(loss)
 
+            num_tokens += queries[1].sum().item() + passages[1].sum().item()
+
             train_loss += loss.item()
             this_batch_loss += loss.item()
 
@@ -156,6 +164,12 @@ def train(args):
                 step=batch_idx,
                 log_to_mlflow=log_to_mlflow,
             )
+            Run.log_metric(
+                "train/tokens_per_sec",
+                num_tokens / elapsed,
+                step=batch_idx,
+                log_to_mlflow=log_to_mlflow,
+            )
 
             print_message(batch_idx, avg_loss)
             manage_checkpoints(args, colbert, optimizer, batch_idx + 1)
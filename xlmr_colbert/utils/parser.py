@@ -57,8 +57,32 @@ class Arguments:
         self.add_argument("--maxsteps", dest="maxsteps", default=400000, type=int)
         self.add_argument("--bsize", dest="bsize", default=32, type=int)
         self.add_argument("--accum", dest="accumsteps", default=2, type=int)
+        self.add_argument("--max_tokens", dest="max_tokens", default=None, type=int)
         self.add_argument("--amp", dest="amp", default=False, action="store_true")
 
+    def add_index_pruning_parameters(self):
+        # Passage tokens not to store, see TokenPruner.
+        self.add_argument(
+            "--prune_punctuation",
+            dest="prune_punctuation",
+            default=False,
+            action="store_true",
+        )
+        self.add_argument("--stopwords", dest="stopwords", default=None, nargs="+")
+        self.add_argument("--token_df", dest="token_df", default=None)
+        self.add_argument("--min_idf", dest="min_idf", default=None, type=float)
+        self.add_argument("--min_norm", dest="min_norm", default=None, type=float)
+
+    def add_faiss_adding_parameters(self):
+        # Streaming embeddings into FAISS, see iterate_slices().
+        self.add_argument(
+            "--memory_budget", dest="memory_budget", default=None, type=float
+        )  # in MiBs
+        self.add_argument("--faiss_threads", dest="faiss_threads", default=1, type=int)
+        self.add_argument(
+            "--faiss_prefetch", dest="faiss_prefetch", default=2, type=int
+        )
+
     def add_model_inference_parameters(self):
         self.add_argument("--checkpoint", dest="checkpoint", required=True)
         self.add_argument("--bsize", dest="bsize", default=128, type=int)
@@ -156,10 +180,20 @@ class Arguments:
         self.add_argument("--index_root", dest="index_root", required=True)
         self.add_argument("--index_name", dest="index_name", required=True)
         self.add_argument("--partitions", dest="partitions", default=None, type=int)
+        self.add_argument(
+            "--pid_labels", dest="pid_labels", default=False, action="store_true"
+        )
+        self.add_argument(
+            "--faiss_factory", dest="faiss_factory", default="ivfpq", type=str
+        )
 
     def add_retrieval_input(self):
         self.add_index_use_input()
         self.add_argument("--nprobe", dest="nprobe", default=10, type=int)
+        self.add_argument("--faiss_params", dest="faiss_params", default=None, type=str)
+        self.add_argument(
+            "--faiss_mmap", dest="faiss_mmap", default=False, action="store_true"
+        )
         self.add_argument(
             "--retrieve_only", dest="retrieve_only", default=False, action="store_true"
         )